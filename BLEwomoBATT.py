@@ -6,11 +6,8 @@
 # https://github.com/micropython/micropython-lib/tree/master/micropython/bluetooth/aioble
 # and in particular the temp_client.py example included with aioble.
 
-from ota import OTAUpdater
-from WIFI_CONFIG import SSID, PASSWORD, SSID_TEST, PASSWORD_TEST
 import ubluetooth as bluetooth
 import time
-import network
 import machine
 #import urequests
 #import ussl
@@ -32,66 +29,17 @@ import central
 
 import random
 import struct
-
-# Wi-Fi-Verbindungsdetails
-wifi_ssid = SSID
-wifi_password = PASSWORD
-wifi_ssid_test = SSID_TEST
-wifi_password_test = PASSWORD_TEST
+import berger
+import log
+import scanfilter
 
 # BT-Batt service-UUID
 _BTBATT_UUID = bluetooth.UUID(0xFFF0)
 # org.bluetooth.characteristic.temperature
 _ENV_SENSE_BATT_UUID = bluetooth.UUID(0xfff6)
+# Scan results weaker than this are skipped
+_MIN_RSSI = -95
 
-# OTA-Update durchführen
-def perform_ota_update():
-    firmware_url = "https://raw.githubusercontent.com/gkutyi/Berger-LiFePo4-BLE2MQTT/"
-    ota_updater = OTAUpdater(SSID, PASSWORD, firmware_url, "main.py")
-    if ota_updater.download_and_install_update_if_available():
-        return True
-    else: return False
-
-# Function to reset the WiFi interface
-def reset_wifi_interface():
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(False)
-    time.sleep(1)
-    wlan.active(True)
-
-# Function to connect to a WiFi network
-def connect_to_wifi(ssid, password):
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    wlan.disconnect()  # Ensure we start with a clean state
-    
-    attempts = 3  # Number of attempts to connect
-    for attempt in range(attempts):
-        try:
-            wlan.connect(ssid, password)
-            
-            timeout = 2  # Seconds to wait for connection
-            while not wlan.isconnected() and timeout > 0:
-                print(f'Attempting to connect to {ssid}... (Attempt {attempt + 1}/{attempts})')
-                time.sleep(1)
-                timeout -= 1
-            
-            if wlan.isconnected():
-                print(f'Connected to {ssid}')
-                print('Network config:', wlan.ifconfig())
-                return True
-            
-        except OSError as e:
-            print(f'Error on attempt {attempt + 1}: {e}')
-            time.sleep(2)  # Wait before retrying
-        
-        # Reset WiFi interface before retrying
-        reset_wifi_interface()
-        time.sleep(2)  # Short delay to ensure reset is processed
-    
-    print(f'Failed to connect to {ssid} after {attempts} attempts')
-    return False
-    
 # Helper to decode the temperature characteristic encoding (sint16, hundredths of a degree).
 def _decode_temperature(data):
     return struct.unpack("<h", data)[0] / 100
@@ -101,14 +49,13 @@ async def find_temp_sensor():
     # maximise detection rate).
     async with central.scan(5000, interval_us=30000, window_us=30000, active=True) as scanner:
         async for result in scanner:
-            #print(result, result.name(), result.rssi, result.services())
-            print(result.name())
-            # See if it matches our name and the environmental sensing service.
-            for service in result.services():
-                print(service)
-            #if result.name() == "BT-Battery" and 
-            if _BTBATT_UUID in result.services():
-                return result.device
+            # Cheap checks first; the AD structures are only walked in place
+            # for connectable devices in range, never fully parsed.
+            if not result.connectable or result.rssi < _MIN_RSSI:
+                continue
+            for adv in (result.adv_data, result.resp_data):
+                if adv and scanfilter.has_uuid16(adv, 0xFFF0):
+                    return result.device
     return None
     
 async def notification_handler(batt_char):
@@ -117,24 +64,22 @@ async def notification_handler(batt_char):
     :param characteristic: The characteristic from which the notification was received.
     """
     print("notification_handler")
+    assembler = berger.Assembler()
+    decoder = berger.Decoder()
     while True:
         data = await batt_char.notified()
-        hex_data = data.hex()
-        print(hex_data[0])
-        print(hex_data[1])
-        print(data[0])
-        if data[0] == 58:
-            print(f"Notification_3A: {hex_data}")
-        print(f"Notification: {hex_data}")
+        assembler.feed(data)
+        n = assembler.pending()
+        while n:
+            rc = decoder.decode(assembler.frame(), n)
+            assembler.release()
+            if rc != berger.OK:
+                log.warning("Invalid frame, error %d", rc)
+            elif decoder.has_status:
+                log.debug("Notification: %d mV, %d mA, SOC %d%%", decoder.pack_mv, decoder.current_ma, decoder.soc)
+            n = assembler.pending()
 
 async def main():
-        # Try to connect to the primary WiFi network
-    if not connect_to_wifi(wifi_ssid, wifi_password):
-        # If the primary connection fails, try the secondary WiFi network
-        connect_to_wifi(wifi_ssid_test, wifi_password_test)
-    
-    perform_ota_update()
-    
     device = await find_temp_sensor()
     if not device:
         print("Temperature sensor not found")
@@ -0,0 +1,204 @@
+# Streaming per-window statistics of one battery.
+#
+# add() folds every decoded status frame into preallocated accumulators:
+# min/max/sum of pack voltage, current, each temperature and the cell
+# spread (highest minus lowest cell), plus the charge and energy that went
+# in and out since the previous frame (sample and hold: the previous
+# current and voltage over the time between the two frames). close() turns
+# them into one JSON summary per window and starts the next window;
+# flush() publishes the summaries, keeping a bounded backlog while the
+# broker is unreachable:
+#
+#   {"ts": 1760000000, "n": 30, "s": 60,
+#    "voltage": [13.28, 13.291, 13.3], "current": [-12.7, -12.31, -11.9],
+#    "spread_mv": [8, 9.4, 11], "temp1": [21.5, 21.52, 21.6], ...,
+#    "mAh_in": 0, "mAh_out": 205.17, "Wh_in": 0, "Wh_out": 2.727,
+#    "soc": 86, "gaps": 0}
+#
+# Triples are [min, mean, max] in V, A, mV and degC. Charge and energy
+# carry over window boundaries, so summing windows loses nothing; frames
+# more than MAX_DT_MS apart are counted in gaps and integrated for
+# MAX_DT_MS only.
+#
+# Per frame everything stays in small ints and arrays, so add() does not
+# allocate on MicroPython. Charge is integrated in 10 mA*ms and energy in
+# 0.1 W*ms, whole mAh and mWh are carried out of the remainders, so every
+# product fits a small int for packs up to 60 V and 327 A.
+
+from array import array
+
+from compat import compact_json, ticks_diff, ticks_ms, unix_time
+
+MAX_DT_MS = 5000
+
+# Accumulator fields; temperatures follow from F_TEMP
+F_VOLTAGE = 0
+F_CURRENT = 1
+F_SPREAD = 2
+F_TEMP = 3
+
+_MAH = 360000  # 10 mA*ms per mAh
+_MWH = 36000  # 0.1 W*ms per mWh
+
+# Charge and energy: whole units and remainder, in then out
+Q_IN = 0
+Q_OUT = 2
+E_IN = 4
+E_OUT = 6
+
+
+class Aggregator:
+    """Per-window min/max/mean, cell spread and charge/energy counters.
+
+        agg = Aggregator(topic + "/stats", max_temps)
+        agg.add(decoder)           # every decoded frame
+        agg.close()                # once per window
+        await agg.flush(client)
+    """
+
+    def __init__(self, topic, max_temps=4, max_backlog=8):
+        self.topic = topic
+        self.max_temps = max_temps
+        self.max_backlog = max_backlog
+        n = F_TEMP + max_temps
+        self._min = array('l', [0] * n)
+        self._max = array('l', [0] * n)
+        self._sum = array('l', [0] * n)
+        self._n = array('l', [0] * n)
+        self._acc = array('l', [0] * 8)
+        self._cv = 0  # last pack voltage [10 mV] and current [10 mA]
+        self._ca = 0
+        self._t = None
+        self._t0 = ticks_ms()
+        self.samples = 0
+        self.soc = 0
+        self.gaps = 0
+        self._backlog = []
+        self.windows = 0
+        self.messages = 0
+        self.dropped = 0
+
+    def _fold(self, f, v):
+        if self._n[f]:
+            if v < self._min[f]:
+                self._min[f] = v
+            if v > self._max[f]:
+                self._max[f] = v
+        else:
+            self._min[f] = v
+            self._max[f] = v
+        self._sum[f] += v
+        self._n[f] += 1
+
+    def _carry(self, k, v, unit):
+        r = self._acc[k + 1] + v
+        if r >= unit:
+            self._acc[k] += r // unit
+            r %= unit
+        self._acc[k + 1] = r
+
+    def _integrate(self, now):
+        dt = ticks_diff(now, self._t)
+        if dt > MAX_DT_MS:
+            self.gaps += 1
+            dt = MAX_DT_MS
+        ca = self._ca
+        if ca > 0:
+            self._carry(Q_IN, ca * dt, _MAH)
+            self._carry(E_IN, (self._cv * ca + 500) // 1000 * dt, _MWH)
+        elif ca < 0:
+            self._carry(Q_OUT, -ca * dt, _MAH)
+            self._carry(E_OUT, (self._cv * -ca + 500) // 1000 * dt, _MWH)
+
+    def add(self, dec, now=None):
+        if not dec.has_status:
+            return
+        if now is None:
+            now = ticks_ms()
+        if self._t is not None:
+            self._integrate(now)
+        self._t = now
+        self._cv = dec.pack_mv // 10
+        self._ca = dec.current_ma // 10
+        self._fold(F_VOLTAGE, dec.pack_mv)
+        self._fold(F_CURRENT, dec.current_ma)
+        cells = dec.cells
+        if dec.ncells:
+            lo = hi = cells[0]
+            for i in range(1, dec.ncells):
+                v = cells[i]
+                if v < lo:
+                    lo = v
+                elif v > hi:
+                    hi = v
+            self._fold(F_SPREAD, hi - lo)
+        temps = dec.temps
+        for i in range(min(dec.ntemps, self.max_temps)):
+            self._fold(F_TEMP + i, temps[i])
+        self.soc = dec.soc
+        self.samples += 1
+
+    def _stats(self, f, scale):
+        mean = round(self._sum[f] / self._n[f] / scale, 3)
+        if scale == 1:
+            return [self._min[f], mean, self._max[f]]
+        return [self._min[f] / scale, mean, self._max[f] / scale]
+
+    def _take(self, k, unit, scale):
+        # Whole units plus remainder, then both start from zero
+        v = (self._acc[k] + self._acc[k + 1] / unit) / scale
+        self._acc[k] = 0
+        self._acc[k + 1] = 0
+        return round(v, 3)
+
+    def summary(self):
+        d = {"ts": unix_time(), "n": self.samples, "s": ticks_diff(ticks_ms(), self._t0) // 1000}
+        d["voltage"] = self._stats(F_VOLTAGE, 1000)
+        d["current"] = self._stats(F_CURRENT, 1000)
+        if self._n[F_SPREAD]:
+            d["spread_mv"] = self._stats(F_SPREAD, 1)
+        for i in range(self.max_temps):
+            if self._n[F_TEMP + i]:
+                d["temp%d" % (i + 1)] = self._stats(F_TEMP + i, 10)
+        d["mAh_in"] = self._take(Q_IN, _MAH, 1)
+        d["mAh_out"] = self._take(Q_OUT, _MAH, 1)
+        d["Wh_in"] = self._take(E_IN, _MWH, 1000)
+        d["Wh_out"] = self._take(E_OUT, _MWH, 1000)
+        d["soc"] = self.soc
+        d["gaps"] = self.gaps
+        return compact_json(d)
+
+    def close(self):
+        # Ends the window: queues its summary (if it saw a frame) and
+        # resets the statistics. Charge and energy since the last frame
+        # count towards the next window.
+        if self.samples:
+            if len(self._backlog) >= self.max_backlog:
+                self._backlog.pop(0)
+                self.dropped += 1
+            self._backlog.append(self.summary())
+            self.windows += 1
+        for i in range(len(self._n)):
+            self._n[i] = 0
+            self._sum[i] = 0
+        self.samples = 0
+        self.gaps = 0
+        self._t0 = ticks_ms()
+
+    def pending(self):
+        return len(self._backlog)
+
+    async def flush(self, client):
+        # Publishes queued summaries in order; client may be None or
+        # disconnected.
+        if not self._backlog or client is None or not client.isconnected():
+            return 0
+        backlog = self._backlog
+        self._backlog = []
+        try:
+            await client.publish_many([(self.topic, p) for p in backlog])
+        except Exception:
+            self._backlog = (backlog + self._backlog)[-self.max_backlog:]
+            raise
+        self.messages += len(backlog)
+        return len(backlog)
@@ -0,0 +1,309 @@
+# Non-blocking MQTT 3.1.1 client on asyncio streams.
+#
+# Replaces umqtt.simple in the event loop: a reader task parses incoming
+# packets and calls the umqtt-style callback(topic, msg), a writer task
+# drains the outgoing queue and sends PINGREQ when nothing has been heard
+# from the broker for half the keepalive. QoS 0 publishes get no reply, so
+# only an unanswered PINGREQ counts as a dead link. No call ever blocks the
+# loop on a socket read.
+#
+# QoS 0 publish and QoS 0/1 subscribe only, which is all the bridge uses.
+#
+# Every write goes through one lock: the writer task, publish(),
+# publish_many() and subscribe() run from different tasks, and a
+# uasyncio stream takes a single drain() at a time.
+
+import log
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from compat import ticks_ms, ticks_diff
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+SUBSCRIBE = 0x82
+SUBACK = 0x90
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+
+class MQTTException(Exception):
+    pass
+
+
+def _varlen(n):
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return out
+
+
+def _str(s):
+    if isinstance(s, str):
+        s = s.encode()
+    return len(s).to_bytes(2, 'big') + s
+
+
+def _packet(kind, body):
+    return bytes([kind]) + _varlen(len(body)) + body
+
+
+class MQTTClient:
+    """asyncio MQTT client with the umqtt.simple callback convention.
+
+        client = MQTTClient(CLIENT_ID, server, port, user, password, ssl=ctx)
+        client.set_callback(mqtt_callback)
+        await client.connect()
+        await client.subscribe(topic)
+        await client.publish(topic, msg)      # waits until written
+        client.publish_nowait(topic, msg)     # for sync callers
+        await client.wait_closed()            # returns when the link drops
+
+    publish_nowait() queues at most max_queue packets; beyond that the
+    packet is dropped and counted in dropped.
+    """
+
+    def __init__(self, client_id, server, port=1883, user=None, password=None,
+                 keepalive=60, ssl=None, max_queue=32):
+        self.client_id = client_id
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        self.keepalive = keepalive
+        self.ssl = ssl
+        self.max_queue = max_queue
+        self._cb = None
+        self._reader = None
+        self._writer = None
+        self._tasks = []
+        self._queue = []
+        self._wake = asyncio.Event()
+        self._closed = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._suback = {}
+        self._pid = 0
+        self._last_rx = 0
+        self._last_tx = 0
+        self._ping_at = None  # ticks of the unanswered PINGREQ, if any
+        self.connected = False
+        self.sent = 0
+        self.received = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.dropped = 0
+
+    def set_callback(self, f):
+        self._cb = f
+
+    def isconnected(self):
+        return self.connected
+
+    async def connect(self, clean_session=True, timeout=10):
+        # ssl is an SSLContext or a tls.TLSClient, which keeps its own stats.
+        tls = self.ssl if hasattr(self.ssl, 'established') else None
+        if tls is not None:
+            self._reader, self._writer = await tls.open_connection(self.server, self.port, timeout)
+        else:
+            if self.ssl is not None:
+                conn = asyncio.open_connection(self.server, self.port, ssl=self.ssl)
+            else:
+                conn = asyncio.open_connection(self.server, self.port)
+            self._reader, self._writer = await asyncio.wait_for(conn, timeout)
+
+        flags = 0x02 if clean_session else 0
+        payload = _str(self.client_id)
+        if self.user is not None:
+            flags |= 0x80
+            payload += _str(self.user)
+            if self.password is not None:
+                flags |= 0x40
+                payload += _str(self.password)
+        body = _str(b'MQTT') + bytes([4, flags]) + self.keepalive.to_bytes(2, 'big') + payload
+        await self._write(_packet(CONNECT, body))
+
+        kind, body = await asyncio.wait_for(self._read_packet(), timeout)
+        if kind != CONNACK or len(body) < 2 or body[1] != 0:
+            self._close_streams()
+            raise MQTTException(body[1] if len(body) > 1 else -1)
+        if tls is not None:
+            tls.established(self._writer)
+
+        self.connected = True
+        self._closed = asyncio.Event()
+        self._queue = []
+        self._last_rx = self._last_tx = ticks_ms()
+        self._ping_at = None
+        self._tasks = [asyncio.create_task(self._read_loop()), asyncio.create_task(self._write_loop())]
+        return False  # session present is never used with clean sessions
+
+    async def disconnect(self):
+        # Messages still queued go out before the DISCONNECT.
+        if self.connected:
+            pkts = self._queue
+            self._queue = []
+            try:
+                await self._write_many(pkts + [_packet(DISCONNECT, b'')])
+            except OSError:
+                pass
+        self._lost()
+
+    async def wait_closed(self):
+        await self._closed.wait()
+
+    def _next_pid(self):
+        self._pid = self._pid % 0xFFFF + 1
+        return self._pid
+
+    def _publish_packet(self, topic, msg, retain):
+        if isinstance(msg, str):
+            msg = msg.encode()
+        return _packet(PUBLISH | (1 if retain else 0), _str(topic) + msg)
+
+    def publish_nowait(self, topic, msg, retain=False):
+        if not self.connected or len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            return False
+        self._queue.append(self._publish_packet(topic, msg, retain))
+        self._wake.set()
+        return True
+
+    async def publish(self, topic, msg, retain=False):
+        if not self.connected:
+            raise MQTTException('not connected')
+        await self._write(self._publish_packet(topic, msg, retain))
+
+    async def publish_many(self, msgs, retain=False):
+        # Pipelined burst: all PUBLISH packets go out with a single drain,
+        # i.e. as few TLS records and radio wakeups as the stack allows.
+        if not self.connected:
+            raise MQTTException('not connected')
+        await self._write_many([self._publish_packet(t, m, retain) for t, m in msgs])
+
+    async def subscribe(self, topic, qos=0, timeout=10):
+        if not self.connected:
+            raise MQTTException('not connected')
+        pid = self._next_pid()
+        done = asyncio.Event()
+        self._suback[pid] = done
+        body = pid.to_bytes(2, 'big') + _str(topic) + bytes([qos])
+        try:
+            await self._write(_packet(SUBSCRIBE, body))
+            await asyncio.wait_for(done.wait(), timeout)
+        finally:
+            self._suback.pop(pid, None)
+
+    async def _write(self, pkt):
+        await self._write_many((pkt,))
+
+    async def _write_many(self, pkts):
+        async with self._lock:
+            writer = self._writer
+            if writer is None:
+                raise OSError(-1)  # lost while waiting for the lock
+            for pkt in pkts:
+                writer.write(pkt)
+            await writer.drain()
+        for pkt in pkts:
+            self._count_out(pkt)
+
+    def _count_out(self, pkt):
+        self._last_tx = ticks_ms()
+        self.bytes_out += len(pkt)
+        if pkt[0] & 0xF0 == PUBLISH:
+            self.sent += 1
+
+    async def _read_packet(self):
+        hdr = await self._reader.readexactly(1)
+        n = 0
+        shift = 0
+        while True:
+            b = (await self._reader.readexactly(1))[0]
+            n |= (b & 0x7F) << shift
+            if not b & 0x80:
+                break
+            shift += 7
+        body = await self._reader.readexactly(n) if n else b''
+        self._last_rx = ticks_ms()
+        self._ping_at = None  # any packet answers an outstanding ping
+        self.bytes_in += 2 + n
+        return hdr[0], body
+
+    async def _read_loop(self):
+        try:
+            while True:
+                kind, body = await self._read_packet()
+                t = kind & 0xF0
+                if t == PUBLISH:
+                    tlen = (body[0] << 8) | body[1]
+                    topic = body[2:2 + tlen]
+                    pos = 2 + tlen
+                    if kind & 0x06:
+                        pos += 2  # packet id of QoS>0 publishes, not acked
+                    self.received += 1
+                    if self._cb:
+                        self._cb(topic, body[pos:])
+                elif t == SUBACK:
+                    done = self._suback.get((body[0] << 8) | body[1])
+                    if done:
+                        done.set()
+        except Exception as e:
+            log.warning("MQTT reader stopped: %s", e)
+        self._lost()
+
+    async def _write_loop(self):
+        ping_ms = self.keepalive * 500  # ping after half the keepalive silent
+        try:
+            while True:
+                if not self._queue:
+                    self._wake.clear()
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), ping_ms / 1000)
+                    except asyncio.TimeoutError:
+                        pass
+                if self._queue:
+                    pkts = self._queue
+                    self._queue = []
+                    await self._write_many(pkts)
+                now = ticks_ms()
+                if self._ping_at is not None:
+                    if ticks_diff(now, self._ping_at) > self.keepalive * 1000:
+                        raise MQTTException('keepalive timeout')
+                elif (ticks_diff(now, self._last_rx) >= ping_ms
+                        or ticks_diff(now, self._last_tx) >= ping_ms):
+                    # Set before writing: the PINGRESP may arrive during the drain
+                    self._ping_at = now
+                    await self._write(_packet(PINGREQ, b''))
+        except Exception as e:
+            log.warning("MQTT writer stopped: %s", e)
+        self._lost()
+
+    def _close_streams(self):
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception:
+                pass
+        self._reader = self._writer = None
+
+    def _lost(self):
+        if not self.connected and self._writer is None:
+            return
+        self.connected = False
+        current = asyncio.current_task()
+        for t in self._tasks:
+            if t is not current:
+                t.cancel()
+        self._tasks = []
+        self._close_streams()
+        self._closed.set()
@@ -0,0 +1,162 @@
+# Streaming aggregation: frames from fake_ble are decoded by berger and
+# folded into aggregate.Aggregator at jittered intervals, with charge and
+# discharge phases. Checks the per-window min/mean/max against the samples,
+# the integrated charge and energy summed over all windows against an
+# exact reference, gap handling, that every product stays a MicroPython
+# small int, and that add() leaves no allocations behind. Reports the cost
+# of add() and the bytes per hour against publishing every frame as JSON.
+#   python bench/bench_aggregate.py
+
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+sys.path.insert(0, 'bench')
+
+import aggregate
+import berger
+import outbox
+from common import check
+from fake_ble import status_frame
+
+FRAMES = 3600
+WINDOW = 60  # frames per window
+SMALL_INT = 2 ** 30  # ESP32 MicroPython small int bound
+
+
+def frames(n, seed=7):
+    # (dt ms since the previous frame, frame): 1 s +- 20 %, 20 A charge
+    # for the first third, then about 12 A discharge
+    rnd = random.Random(seed)
+    cells = [3321, 3325, 3330, 3319]
+    for i in range(n):
+        cells = [c + rnd.choice((-1, 0, 1)) for c in cells]
+        current = 2000 + rnd.randrange(-50, 51) if i < n // 3 else -1230 + rnd.randrange(-300, 301)
+        temps = (215 + rnd.randrange(-3, 4), -15 + i // 600)
+        yield rnd.randrange(800, 1201), status_frame(cells=cells, temps=temps, pack=sum(cells) // 10,
+                                                     current=current, soc=80, capacity=9000)
+
+
+def run():
+    dec = berger.Decoder()
+    agg = aggregate.Aggregator('womo/batt1/stats', berger.MAX_TEMPS, max_backlog=FRAMES)
+    now = 0
+    ref_q = [0.0, 0.0]  # mAh in, out
+    ref_e = [0.0, 0.0]  # Wh in, out
+    prev = None
+    window = []
+    ok = True
+    summaries = []
+    for k, (dt, frame) in enumerate(frames(FRAMES)):
+        now += dt
+        dec.decode(frame)
+        if prev is not None:
+            v, i = prev
+            d = 0 if i > 0 else 1
+            ref_q[d] += abs(i) * dt / 3600000
+            ref_e[d] += v * abs(i) * dt / 3600000000000
+        prev = (dec.pack_mv, dec.current_ma)
+        agg.add(dec, now)
+        window.append((dec.pack_mv, dec.current_ma, max(dec.cells[:4]) - min(dec.cells[:4]), dec.temps[0]))
+        if (k + 1) % WINDOW == 0:
+            agg.close()
+            s = json.loads(agg._backlog[-1])
+            summaries.append(s)
+            for j, (key, scale) in enumerate((('voltage', 1000), ('current', 1000), ('spread_mv', 1), ('temp1', 10))):
+                col = [w[j] for w in window]
+                want = [min(col) / scale, round(sum(col) / len(col) / scale, 3), max(col) / scale]
+                ok = ok and s[key] == want and s['n'] == len(window)
+            window = []
+    got_q = [sum(s['mAh_in'] for s in summaries), sum(s['mAh_out'] for s in summaries)]
+    got_e = [sum(s['Wh_in'] for s in summaries), sum(s['Wh_out'] for s in summaries)]
+    return ok, summaries, ref_q, got_q, ref_e, got_e
+
+
+def gap():
+    # A 20 s gap counts once and integrates MAX_DT_MS
+    dec = berger.Decoder()
+    agg = aggregate.Aggregator('t')
+    dec.decode(status_frame(current=-1000))  # -10 A
+    agg.add(dec, 0)
+    agg.add(dec, 20000)
+    agg.close()
+    s = json.loads(agg._backlog[0])
+    return s['gaps'] == 1 and abs(s['mAh_out'] - 10000 * aggregate.MAX_DT_MS / 3600000) < 0.001
+
+
+def small_ints():
+    # Largest products and remainders for 60 V, 327 A, MAX_DT_MS
+    cv, ca, dt = 6000, 32767, aggregate.MAX_DT_MS
+    q = ca * dt + aggregate._MAH
+    e = (cv * ca + 500) // 1000 * dt + aggregate._MWH
+    return max(q, e, cv * ca) < SMALL_INT, max(q, e, cv * ca)
+
+
+def cost():
+    dec = berger.Decoder()
+    dec.decode(status_frame(cells=tuple(3300 + i for i in range(16)), temps=(215, 220, 225, 230)))
+    agg = aggregate.Aggregator('t')
+    for i in range(100):
+        agg.add(dec, i * 1000)
+    n = 20000
+    t0 = time.perf_counter()
+    for i in range(n):
+        agg.add(dec, 100000 + i * 1000)
+    us = (time.perf_counter() - t0) / n * 1e6
+    # Traced memory after n more frames; the first round replaces the
+    # attributes set before tracing started
+    tracemalloc.start()
+    for r in range(2):
+        for i in range(n):
+            agg.add(dec, (r + 2) * n * 1000 + i * 1000)
+        if r == 0:
+            before = tracemalloc.get_traced_memory()[0]
+    kept = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return us, kept
+
+
+def main():
+    ok, summaries, ref_q, got_q, ref_e, got_e = run()
+    print('window summary %d B: %s' % (len(json.dumps(summaries[-1], separators=(',', ':'))),
+                                        json.dumps(summaries[-1], separators=(',', ':'))))
+    results = [check('min/mean/max per window', ok, '%d windows' % len(summaries))]
+    err_q = max(abs(g - r) / r for g, r in zip(got_q, ref_q))
+    err_e = max(abs(g - r) / r for g, r in zip(got_e, ref_e))
+    results.append(check('charge summed over windows', err_q < 1e-5, 'in %.3f out %.3f mAh (exact %.3f %.3f)' % (
+        got_q[0], got_q[1], ref_q[0], ref_q[1])))
+    results.append(check('energy summed over windows', err_e < 1e-3, 'in %.4f out %.4f Wh (exact %.4f %.4f), %.3f %%' % (
+        got_e[0], got_e[1], ref_e[0], ref_e[1], err_e * 100)))
+    results.append(check('gap counted, MAX_DT_MS integrated', gap()))
+    fits, largest = small_ints()
+    results.append(check('products fit a small int', fits, 'largest %d < 2**30' % largest))
+    us, kept = cost()
+    results.append(check('add() keeps no allocations', kept <= 0, '%d bytes, %.1f us per frame (16 cells)' % (kept, us)))
+
+    # One frame per second for an hour: every frame as a JSON snapshot
+    # against one summary per minute
+    dec = berger.Decoder()
+    box = outbox.Outbox('womo/batt1')
+    raw = 0
+    for dt, frame in frames(FRAMES):
+        dec.decode(frame)
+        box.set('voltage', dec.pack_mv, 1000)
+        box.set('current', dec.current_ma, 1000)
+        box.set('soc', dec.soc)
+        box.set('capacity', dec.capacity_mah, 1000)
+        for i in range(dec.ncells):
+            box.set('cell%d' % (i + 1), dec.cells[i], 1000)
+        for i in range(dec.ntemps):
+            box.set('temp%d' % (i + 1), dec.temps[i], 10)
+        raw += len(box.snapshot())
+    stats = sum(len(json.dumps(s, separators=(',', ':'))) for s in summaries)
+    print('per hour: every frame %d kB in %d messages, summaries %d kB in %d (%.0fx less)' % (
+        raw // 1024, FRAMES, stats // 1024, len(summaries), raw / stats))
+    if not all(results):
+        sys.exit(1)
+
+main()
@@ -0,0 +1,122 @@
+# Runs amqtt.MQTTClient against the local broker stand-in: subscribe,
+# callback delivery, keepalive pings, loop responsiveness while idle and
+# publish throughput, that concurrent publishers never drain the stream
+# at the same time (a uasyncio stream allows one drain at a time), and
+# that a steady QoS 0 publisher still pings and keeps its session.
+#   python bench/bench_amqtt.py
+
+import asyncio
+import sys
+import time
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+sys.path.insert(0, 'bench')
+
+import amqtt
+from broker_stub import BrokerStub
+
+N = 5000
+
+
+async def main():
+    broker = await BrokerStub().start()
+    received = []
+    client = amqtt.MQTTClient('bench', '127.0.0.1', broker.port, keepalive=2)
+    client.set_callback(lambda topic, msg: received.append((topic, msg)))
+    await client.connect()
+    await client.subscribe('womo/ota')
+    await broker.inject('womo/ota', 'now')
+
+    # The loop must keep running while the client waits for packets.
+    ticks = 0
+    t_end = time.monotonic() + 2.5
+    while time.monotonic() < t_end:
+        await asyncio.sleep(0.01)
+        ticks += 1
+    ok = received == [(b'womo/ota', b'now')] and broker.pings >= 1 and ticks > 100
+
+    t0 = time.perf_counter()
+    for i in range(N):
+        await client.publish('womo/batt/voltage', str(13.3 + i % 10 / 100))
+    dt = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for i in range(N):
+        client.publish_nowait('womo/batt/voltage', str(13.3 + i % 10 / 100))
+        if i % 16 == 15:
+            await asyncio.sleep(0)
+    while client._queue:
+        await asyncio.sleep(0)
+    dt_nowait = time.perf_counter() - t0
+    await asyncio.sleep(0.1)
+
+    # Writer task, publish(), publish_many() and subscribe() at once over
+    # a slow link; a second drain while one is pending is an overlap.
+    writer = client._writer
+    drain = writer.drain
+    state = {'in': 0, 'overlaps': 0}
+
+    async def slow_drain():
+        state['overlaps'] += state['in']
+        state['in'] += 1
+        try:
+            await asyncio.sleep(0.002)
+            await drain()
+        finally:
+            state['in'] -= 1
+
+    writer.drain = slow_drain
+    p0 = len(broker.published)
+
+    async def burst(k):
+        for i in range(20):
+            if k == 0:
+                await client.publish('womo/c0', str(i))
+            elif k == 1:
+                await client.publish_many([('womo/c1', str(i)), ('womo/c1', str(i))])
+            else:
+                client.publish_nowait('womo/c2', str(i))
+                await asyncio.sleep(0.001)
+
+    await asyncio.gather(burst(0), burst(1), burst(2), client.subscribe('womo/debug'))
+    await asyncio.sleep(0.2)
+    writer.drain = drain
+    got = [(t, p.decode()) for _, t, p in broker.published[p0:]]
+    in_order = all([p for t, p in got if t == tp] == want for tp, want in (
+        ('womo/c0', [str(i) for i in range(20)]),
+        ('womo/c1', [str(i // 2) for i in range(40)]),
+        ('womo/c2', [str(i) for i in range(20)])))
+    concurrent_ok = state['overlaps'] == 0 and in_order and client.isconnected()
+    ok = ok and concurrent_ok
+
+    await client.disconnect()
+    ok = ok and len(broker.published) == N + N - client.dropped + 80
+
+    # QoS 0 publishes every 0.3 s keep the send side busy but get no
+    # reply; the client must still ping and must not time itself out.
+    pub = amqtt.MQTTClient('bench-pub', '127.0.0.1', broker.port, keepalive=2)
+    await pub.connect()
+    pings0 = broker.pings
+    t_end = time.monotonic() + 7
+    while time.monotonic() < t_end and pub.isconnected():
+        await pub.publish('womo/batt/voltage', '13.3')
+        await asyncio.sleep(0.3)
+    busy_pings = broker.pings - pings0
+    busy_ok = pub.isconnected() and busy_pings >= 3
+    ok = ok and busy_ok
+    await pub.disconnect()
+    await broker.stop()
+
+    print('callback delivery:  ', received)
+    print('pings while idle:   ', broker.pings)
+    print('loop ticks in 2.5 s:', ticks)
+    print('publish msgs/s:     ', int(N / dt))
+    print('publish_nowait msgs/s:', int(N / dt_nowait), 'dropped', client.dropped)
+    print('bytes out:          ', client.bytes_out)
+    print('concurrent writers: ', 'ok' if concurrent_ok else 'FAIL', '%d overlapping drains' % state['overlaps'])
+    print('busy publisher:     ', 'ok' if busy_ok else 'FAIL', '%d pings in 7 s' % busy_pings)
+    print('OK' if ok else 'FAIL')
+    if not ok:
+        sys.exit(1)
+
+asyncio.run(main())
@@ -0,0 +1,71 @@
+# Decoder throughput and heap use per frame.
+# Runs on CPython or the MicroPython unix port from the repo root:
+#   python bench/bench_berger.py     micropython bench/bench_berger.py
+
+import gc
+import sys
+import time
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+
+import berger
+
+N = 20000
+
+def sample_frame():
+    words = [1330, (-1234) & 0xFFFF, 87, 9000, 4, 3321, 3325, 3330, 3319, 2, 215, (-15) & 0xFFFF]
+    buf = bytearray(berger.MAX_FRAME)
+    n = berger.encode_frame(buf, berger.ADR_DEFAULT, berger.CMD_READ, berger.REG_STATUS, 2 * len(words), words)
+    return buf, n
+
+def ticks_ms():
+    if hasattr(time, 'ticks_ms'):
+        return time.ticks_ms()
+    return int(time.perf_counter() * 1000)
+
+def ticks_diff(a, b):
+    if hasattr(time, 'ticks_diff'):
+        return time.ticks_diff(a, b)
+    return a - b
+
+def run(decoder, mv, n, count):
+    for _ in range(count):
+        decoder.decode(mv, n)
+
+def measure_alloc(decoder, mv, n, count):
+    # MicroPython: heap delta with the collector off is exact.
+    if hasattr(gc, 'mem_alloc'):
+        gc.collect()
+        gc.disable()
+        before = gc.mem_alloc()
+        run(decoder, mv, n, count)
+        after = gc.mem_alloc()
+        gc.enable()
+        return (after - before) / count
+    import tracemalloc
+    tracemalloc.start()
+    run(decoder, mv, n, 10)
+    base = tracemalloc.get_traced_memory()[0]
+    run(decoder, mv, n, count)
+    cur = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (cur - base) / count
+
+def main():
+    buf, n = sample_frame()
+    mv = memoryview(buf)
+    decoder = berger.Decoder()
+    assert decoder.decode(mv, n) == berger.OK and decoder.has_status
+
+    run(decoder, mv, n, 100)
+    t0 = ticks_ms()
+    run(decoder, mv, n, N)
+    dt = ticks_diff(ticks_ms(), t0) or 1
+    per_frame = measure_alloc(decoder, mv, n, 1000)
+
+    print('frame bytes:      ', n)
+    print('frames/s:         ', int(N * 1000 / dt))
+    print('bytes alloc/frame:', per_frame)
+
+main()
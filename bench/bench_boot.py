@@ -0,0 +1,168 @@
+# Boot-to-first-frame and boot-to-first-publish for the old sequential
+# start (WiFi, blocking NTP, MQTT, then the BLE scan) against the boot
+# pipeline of main.py (BLE scan right away, WiFi/MQTT brought up by the
+# supervisor, a non-blocking SNTP query after the MQTT connect when the RTC
+# kept its time, or before it on a cold clock, with BLE running meanwhile).
+# WiFi association and NTP are simulated with fixed delays, the battery by
+# fake_ble and the broker by broker_stub.
+#   python bench/bench_boot.py
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+sys.path.insert(0, 'bench')
+
+asyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+
+import amqtt
+import bms
+import evq
+import gattcache
+import log
+import outbox
+import supervisor
+from broker_stub import BrokerStub
+from common import check
+from fake_ble import FakeBLE, FakePeripheral, SERVICE, CHAR, CCCD
+
+WIFI_S = 0.8  # association and DHCP
+NTP_S = 0.15  # SNTP round trip; ntptime.settime() blocks the loop for it
+WINDOW_MS = 200
+
+
+class Boot:
+    def __init__(self, tmp, broker, cold=False):
+        self.t0 = time.perf_counter()
+        self.synced = asyncio.Event()
+        if not cold:
+            self.synced.set()
+        self.marks = {}
+        self.broker = broker
+        self.wifi = False
+        self.client = None
+        peer = FakePeripheral(b'\x04\x7f\x0e\x00\x00\x01', frame_ms=100)
+        self.link = bms.BmsLink('batt1', peer.mac, 'womo/batt1')
+        self.link.telemetry = outbox.Outbox(self.link.topic, window_ms=WINDOW_MS)
+        self.central = bms.Central(FakeBLE([peer]), [self.link], evq.EventQueue(64),
+                                   gattcache.HandleCache(os.path.join(tmp, 'gatt.json')), (SERVICE, CHAR, CCCD))
+        self.central.on_frame = self.on_frame
+
+    def mark(self, name):
+        if name not in self.marks:
+            self.marks[name] = (time.perf_counter() - self.t0) * 1000
+
+    def on_frame(self, link):
+        self.mark('frame')
+        link.telemetry.set('voltage', link.decoder.pack_mv, 1000)
+
+    async def connect_wifi(self):
+        await asyncio.sleep(WIFI_S)
+        self.wifi = True
+        self.mark('wifi')
+        return True
+
+    def ntp(self):
+        time.sleep(NTP_S)
+
+    async def sntp(self):
+        await asyncio.sleep(NTP_S)
+        self.mark('ntp')
+        self.synced.set()
+
+    async def ntp_task(self):
+        if self.synced.is_set():
+            try:
+                await asyncio.wait_for(self.mqtt_link.up_event.wait(), 10)
+            except asyncio.TimeoutError:
+                pass
+        await self.sntp()
+
+    async def wifi_up(self):
+        asyncio.create_task(self.ntp_task())
+
+    async def connect_mqtt(self):
+        await self.synced.wait()
+        self.client = amqtt.MQTTClient('boot', '127.0.0.1', self.broker.port)
+        await self.client.connect(timeout=2)
+        self.mark('mqtt')
+        return True
+
+    def mqtt_up(self):
+        return self.client is not None and self.client.isconnected()
+
+    async def publish(self):
+        while True:
+            await asyncio.sleep_ms(WINDOW_MS)
+            if await self.link.telemetry.flush(self.client):
+                self.mark('publish')
+                return
+
+
+async def sequential(tmp, broker):
+    b = Boot(tmp, broker)
+    await b.connect_wifi()
+    b.ntp()
+    await b.connect_mqtt()
+    tasks = [asyncio.create_task(b.central.run()), asyncio.create_task(b.publish())]
+    b.central.start()
+    await tasks[1]
+    return b, tasks[:1]
+
+
+async def pipeline(tmp, broker, cold=False):
+    b = Boot(tmp, broker, cold)
+    tasks = [asyncio.create_task(b.central.run()), asyncio.create_task(b.publish())]
+    b.central.start()
+    sup = supervisor.Supervisor()
+    w = sup.add('wifi', b.connect_wifi, lambda: b.wifi, on_up=b.wifi_up)
+    b.mqtt_link = sup.add('mqtt', b.connect_mqtt, b.mqtt_up, depends=w)
+    sup.start()
+    await tasks[1]
+    sup.stop()
+    return b, tasks[:1]
+
+
+async def cold_pipeline(tmp, broker):
+    return await pipeline(tmp, broker, cold=True)
+
+
+async def run(name, boot):
+    tmp = tempfile.mkdtemp()
+    broker = await BrokerStub().start()
+    try:
+        b, tasks = await boot(tmp, broker)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if b.client is not None:
+            await b.client.disconnect()
+        m = b.marks
+        print('%-12s first frame %5.0f ms  first publish %5.0f ms  (wifi %4.0f, mqtt %4.0f)' % (
+            name, m['frame'], m['publish'], m['wifi'], m['mqtt']))
+        return m
+    finally:
+        await broker.stop()
+        shutil.rmtree(tmp)
+
+
+def main():
+    log.configure(log.WARNING)
+    seq = asyncio.run(run('sequential', sequential))
+    pipe = asyncio.run(run('pipeline', pipeline))
+    cold = asyncio.run(run('cold clock', cold_pipeline))
+    ok = [
+        check('boot pipeline', pipe['frame'] < seq['frame'] / 4 and pipe['publish'] < seq['publish'] - NTP_S * 500),
+        check('cold clock: BLE during NTP', cold['frame'] < seq['frame'] / 4),
+        check('cold clock: MQTT after NTP', cold['mqtt'] >= cold['ntp'] >= cold['wifi'] + NTP_S * 1000,
+              'ntp %.0f ms, mqtt %.0f ms' % (cold['ntp'], cold['mqtt'])),
+    ]
+    if not all(ok):
+        sys.exit(1)
+
+main()
@@ -0,0 +1,114 @@
+# Connection parameter profiles: bms.Central against fake_ble peripherals
+# that send one notification per connection interval, so the interval
+# shows up in how long a frame takes to arrive.
+#
+#   fixed      backend without gap_update_params (MicroPython), first
+#              connect: discovery and streaming stay on the fast profile
+#   adaptive   backend with gap_update_params: fast for discovery,
+#              relaxed once notifications stream
+#   refused    the peripheral answers every request with its own
+#              parameters: a few requests, then the link is kept
+#   cached     MicroPython again, handles cached by an earlier connect:
+#              connects on the relaxed profile right away
+#
+# Per scenario: connection updates, notifications and frames per profile,
+# the mean ms from a frame's first to its last notification, and the
+# connection events per second the central wakes for (power).
+#   python bench/bench_connparams.py
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+sys.path.insert(0, 'bench')
+
+asyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+
+import bms
+import evq
+import gattcache
+import log
+import metrics
+from common import check
+from fake_ble import FakeBLE, FakePeripheral, SERVICE, CHAR, CCCD
+
+BATTERIES = 3
+FRAME_MS = 500
+RUN_S = 4.0
+
+
+async def simulate(cache_path, update_params=True, accept_params=True):
+    peers = [FakePeripheral(bytes([4, 0x7f, 0x0e, 0, 0, i + 1]), frame_ms=FRAME_MS) for i in range(BATTERIES)]
+    for p in peers:
+        p.accept_params = accept_params
+    ble = FakeBLE(peers, conn_events=True, update_params=update_params)
+    links = [bms.BmsLink('batt%d' % (i + 1), p.mac, 'womo/batt%d' % (i + 1)) for i, p in enumerate(peers)]
+    central = bms.Central(ble, links, evq.EventQueue(64), gattcache.HandleCache(cache_path),
+                          (SERVICE, CHAR, CCCD), BATTERIES, rescan_ms=200, poll_request=None)
+    for i in range(3):
+        central.frame_span_ms[i] = metrics.Histogram(metrics.MS_BUCKETS)
+    tasks = [asyncio.create_task(central.run()), asyncio.create_task(central.schedule())]
+    central.start()
+    await asyncio.sleep(RUN_S)
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for p in peers:
+        ble.disconnect_peer(p)
+    await asyncio.sleep(0.05)
+    return {
+        'profiles': central.profile_stats(),
+        'span_ms': {bms.PROFILE_NAMES[i]: central.frame_span_ms[i].summary()[1] for i in range(3)
+                    if central.frame_span_ms[i].count},
+        'final': [bms.PROFILE_NAMES[link.profile] for link in links],
+        'events_s': round(sum(1000 / (p.interval * 1.25) for p in peers), 1),
+        'frames': sum(link.decoder.frames for link in links),
+        'disconnects': sum(link.disconnects for link in links),
+        'requests': [p.param_requests for p in peers],
+    }
+
+
+def main():
+    log.configure(log.WARNING, 64, False)
+    tmp = tempfile.mkdtemp()
+    try:
+        runs = {}
+        cache = os.path.join(tmp, 'fixed.json')
+        runs['fixed'] = asyncio.run(simulate(cache, update_params=False))
+        runs['cached'] = asyncio.run(simulate(cache, update_params=False))
+        runs['adaptive'] = asyncio.run(simulate(os.path.join(tmp, 'adaptive.json')))
+        runs['refused'] = asyncio.run(simulate(os.path.join(tmp, 'refused.json'), accept_params=False))
+    finally:
+        shutil.rmtree(tmp)
+
+    for name in ('fixed', 'adaptive', 'refused', 'cached'):
+        r = runs[name]
+        print('%-9s final %-24s updates/notifications/frames %s, first->last notification %s ms, '
+              '%.1f connection events/s, requests %s' % (
+                  name, ','.join(r['final']), r['profiles'], r['span_ms'], r['events_s'], r['requests']))
+
+    expected = BATTERIES * (RUN_S * 1000 // FRAME_MS - 2)
+    fixed, adaptive, refused, cached = runs['fixed'], runs['adaptive'], runs['refused'], runs['cached']
+    ok = [
+        check('no link dropped', all(r['disconnects'] == 0 for r in runs.values())),
+        check('frames keep flowing', all(r['frames'] >= expected for r in runs.values()), '>= %d each' % expected),
+        check('fixed: fast throughout', set(fixed['final']) == {'fast'} and list(fixed['profiles']) == ['fast']),
+        check('adaptive: relaxed while streaming', set(adaptive['final']) == {'relaxed'}
+              and adaptive['profiles']['relaxed'][2] > adaptive['profiles'].get('fast', [0, 0, 0])[2]),
+        check('adaptive: fewer connection events', adaptive['events_s'] < fixed['events_s'] / 4,
+              '%.1f vs %.1f per s' % (adaptive['events_s'], fixed['events_s'])),
+        check('relaxed frames take longer', adaptive['span_ms']['relaxed'] > fixed['span_ms']['fast'],
+              '%d vs %d ms' % (adaptive['span_ms']['relaxed'], fixed['span_ms']['fast'])),
+        check('refused: bounded requests, kept', max(refused['requests']) <= bms.MAX_PARAM_REQUESTS
+              and set(refused['final']) == {'other'}, 'requests %s' % refused['requests']),
+        check('cached: connects relaxed', set(cached['final']) == {'relaxed'}
+              and 'fast' not in cached['profiles']),
+    ]
+    if not all(ok):
+        sys.exit(1)
+
+main()
@@ -0,0 +1,123 @@
+# Duty-cycled mode on the host: every simulated wake imports main.py
+# fresh through bench/harness.py (as after a deep sleep reset) and runs its
+# duty_cycle_async() against fake BMS peripherals until it deep-sleeps;
+# the working directory (gattcache, flash logs) and RTC memory carry over.
+# Every FLUSH_EVERY cycles main.py replays the stored records to the
+# broker. Reports wake-to-first-frame with and without cached GATT
+# handles, checks that the RTC state and every stored frame survive the
+# cycles and that the status request follows POLL_INTERVAL_MS (none at
+# 0), that wakes without a flush load none of the network modules, and
+# estimates mean supply current for typical ESP32 phase durations
+# against the always-on firmware.
+#   python bench/bench_dutycycle.py
+
+import asyncio
+import json
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+sys.path.insert(0, 'bench')
+
+import harness  # first: installs the time extensions and bench/sim
+import dutycycle
+import log
+import machine
+
+BATTERIES = 2
+FRAMES = 3
+FLUSH_EVERY = 4
+CYCLES = 8
+PERIOD_S = 300
+SPEED = 10
+NET_MODULES = ('amqtt', 'tls', 'outbox', 'packed', 'aggregate', 'supervisor', 'metrics')
+
+
+async def wake(tmp, poll_ms=0):
+    for name in NET_MODULES:
+        sys.modules.pop(name, None)
+    fw = harness.Firmware(batteries=BATTERIES, speed=SPEED, workdir=tmp, config={
+        'DUTY_CYCLE_S': PERIOD_S, 'DUTY_FRAMES': FRAMES, 'DUTY_FLUSH_EVERY': FLUSH_EVERY,
+        'POLL_INTERVAL_MS': poll_ms})
+    await fw.start()
+    while fw.exit is None and time_ms(fw) < fw.main.DUTY_WAKE_MS + 10000:
+        await asyncio.sleep(0.01)
+    main = fw.main
+    published = list(fw.broker.published)
+    r = {
+        'exit': fw.exit,
+        'stored': sum(len(t) for t in fw.frames.values()),
+        'first_ms': int((min(t[0] for t in fw.frames.values()) - fw.t0) * 1000) if fw.frames else None,
+        'hits': main.gatt_cache.hits,
+        'polls': sum(p.polls for p in fw.peers),
+        'awake_ms': time_ms(fw),
+        'replayed': sum(len(json.loads(m)) for _, tp, m in published if tp.endswith('/history')),
+        'reports': [json.loads(m) for _, tp, m in published if tp == main.debug_topic and b'"cycles"' in m],
+        'net': [name for name in NET_MODULES if name in sys.modules],
+    }
+    await fw.stop()
+    return r
+
+
+def time_ms(fw):
+    return int((time.monotonic() - fw.t0) * 1000)
+
+
+async def simulate():
+    tmp = tempfile.mkdtemp()
+    try:
+        machine._rtc_memory[0] = b''
+        reports = []
+        stored = replayed = 0
+        ok = True
+        for n in range(CYCLES):
+            r = await wake(tmp)
+            stored += r['stored']
+            replayed += r['replayed']
+            reports += r['reports']
+            dc = dutycycle.DutyCycle(PERIOD_S, FLUSH_EVERY)  # what the next wake loads
+            print('cycle %d  first frame %4s ms  awake %4d ms  cache hits %d  polls %d%s' % (
+                dc.cycle - 1, r['first_ms'], r['awake_ms'], r['hits'], r['polls'],
+                '  flushed %d records, loaded %s' % (r['replayed'], ' '.join(r['net'])) if r['replayed']
+                else '  loaded %s' % (' '.join(r['net']) or 'no network modules')))
+            ok = ok and dc.cycle == n + 2 and r['exit'].startswith('machine.deepsleep') and r['polls'] == 0
+            ok = ok and (n == 0 or r['hits'] >= BATTERIES)
+            ok = ok and (r['net'] == [] if not r['replayed'] else 'amqtt' in r['net'])
+        print('stored %d, replayed %d' % (stored, replayed))
+        print('report', reports[-1])
+        ok = ok and stored == replayed and reports[-1]['cycles'] == FLUSH_EVERY and len(reports) == CYCLES // FLUSH_EVERY
+        r = await wake(tmp, poll_ms=200)
+        polled = 0 < r['polls'] <= BATTERIES * (r['awake_ms'] // 200 + 1)
+        print('POLL_INTERVAL_MS 200: %d polls in %d ms %s' % (r['polls'], r['awake_ms'], 'ok' if polled else 'FAIL'))
+        return ok and polled
+    finally:
+        shutil.rmtree(tmp)
+
+
+def estimate(period_s, flush_every, boot_ms=900, ble_ms=2500, net_ms=6000):
+    # Mean current of the duty cycle for assumed phase durations
+    dc = dutycycle.DutyCycle(period_s, flush_every)
+    dc.cycles = flush_every
+    dc.totals = [boot_ms * flush_every, ble_ms * flush_every, net_ms]
+    dc.sleep_ms = period_s * 1000 * flush_every - sum(dc.totals)
+    return dc.estimate()
+
+
+def main():
+    log.configure(log.WARNING)
+    ok = asyncio.run(simulate())
+    c = dutycycle.CURRENTS_MA
+    always = (c["ble"] + c["net"]) / 2
+    print('always on (WiFi + BLE)      %6.1f mA  %6.0f mAh/day' % (always, always * 24))
+    for period_s in (60, 300, 900):
+        mah, mwh, ma = estimate(period_s, 12)
+        print('every %3d s, flush 1 in 12  %6.2f mA  %6.1f mAh/day  %.3f mAh/cycle (%.0fx less)' % (
+            period_s, ma, ma * 24, mah, always / ma))
+    print('duty cycle', 'ok' if ok else 'FAIL')
+    if not ok:
+        sys.exit(1)
+
+main()
@@ -0,0 +1,179 @@
+# End-to-end: the unmodified main.py under bench/harness.py, with every
+# battery replaying the FFF6 notification trace in bench/traces/.
+#
+#   steady   2 batteries, trace at 10x: frames/s, publish latency
+#            percentiles (frame decoded -> broker received) and whether
+#            the firmware's own heap stays flat
+#   load     4 batteries, trace at 50x: frames/s against frames offered
+#   faults   WiFi outage, broker dropping the session, a battery out of
+#            range: supervisor recovery times and the telemetry gap
+#   legacy   ota-mqtt.py connects and publishes through the stand-ins
+#
+# Heap is tracemalloc on CPython, for comparing runs. --json writes the
+# results; --baseline compares against such a file and fails when
+# frames/s fell or latency, gaps or heap grew by more than --tolerance.
+#   python bench/bench_e2e.py [--json out.json] [--baseline base.json] [--tolerance 0.5]
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness
+from common import check
+
+WINDOW_MS = harness.BROKER['PUBLISH_WINDOW_MS']
+
+
+async def steady():
+    fw = harness.Firmware(batteries=2, speed=10)
+    await fw.start()
+    try:
+        await fw.run(2)
+        heap0 = harness.firmware_heap()
+        await fw.run(6)
+        r = fw.report()
+        r['heap_growth'] = r['firmware_heap'] - heap0
+        return r
+    finally:
+        await fw.stop()
+
+
+async def load():
+    fw = harness.Firmware(batteries=4, speed=50)
+    await fw.start()
+    try:
+        await fw.run(1)
+        f0 = sum(link.decoder.frames for link in fw.main.links)
+        s0 = sum(p.sent_frames for p in fw.peers)
+        await fw.run(4)
+        r = fw.report()
+        r['frames_s'] = round((r['frames'] - f0) / 4, 1)
+        r['offered_s'] = round((sum(p.sent_frames for p in fw.peers) - s0) / 4, 1)
+        return r
+    finally:
+        await fw.stop()
+
+
+async def faults():
+    fw = harness.Firmware(batteries=2, speed=10)
+    await fw.start()
+    try:
+        await fw.run(3)
+        fw.wifi_drop(1000)
+        await fw.run(6)
+        fw.broker_drop()
+        await fw.run(4)
+        fw.ble_drop(0, 1000)
+        await fw.run(5)
+        return fw.report()
+    finally:
+        await fw.stop()
+
+
+async def legacy():
+    # ota-mqtt.py blocks on its sockets, so it runs in a thread while the
+    # broker keeps serving from the loop
+    broker = await harness.BrokerStub().start()
+    try:
+        config = dict(harness.BROKER, MQTT_PORT=broker.port)
+        harness._module('BROKER', config)
+        harness._module('WIFI_CONFIG', harness.WIFI_CONFIG)
+        harness.network.reset({harness.WIFI_CONFIG['SSID']: harness.WIFI_CONFIG['PASSWORD']})
+        harness.ubluetooth.reset()
+
+        def run():
+            mod = harness.import_entry('ota-mqtt.py')
+            ok = mod.connect_to_wifi(mod.wifi_ssid, mod.wifi_password) and mod.connect_mqtt()
+            if ok:
+                mod.publish_to_mqtt(mod.mqtt_topic, 'hello')
+                mod.mqtt_client.disconnect()
+            return ok
+
+        ok = await asyncio.to_thread(run)
+        await asyncio.sleep(0.1)
+        return {'connected': ok, 'published': [(t, p.decode()) for _, t, p in broker.published]}
+    finally:
+        await broker.stop()
+
+
+def flatten(results):
+    # The figures --baseline compares, as {name: (value, higher_is_worse)}
+    out = {}
+    for name in ('steady', 'load', 'faults'):
+        r = results[name]
+        out[name + '.frames_s'] = (r['frames_s'], False)
+        out[name + '.heap_peak'] = (r['heap_peak'], True)
+    out['steady.latency_p95_ms'] = (results['steady']['latency_ms'][1], True)
+    for kind, ms in results['faults']['gaps_ms']:
+        out['faults.gap_%s_ms' % kind] = (ms, True)
+    return out
+
+
+def compare(results, baseline, tolerance):
+    ok = True
+    base = flatten(baseline)
+    for name, (value, worse_up) in sorted(flatten(results).items()):
+        if name not in base or base[name][0] is None:
+            continue
+        ref = base[name][0]
+        if value is None:
+            bad = True
+        elif worse_up:
+            bad = value > ref * (1 + tolerance)
+        else:
+            bad = value < ref * (1 - tolerance)
+        if bad:
+            print('regression %-26s %s (baseline %s)' % (name, value, ref))
+            ok = False
+    return ok
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--json')
+    ap.add_argument('--baseline')
+    ap.add_argument('--tolerance', type=float, default=0.5)
+    args = ap.parse_args()
+
+    results = {}
+    for name, scenario in (('steady', steady), ('load', load), ('faults', faults), ('legacy', legacy)):
+        results[name] = asyncio.run(scenario())
+
+    s = results['steady']
+    print('steady   %5.1f frames/s, %d publishes, latency p50/p95/p99/max %s ms, heap peak %d, firmware %d (+%d)' % (
+        s['frames_s'], s['publishes'], '/'.join(map(str, s['latency_ms'])), s['heap_peak'], s['firmware_heap'],
+        s['heap_growth']))
+    ld = results['load']
+    print('load     %5.1f frames/s of %.1f offered, %d decode errors, heap peak %d' % (
+        ld['frames_s'], ld['offered_s'], ld['decode_errors'], ld['heap_peak']))
+    f = results['faults']
+    print('faults   recover %s ms, BLE link %s ms, telemetry gap %s' % (
+        f['recover_ms'], f['ble_recover_ms'][0], ', '.join('%s %s ms' % g for g in f['gaps_ms'])))
+    lg = results['legacy']
+    print('legacy   ota-mqtt.py connected=%s published=%s' % (lg['connected'], lg['published']))
+
+    ok = [
+        check('steady: no decode errors', s['decode_errors'] == 0 and s['exit'] is None),
+        check('steady: p95 latency', s['latency_ms'][1] <= WINDOW_MS + 100, '<= %d ms' % (WINDOW_MS + 100)),
+        check('steady: firmware heap flat', s['heap_growth'] < 16 * 1024, '%+d bytes' % s['heap_growth']),
+        check('load: frames keep up', ld['frames_s'] >= 0.9 * ld['offered_s'] and ld['decode_errors'] == 0),
+        check('faults: all links recovered', all(ms is not None for _, ms in f['gaps_ms'])
+              and all(v is not None for v in f['recover_ms'].values())),
+        check('faults: gaps', all(ms is not None and ms < 5000 for _, ms in f['gaps_ms']), '< 5000 ms'),
+        check('legacy entry point', lg['connected'] and ('womo', 'hello') in lg['published']),
+    ]
+    if args.baseline:
+        with open(args.baseline) as fh:
+            ok.append(check('baseline', compare(results, json.load(fh), args.tolerance),
+                            '%s, tolerance %d%%' % (args.baseline, args.tolerance * 100)))
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(results, fh, indent=1)
+    if not all(ok):
+        sys.exit(1)
+
+main()
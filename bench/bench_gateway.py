@@ -0,0 +1,143 @@
+# Linux gateway at scale: gateway.Gateway with fake_ble adapters (10
+# connections each, every battery visible on every adapter) and
+# broker_stub, at 1, 10 and 50 batteries sending a status frame every
+# FRAME_MS; 50 batteries once more with decoding in a process pool.
+# Reports the time until every battery streams, frames/s decoded against
+# offered, event loop lag, CPU of the gateway process and telemetry
+# publishes per window; checks that every battery is connected, keeps up
+# and reaches the broker, and that pool decoding loads the decoder exactly
+# like decoding inline.
+#   python bench/bench_gateway.py
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+sys.path.insert(0, 'bench')
+
+import berger
+import gateway
+import log
+from broker_stub import BrokerStub
+from common import check
+from fake_ble import FakeBLE, FakePeripheral, status_frame
+from harness import percentiles
+
+FRAME_MS = 100
+PER_ADAPTER = 10
+RUN_S = 5.0
+WINDOW_MS = 1000
+
+
+async def lag_probe(samples, period_ms=10):
+    # Extra ms the loop took to come back to a 10 ms sleep
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(period_ms / 1000)
+        samples.append((time.perf_counter() - t0) * 1000 - period_ms)
+
+
+async def simulate(n, workers=0):
+    tmp = tempfile.mkdtemp()
+    broker = await BrokerStub().start()
+    peers = [FakePeripheral(bytes([4, 0x7f, 0x0e, 0, i >> 8, i & 0xff]), frame_ms=FRAME_MS) for i in range(n)]
+    adapters = {'hci%d' % k: PER_ADAPTER for k in range((n + PER_ADAPTER - 1) // PER_ADAPTER)}
+    config = {
+        'broker': {'host': '127.0.0.1', 'port': broker.port},
+        'adapters': adapters,
+        'batteries': [['batt%d' % (i + 1), p.mac.hex()] for i, p in enumerate(peers)],
+        'publish_window_ms': WINDOW_MS,
+        'publish_rules': {},
+        'stats_window_s': 2,
+        'poll_interval_ms': 0,
+        'metrics_interval_s': 0,
+        'decode_workers': workers,
+    }
+    gw = gateway.Gateway(config, lambda adapter: FakeBLE(peers, max_connections=PER_ADAPTER),
+                         os.path.join(tmp, 'gatt.json'))
+    lag = []
+    probe = asyncio.create_task(lag_probe(lag))
+    try:
+        t0 = time.monotonic()
+        gw.start()
+        while sum(1 for link in gw.links if link.decoder.frames) < n and time.monotonic() - t0 < 15:
+            await asyncio.sleep(0.01)
+        connect_s = time.monotonic() - t0
+        await asyncio.sleep(0.5)
+        del lag[:]
+        f0 = sum(link.decoder.frames for link in gw.links)
+        s0 = sum(p.sent_frames for p in peers)
+        p0 = len(broker.published)
+        w0 = time.monotonic()
+        c0 = time.process_time()
+        await asyncio.sleep(RUN_S)
+        wall = time.monotonic() - w0
+        cpu = time.process_time() - c0
+        topics = set(link.topic for link in gw.links)
+        published = broker.published[p0:]
+        return {
+            'connected': sum(1 for link in gw.links if link.decoder.frames),
+            'connect_s': connect_s,
+            'frames_s': (sum(link.decoder.frames for link in gw.links) - f0) / wall,
+            'offered_s': (sum(p.sent_frames for p in peers) - s0) / wall,
+            'errors': sum(link.decoder.errors for link in gw.links),
+            'lag_ms': percentiles(lag, (50, 95)),
+            'cpu': cpu / wall,
+            'per_window': sum(1 for _, tp, _ in published if tp in topics) / (wall * 1000 / WINDOW_MS),
+            'reached': len(set(tp for _, tp, _ in broker.published if tp in topics)),
+            'stats': sum(1 for _, tp, _ in broker.published if tp.endswith('/stats')),
+            'batches': gw.pool.batches if gw.pool else 0,
+        }
+    finally:
+        probe.cancel()
+        await gw.stop()
+        await broker.stop()
+        shutil.rmtree(tmp)
+
+
+def same_as_inline():
+    # decode_batch() in this process, loaded by _load(), against decode()
+    frames = [status_frame(i, cells=(3300 + i, 3310, 3320, 3330, 3340), temps=(215, -15, 230), current=-i * 10)
+              for i in range(8)] + [b':0150000E~']
+    ref = berger.Decoder()
+    dec = berger.Decoder()
+    for frame, result in zip(frames, gateway.decode_batch(frames)):
+        rc = ref.decode(frame)
+        if gateway._load(dec, result) != rc:
+            return False
+        for k in ('has_status', 'pack_mv', 'current_ma', 'soc', 'capacity_mah', 'ncells', 'ntemps', 'frames', 'errors'):
+            if getattr(dec, k) != getattr(ref, k):
+                return False
+        if list(dec.cells[:dec.ncells]) != list(ref.cells[:ref.ncells]) or \
+                list(dec.temps[:dec.ntemps]) != list(ref.temps[:ref.ntemps]):
+            return False
+    return True
+
+
+def main():
+    log.configure(log.WARNING, 64, False)
+    results = []
+    runs = [(1, 0), (10, 0), (50, 0), (50, 2)]
+    print('%-14s %9s %9s %9s %11s %6s %10s' % ('devices', 'connect', 'frames/s', 'offered', 'lag p50/95', 'cpu',
+                                                'pub/window'))
+    for n, workers in runs:
+        r = asyncio.run(simulate(n, workers))
+        name = '%d%s' % (n, ' pool=%d' % workers if workers else '')
+        print('%-14s %8.2fs %9.1f %9.1f %5.1f/%-5.1f %5.0f%% %10.1f' % (
+            name, r['connect_s'], r['frames_s'], r['offered_s'], r['lag_ms'][0], r['lag_ms'][1], r['cpu'] * 100,
+            r['per_window']))
+        results.append(check('%s: all streaming' % name, r['connected'] == n and r['reached'] == n,
+                             '%d/%d connected, %d on the broker' % (r['connected'], n, r['reached'])))
+        results.append(check('%s: keeps up' % name, r['frames_s'] >= 0.9 * r['offered_s'] and r['errors'] == 0,
+                             '%d decode errors' % r['errors']))
+        results.append(check('%s: stats windows' % name, r['stats'] >= n, '%d summaries' % r['stats']))
+    results.append(check('pool decode matches inline', same_as_inline()))
+    if not all(results):
+        sys.exit(1)
+
+main()
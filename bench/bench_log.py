@@ -0,0 +1,80 @@
+# Scan-event throughput of bms.Central.irq at a busy site (40 foreign
+# advertisers plus the battery) with logging off, on into the ring only,
+# and on with console echo, against the old per-result prints of ble_irq.
+# Console output goes to /dev/null, so UART time is not even counted.
+#   python bench/bench_log.py
+
+import os
+import sys
+import time
+from binascii import hexlify
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+sys.path.insert(0, 'bench')
+
+import bms
+import evq
+import log
+from common import NoCache
+from fake_ble import FakeBLE, SERVICE, CHAR, CCCD
+
+N = 20000
+TARGET = b'\x04\x7f\x0e\x9e\xd1\x64'
+ADV = memoryview(b'\x02\x01\x06\x0b\x09BT-Battery')
+
+
+def results():
+    out = []
+    for i in range(40):
+        out.append((0, memoryview(bytes([0xc0, 1, 2, 3, 4, i])), 0, -70 - i % 20, ADV))
+    out.append((0, memoryview(TARGET), 0, -60, ADV))
+    return out
+
+
+def legacy_irq(event, data):
+    # What the original ble_irq did for every scan result.
+    if event == 5:
+        addr_type, addr, adv_type, rssi, adv_data = data
+        print(f"Scan result: addr_type={addr_type}, addr={hexlify(bytes(addr))}, rssi={rssi}")
+        print(f"adv_data={hexlify(bytes(adv_data))}")
+        if bytes(addr) == TARGET:
+            print(f"Target found: {hexlify(bytes(addr))}")
+
+
+def run(irq, scans):
+    t0 = time.perf_counter()
+    k = len(scans)
+    for i in range(N):
+        irq(5, scans[i % k])
+    return N / (time.perf_counter() - t0)
+
+
+def main():
+    scans = results()
+    events = evq.EventQueue(N + 1)
+    link = bms.BmsLink('batt1', TARGET, 'womo/batt1')
+    central = bms.Central(FakeBLE([]), [link], events, NoCache(), (SERVICE, CHAR, CCCD))
+    devnull = open(os.devnull, 'w')
+    stdout = sys.stdout
+    rates = {}
+    try:
+        sys.stdout = devnull
+        rates['legacy prints'] = run(legacy_irq, scans)
+        log.configure(log.INFO, 64, True)
+        rates['log off'] = run(central.irq, scans)
+        log.configure(log.DEBUG, 64, False)
+        rates['log on, ring only'] = run(central.irq, scans)
+        log.configure(log.DEBUG, 64, True)
+        rates['log on, echo'] = run(central.irq, scans)
+    finally:
+        sys.stdout = stdout
+        log.configure()
+    for name, r in rates.items():
+        print('%-20s %9.0f scan events/s' % (name, r))
+    ok = rates['log off'] > 1.5 * rates['legacy prints'] and len(log.dump()) == 0
+    print('ring keeps last %d lines' % len(log._ring), 'ok' if ok else 'FAIL')
+    if not ok:
+        sys.exit(1)
+
+main()
@@ -0,0 +1,107 @@
+# Cost of the metrics hooks: raw Histogram/Counter operations, and the
+# BLE notify path (IRQ, reassembly, queue, decode) with the IRQ, decode
+# and latency histograms attached versus detached. The notify path runs
+# RUNS times each way, interleaved; the difference of the medians per hook
+# call must stay within HOOK_COST Histogram.observe() calls as measured on
+# the same host, so neither noise nor a slow host fails it.
+#   python bench/bench_metrics.py
+
+import sys
+import time
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+sys.path.insert(0, 'bench')
+
+import bms
+import evq
+import metrics
+from common import NoCache
+from fake_ble import FakeBLE, status_frame, SERVICE, CHAR, CCCD, H_CHAR_VALUE
+
+N = 200000
+FRAMES = 5000
+RUNS = 7
+HOOK_COST = 3  # budget per hook call, in Histogram.observe() calls
+
+
+def per_op(fn, n):
+    t0 = time.perf_counter()
+    fn(n)
+    return (time.perf_counter() - t0) / n * 1e9
+
+
+def bare(n):
+    x = 0
+    for i in range(n):
+        x += 1
+
+
+def observe(n):
+    h = metrics.Histogram(metrics.US_BUCKETS)
+    for i in range(n):
+        h.observe(i & 1023)
+
+
+def inc(n):
+    c = metrics.Counter()
+    for i in range(n):
+        c.inc()
+
+
+def notify_path(hooks):
+    m = metrics.Metrics()
+    events = evq.EventQueue(64)
+    link = bms.BmsLink('batt1', b'\x04\x7f\x0e\x00\x00\x01', 'womo/batt1')
+    central = bms.Central(FakeBLE([]), [link], events, NoCache(), (SERVICE, CHAR, CCCD))
+    if hooks:
+        events.irq_hist = m.histogram('irq_us')
+        central.decode_us = m.histogram('decode_us')
+        central.frame_latency_us = m.histogram('frame_latency_us')
+    link.conn = 0
+    link.state = bms.STREAMING
+    link.char_handle = H_CHAR_VALUE
+    central._by_conn[0] = link
+    frame = status_frame()
+    chunks = [memoryview(frame[i:i + 20]) for i in range(0, len(frame), 20)]
+    t0 = time.perf_counter()
+    for _ in range(FRAMES):
+        for c in chunks:
+            central.irq(18, (0, H_CHAR_VALUE, c))
+        event = events.get()
+        while event >= 0:
+            central.handle(event)
+            events.release()
+            event = events.get()
+    dt = (time.perf_counter() - t0) / FRAMES * 1e6
+    assert link.decoder.frames == FRAMES
+    return dt, m, len(chunks) + 2  # hooks per frame: one per IRQ, decode, latency
+
+
+def median(values):
+    v = sorted(values)
+    return v[len(v) // 2]
+
+
+def main():
+    base = per_op(bare, N)
+    observe_ns = median([per_op(observe, N) - base for _ in range(3)])
+    print('Histogram.observe  %6.0f ns/op (loop overhead %.0f ns)' % (observe_ns, base))
+    print('Counter.inc        %6.0f ns/op' % (per_op(inc, N) - base))
+    offs, ons = [], []
+    for _ in range(RUNS):
+        offs.append(notify_path(False)[0])
+        dt, m, hooks = notify_path(True)
+        ons.append(dt)
+    off, on = median(offs), median(ons)
+    per_hook = (on - off) * 1000 / hooks
+    print('notify path off    %6.1f us/frame (median of %d)' % (off, RUNS))
+    print('notify path on     %6.1f us/frame (+%.1f%%, %.0f ns per hook, %d hooks/frame)' % (
+        on, (on - off) / off * 100, per_hook, hooks))
+    print('snapshot', m.snapshot())
+    ok = per_hook < HOOK_COST * observe_ns
+    print('overhead', 'ok' if ok else 'FAIL', '< %.0f ns per hook' % (HOOK_COST * observe_ns))
+    if not ok:
+        sys.exit(1)
+
+main()
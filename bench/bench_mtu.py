@@ -0,0 +1,123 @@
+# ATT MTU: bms.Central against fake_ble peripherals that allow MTU 247 and
+# send one notification per connection event, with and without the MTU
+# exchange (Central(mtu=0) is the central before it). Frames are full
+# 16-cell, 4-temperature status frames (118 bytes).
+#
+#   notify   frames/s, notification IRQs per frame and ms from a frame's
+#            first to its last notification
+#   read     peripherals without notify, polled by reads: at MTU 23 a
+#            read returns 22 bytes of the frame, at 247 all of it; also
+#            one that sets the notify flag but has no CCCD descriptor
+#
+# Also checks the effective MTU every link logs and the rxbuf sizing.
+#   python bench/bench_mtu.py
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+sys.path.insert(0, 'bench')
+
+asyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+
+import berger
+import bms
+import evq
+import gattcache
+import log
+import metrics
+from common import check
+from fake_ble import FakeBLE, FakePeripheral, SERVICE, CHAR, CCCD, status_frame
+
+BATTERIES = 3
+FRAME_MS = 100
+POLL_MS = 250
+RUN_S = 4.0
+FRAME = status_frame(cells=tuple(3300 + i for i in range(16)), temps=(215, 220, 225, 230))
+
+
+async def poller(central):
+    while True:
+        await asyncio.sleep(POLL_MS / 1000)
+        central.poll()
+
+
+async def simulate(mtu, notify=True, cccd=True):
+    tmp = tempfile.mkdtemp()
+    try:
+        peers = [FakePeripheral(bytes([4, 0x7f, 0x0e, 0, 0, i + 1]), frame_ms=FRAME_MS, mtu=247, frames=[FRAME])
+                 for i in range(BATTERIES)]
+        for p in peers:
+            p.notify_supported = notify
+            p.has_cccd = cccd
+        ble = FakeBLE(peers, conn_events=True)
+        links = [bms.BmsLink('batt%d' % (i + 1), p.mac, 'womo/batt%d' % (i + 1)) for i, p in enumerate(peers)]
+        central = bms.Central(ble, links, evq.EventQueue(64), gattcache.HandleCache(os.path.join(tmp, 'g.json')),
+                              (SERVICE, CHAR, CCCD), BATTERIES, rescan_ms=200, mtu=mtu)
+        span = metrics.Histogram(metrics.MS_BUCKETS)
+        central.frame_span_ms = [span, span, span]
+        tasks = [asyncio.create_task(central.run()), asyncio.create_task(central.schedule())]
+        if not notify or not cccd:
+            tasks.append(asyncio.create_task(poller(central)))
+        central.start()
+        await asyncio.sleep(1.0)
+        f0 = sum(link.decoder.frames for link in links)
+        n0 = central.irq_events[18] + central.irq_events[15]
+        await asyncio.sleep(RUN_S)
+        frames = sum(link.decoder.frames for link in links) - f0
+        irqs = central.irq_events[18] + central.irq_events[15] - n0
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return {
+            'mtu': [link.mtu for link in links],
+            'frames_s': frames / RUN_S,
+            'irqs_frame': irqs / frames if frames else None,
+            'span_ms': span.summary()[1],
+            'truncated': sum(link.truncated_reads for link in links),
+            'errors': sum(link.decoder.errors for link in links),
+            'rxbuf': ble.config('rxbuf'),
+        }
+    finally:
+        shutil.rmtree(tmp)
+
+
+def main():
+    log.configure(log.WARNING, 64, False)
+    print('frame %d bytes (berger.MAX_FRAME %d)' % (len(FRAME), berger.MAX_FRAME))
+    runs = {}
+    for name, mtu, notify, cccd in (('notify, no exchange', 0, True, True),
+                                    ('notify, MTU exchange', bms.MTU, True, True),
+                                    ('read, no exchange', 0, False, True),
+                                    ('read, MTU exchange', bms.MTU, False, True),
+                                    ('read, no CCCD', bms.MTU, True, False)):
+        r = runs[name] = asyncio.run(simulate(mtu, notify, cccd))
+        print('%-21s MTU %s: %5.1f frames/s, %s IRQs/frame, first->last notification %d ms, '
+              '%d truncated reads, rxbuf %d' % (
+                  name, r['mtu'], r['frames_s'], r['irqs_frame'] and round(r['irqs_frame'], 1), r['span_ms'],
+                  r['truncated'], r['rxbuf']))
+    before, after = runs['notify, no exchange'], runs['notify, MTU exchange']
+    rd0, rd1 = runs['read, no exchange'], runs['read, MTU exchange']
+    nocccd = runs['read, no CCCD']
+    chunks = (len(FRAME) + 19) // 20
+    ok = [
+        check('MTU negotiated on every link', after['mtu'] == [bms.MTU] * BATTERIES and before['mtu'] == [23] * 3),
+        check('notify: one IRQ per frame', after['irqs_frame'] < 1.1 and before['irqs_frame'] >= chunks - 0.5,
+              '%.1f -> %.1f' % (before['irqs_frame'], after['irqs_frame'])),
+        check('notify: frames/s', after['frames_s'] >= 3 * before['frames_s'],
+              '%.1f -> %.1f' % (before['frames_s'], after['frames_s'])),
+        check('read: whole frame per read', rd0['frames_s'] == 0 and rd0['truncated'] > 0
+              and rd1['frames_s'] > 0 and rd1['truncated'] == 0, '%.1f frames/s' % rd1['frames_s']),
+        check('read: notify flag without CCCD', nocccd['frames_s'] > 0, '%.1f frames/s' % nocccd['frames_s']),
+        check('no decode errors', all(r['errors'] == 0 for r in runs.values())),
+        check('rxbuf sized from the MTU', after['rxbuf'] >= BATTERIES * bms.RXBUF_EVENTS * bms.MTU,
+              '%d bytes' % after['rxbuf']),
+    ]
+    if not all(ok):
+        sys.exit(1)
+
+main()
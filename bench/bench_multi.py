@@ -0,0 +1,82 @@
+# Multi-battery simulation: bms.Central against fake BMS peripherals.
+# Checks that every battery gets connected within the controller limit,
+# that frames are shared fairly and that a dropped link is re-established,
+# and reports aggregate frame throughput.
+#   python bench/bench_multi.py
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+sys.path.insert(0, 'bench')
+
+# MicroPython's uasyncio extension used by the modules under test
+asyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+
+import bms
+import evq
+import gattcache
+from fake_ble import FakeBLE, FakePeripheral, SERVICE, CHAR, CCCD
+
+RUN_S = 3.0
+
+
+async def simulate(n_devices, max_connections, frame_ms=20, drop_after_s=None, bind=False):
+    tmp = tempfile.mkdtemp()
+    try:
+        peers = [FakePeripheral(bytes([4, 0x7f, 0x0e, 0, 0, i + 1]), frame_ms=frame_ms) for i in range(n_devices)]
+        ble = FakeBLE(peers, max_connections=max_connections)
+        links = [bms.BmsLink('batt%d' % (i + 1), None if bind else p.mac, 'womo/batt%d' % (i + 1))
+                 for i, p in enumerate(peers)]
+        cache = gattcache.HandleCache(os.path.join(tmp, 'gatt.json'))
+        central = bms.Central(ble, links, evq.EventQueue(64), cache, (SERVICE, CHAR, CCCD),
+                              max_connections, rescan_ms=200)
+        tasks = [asyncio.create_task(central.run()), asyncio.create_task(central.schedule())]
+        central.start()
+        if drop_after_s:
+            await asyncio.sleep(drop_after_s)
+            ble.disconnect_peer(peers[0])
+            await asyncio.sleep(RUN_S - drop_after_s)
+        else:
+            await asyncio.sleep(RUN_S)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return ble, links, central
+    finally:
+        shutil.rmtree(tmp)
+
+
+def report(name, links, expect_connected):
+    frames = [l.decoder.frames for l in links]
+    errors = sum(l.decoder.errors for l in links)
+    active = [f for f in frames if f]
+    fairness = min(active) / max(active) if active else 0
+    ok = len(active) == expect_connected and errors == 0 and fairness > 0.8
+    print('%-22s frames/link=%s agg frames/s=%d fairness=%.2f errors=%d %s' % (
+        name, frames, sum(frames) / RUN_S, fairness, errors, 'ok' if ok else 'FAIL'))
+    return ok
+
+
+async def main():
+    results = []
+    for n in (1, 2, 3):
+        ble, links, central = await simulate(n, 3)
+        results.append(report('%d batteries' % n, links, n))
+    ble, links, central = await simulate(4, 3)
+    results.append(report('4 batteries, limit 3', links, 3))
+    ble, links, central = await simulate(2, 3, drop_after_s=1.0)
+    ok = links[0].connects == 2 and links[0].handles_cached and links[0].first_frame_ms['cached'] is not None
+    print('%-22s connects=%d first_frame_ms=%s %s' % (
+        'link drop + cache', links[0].connects, links[0].first_frame_ms, 'ok' if ok else 'FAIL'))
+    results.append(ok)
+    ble, links, central = await simulate(2, 3, bind=True)
+    results.append(report('2 unbound (by FFF0)', links, 2) and {l.mac for l in links} == {p.mac for p in ble.peripherals})
+    if not all(results):
+        sys.exit(1)
+
+asyncio.run(main())
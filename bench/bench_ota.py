@@ -0,0 +1,300 @@
+# Streaming OTA against a local HTTP server stand-in: a corrupted and a
+# truncated download must leave the running files untouched; a good one
+# is staged while a fake battery keeps streaming frames, switched in on
+# trial, confirmed, and a later unconfirmed version is rolled back after
+# MAX_TRIAL_BOOTS boots. A switch interrupted by a reset is completed by
+# boot_check(). Delta updates fetch only changed files, a module switched
+# to .mpy replaces its .py (and gets it back on rollback), and the
+# manifest tool follows imports. Peak traced heap is compared for a small
+# and a large file.
+#   python bench/bench_ota.py
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+sys.path.insert(0, 'bench')
+
+asyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+
+import bms
+import evq
+import gattcache
+import log
+import otaupdate
+from common import check
+from fake_ble import FakeBLE, FakePeripheral, SERVICE, CHAR, CCCD
+from http_stub import HttpStub
+
+sys.path.insert(0, 'tools')
+import make_manifest
+
+
+def blob(version, size):
+    rnd = random.Random(version)
+    line = b'# version %d\n' % version
+    return line + bytes(32 + rnd.getrandbits(6) for _ in range(size - len(line)))
+
+
+def release(version, main_size=64 * 1024):
+    files = {'main.py': blob(version, main_size), 'berger.py': blob(version + 1000, 9000)}
+    if version > 90:
+        files['packed.py'] = blob(version + 2000, 3000)
+    manifest = {'version': version, 'files': [
+        {'path': p, 'size': len(b), 'sha256': hashlib.sha256(b).hexdigest()} for p, b in files.items()]}
+    served = {'/fw/' + p: b for p, b in files.items()}
+    served['/fw/manifest.json'] = json.dumps(manifest).encode()
+    return files, served
+
+
+def install(root, files, version):
+    for p, b in files.items():
+        with open(os.path.join(root, p), 'wb') as f:
+            f.write(b)
+    with open(os.path.join(root, 'version.json'), 'w') as f:
+        json.dump({'version': version}, f)
+
+
+def running(root, files):
+    # True if root holds exactly these application files
+    for p, b in files.items():
+        try:
+            with open(os.path.join(root, p), 'rb') as f:
+                if f.read() != b:
+                    return False
+        except OSError:
+            return False
+    return True
+
+
+def version(root):
+    with open(os.path.join(root, 'version.json')) as f:
+        return json.load(f)['version']
+
+
+def serve(files, version):
+    # Manifest from the tool, for files as {path: bytes}; .mpy under mpy/
+    src = tempfile.mkdtemp()
+    try:
+        for p, b in files.items():
+            with open(os.path.join(src, p), 'wb') as f:
+                f.write(b)
+        manifest = make_manifest.build(src, version, sorted(files))
+    finally:
+        shutil.rmtree(src)
+    served = {}
+    for p, b in files.items():
+        served['/fw/' + ('mpy/' + p if p.endswith('.mpy') else p)] = b
+    for e in manifest['files']:
+        if e['path'].endswith('.mpy'):
+            e['url'] = 'mpy/' + e['path']
+    served['/fw/manifest.json'] = json.dumps(manifest, separators=(',', ':')).encode()
+    return served
+
+
+async def update(root, served, truncate=None, rate=None, stats=None):
+    server = await HttpStub(served, rate=rate).start()
+    if truncate:
+        server.truncate.update(truncate)
+    try:
+        u = otaupdate.Updater('http://127.0.0.1:%d/fw/' % server.port, root=root)
+        ok = await u.update()
+        if stats is not None:
+            stats['requests'] = server.requests
+            stats['downloaded'] = u.downloaded
+        return ok
+    finally:
+        await server.stop()
+
+
+async def update_with_ble(root, served):
+    # Download at ~400 kB/s while a battery streams frames every 20 ms
+    tmp = tempfile.mkdtemp()
+    try:
+        peer = FakePeripheral(b'\x04\x7f\x0e\x00\x00\x01', frame_ms=20)
+        link = bms.BmsLink('batt1', peer.mac, 'womo/batt1')
+        central = bms.Central(FakeBLE([peer]), [link], evq.EventQueue(64),
+                              gattcache.HandleCache(os.path.join(tmp, 'gatt.json')), (SERVICE, CHAR, CCCD))
+        task = asyncio.create_task(central.run())
+        central.start()
+        await asyncio.sleep(0.2)
+        f0 = link.decoder.frames
+        t0 = time.perf_counter()
+        ok = await update(root, served, rate=400000)
+        dt = time.perf_counter() - t0
+        frames = link.decoder.frames - f0
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return ok, dt, frames
+    finally:
+        shutil.rmtree(tmp)
+
+
+def peak_heap(root, served):
+    # The server runs in a child process, so only the client is traced,
+    # and is paced so CPython's socket buffering does not dominate
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        async def serve():
+            server = await HttpStub(served, rate=2000000).start()
+            os.write(w, b'%d' % server.port)
+            await asyncio.sleep(30)
+        asyncio.run(serve())
+        os._exit(0)
+    port = int(os.read(r, 16))
+    try:
+        tracemalloc.start()
+        u = otaupdate.Updater('http://127.0.0.1:%d/fw/' % port, root=root)
+        ok = asyncio.run(u.update())
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        os.kill(pid, 9)
+        os.waitpid(pid, 0)
+    return ok, peak
+
+
+def main():
+    log.configure(log.WARNING)
+    root = tempfile.mkdtemp()
+    try:
+        v90, _ = release(90)
+        v91, served91 = release(91)
+        install(root, v90, 90)
+        results = []
+
+        bad = dict(served91)
+        body = bytearray(bad['/fw/main.py'])
+        body[30000] ^= 1
+        bad['/fw/main.py'] = bytes(body)
+        ok = asyncio.run(update(root, bad))
+        results.append(check('corrupted download', not ok and running(root, v90) and version(root) == 90))
+
+        ok = asyncio.run(update(root, served91, truncate={'/fw/main.py': 20000}))
+        results.append(check('truncated download', not ok and running(root, v90) and version(root) == 90))
+
+        ok, dt, frames = asyncio.run(update_with_ble(root, served91))
+        state = otaupdate._load_state(root)
+        results.append(check('update while BLE streams', ok and running(root, v91) and state['state'] == 'trial'
+                             and frames > 0, '%.2f s, %d frames decoded meanwhile' % (dt, frames)))
+
+        st = otaupdate.boot_check(root)
+        ok = st == 'trial' and otaupdate.confirm(root) and not os.path.exists(os.path.join(root, 'ota', 'old'))
+        results.append(check('boot on trial, confirm', ok and version(root) == 91))
+        results.append(check('no state once confirmed', not os.path.exists(os.path.join(root, 'ota', 'state'))
+                             and otaupdate.boot_check(root) is None))
+
+        ok = not asyncio.run(update(root, served91))
+        results.append(check('same version skipped', ok))
+
+        # A second 'now' while the first update downloads must not restage
+        v92, served92 = release(92)
+
+        async def twice():
+            return await asyncio.gather(update(root, served92, rate=400000), update(root, served92))
+
+        both = asyncio.run(twice())
+        results.append(check('concurrent update refused', both == [True, False] and running(root, v92), both))
+        ok = both[0]
+        states = [otaupdate.boot_check(root) for _ in range(otaupdate.MAX_TRIAL_BOOTS + 1)]
+        ok = ok and states[-1] == 'rolledback' and running(root, v91) and version(root) == 91
+        ok = ok and not os.path.exists(os.path.join(root, 'ota', 'state'))
+        results.append(check('unconfirmed version rolled back', ok, ' '.join(states)))
+
+        # Reset after the first file of the switch: boot_check() finishes it
+        v93, served93 = release(93)
+        u = otaupdate.Updater('http://unused/', root=root)
+        server = HttpStub(served93)
+
+        async def stage():
+            await server.start()
+            u.base_url = 'http://127.0.0.1:%d/fw/' % server.port
+            try:
+                m = json.loads(served93['/fw/manifest.json'])
+                return await u.stage(m, m['files'])
+            finally:
+                await server.stop()
+
+        ok = asyncio.run(stage())
+        paths = [p for p in v93] + ['version.json', 'manifest.json']
+        otaupdate._save_state(root, {'state': 'switching', 'version': 93, 'prev': 91, 'files': paths, 'boots': 0})
+        otaupdate._move(os.path.join(root, 'ota', 'new', paths[0]), os.path.join(root, paths[0]))
+        st = otaupdate.boot_check(root)
+        results.append(check('interrupted switch completed', ok and st == 'trial' and running(root, v93)
+                             and version(root) == 93))
+        otaupdate.confirm(root)
+
+        v94 = dict(v93)
+        v94['berger.py'] = blob(94, 9500)
+        stats = {}
+        ok = asyncio.run(update(root, serve(v94, 94), stats=stats))
+        ok = ok and stats['requests'] == ['/fw/manifest.json', '/fw/berger.py'] and running(root, v94)
+        results.append(check('delta: only changed files', ok, '%d of %d bytes downloaded' % (
+            stats['downloaded'], sum(len(b) for b in v94.values()))))
+        otaupdate.confirm(root)
+
+        v95 = dict(v94)
+        v95['packed.mpy'] = b'M\x06' + v95.pop('packed.py')[:1000]
+        ok = asyncio.run(update(root, serve(v95, 95)))
+        ok = ok and running(root, v95) and not os.path.exists(os.path.join(root, 'packed.py'))
+        states = [otaupdate.boot_check(root) for _ in range(otaupdate.MAX_TRIAL_BOOTS + 1)]
+        ok = ok and running(root, v94) and not os.path.exists(os.path.join(root, 'packed.mpy'))
+        results.append(check('.py -> .mpy, rolled back', ok and version(root) == 94))
+
+        # Manifests are spooled to flash, not read into one buffer
+        v96 = dict(v94)
+        for i in range(80):
+            v96['lib%02d.py' % i] = blob(9600 + i, 200)
+        served96 = serve(v96, 96)
+        size = len(served96['/fw/manifest.json'])
+        ok = asyncio.run(update(root, served96)) and running(root, v96) and otaupdate.confirm(root)
+        results.append(check('large manifest', ok, '%d bytes, %d files' % (size, len(v96))))
+        limit = otaupdate.MAX_MANIFEST
+        otaupdate.MAX_MANIFEST = size - 1
+        try:
+            asyncio.run(update(root, served96))
+            err = ''
+        except ValueError as e:
+            err = str(e)
+        finally:
+            otaupdate.MAX_MANIFEST = limit
+        results.append(check('oversized manifest refused', 'MAX_MANIFEST' in err, err))
+
+        src = tempfile.mkdtemp()
+        for name, text in (('main.py', 'import a\nfrom BROKER import MQTT_PW\n'),
+                           ('a.py', 'def f():\n    import b\n'), ('b.py', 'import json\nimport WIFI_CONFIG\n'),
+                           ('c.py', ''), ('BROKER.py', 'MQTT_PW = "secret"\n'), ('WIFI_CONFIG.py', 'SSID = "van"\n')):
+            with open(os.path.join(src, name), 'w') as f:
+                f.write(text)
+        found = make_manifest.firmware_files(src)
+        listed = [e['path'] for e in make_manifest.build(src, 1, ['main.py', 'BROKER.py'])['files']]
+        shutil.rmtree(src)
+        results.append(check('manifest tool follows imports', found == ['a.py', 'b.py', 'main.py'], found))
+        results.append(check('config never in the manifest', listed == ['main.py'], listed))
+
+        peaks = []
+        for n, size in enumerate((64 * 1024, 512 * 1024)):
+            files, served = release(100 + n, size)
+            ok, peak = peak_heap(root, served)
+            otaupdate.confirm(root)
+            peaks.append(peak)
+            print('  %4d kB main.py: peak traced heap %6d bytes%s' % (size // 1024, peak, '' if ok else ' FAIL'))
+        results.append(check('heap independent of file size', peaks[1] < peaks[0] + 16 * 1024))
+        if not all(results):
+            sys.exit(1)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+# Compares per-value publishing with the coalescing Outbox against the
+# local broker stand-in: messages and bytes on the wire for the same
+# stream of decoded frames, plus backlog behaviour during an outage and
+# deadband rules on an hour of simulated slowly drifting battery data
+# (messages in burst mode, bytes in JSON mode, whose snapshots only carry
+# the keys that changed).
+#   python bench/bench_outbox.py
+
+import asyncio
+import random
+import sys
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+sys.path.insert(0, 'bench')
+
+import amqtt
+import berger
+import outbox
+from broker_stub import BrokerStub
+
+FRAMES = 200  # 20 s of frames at 10 Hz, compressed in time
+FRAME_MS = 5
+WINDOW_MS = 100  # i.e. one publish per 20 frames
+
+CELLS = [3321, 3325, 3330, 3319]
+TEMPS = [215, -15]
+
+
+def frames():
+    dec = berger.Decoder()
+    buf = bytearray(berger.MAX_FRAME)
+    for i in range(FRAMES):
+        words = [1330 + i % 3, (-1234 - i) & 0xFFFF, 87, 9000, len(CELLS)] + CELLS + [len(TEMPS)] + [t & 0xFFFF for t in TEMPS]
+        n = berger.encode_frame(buf, 1, berger.CMD_READ, berger.REG_STATUS, 2 * len(words), words)
+        dec.decode(buf, n)
+        yield dec
+
+
+def record(box, dec):
+    box.set('voltage', dec.pack_mv, 1000)
+    box.set('current', dec.current_ma, 1000)
+    box.set('soc', dec.soc)
+    box.set('capacity', dec.capacity_mah, 1000)
+    for i in range(dec.ncells):
+        box.set('cell%d' % (i + 1), dec.cells[i], 1000)
+    for i in range(dec.ntemps):
+        box.set('temp%d' % (i + 1), dec.temps[i], 10)
+
+
+async def per_value(client):
+    for dec in frames():
+        await client.publish('womo/batt/voltage', str(dec.pack_mv / 1000))
+        await client.publish('womo/batt/current', str(dec.current_ma / 1000))
+        await client.publish('womo/batt/soc', str(dec.soc))
+        await client.publish('womo/batt/capacity', str(dec.capacity_mah / 1000))
+        for i in range(dec.ncells):
+            await client.publish('womo/batt/cell%d' % (i + 1), str(dec.cells[i] / 1000))
+        for i in range(dec.ntemps):
+            await client.publish('womo/batt/temp%d' % (i + 1), str(dec.temps[i] / 10))
+        await asyncio.sleep(FRAME_MS / 1000)
+
+
+def coalesced(mode):
+    async def run(client):
+        box = outbox.Outbox('womo/batt', mode, WINDOW_MS)
+        stop = False
+
+        async def flusher():
+            while not stop:
+                await asyncio.sleep(box.window_ms / 1000)
+                await box.flush(client)
+
+        task = asyncio.create_task(flusher())
+        for dec in frames():
+            record(box, dec)
+            await asyncio.sleep(FRAME_MS / 1000)
+        stop = True
+        await task
+        await box.flush(client)
+        return box
+    return run
+
+
+async def measure(name, run):
+    broker = await BrokerStub().start()
+    client = amqtt.MQTTClient('bench', '127.0.0.1', broker.port)
+    await client.connect()
+    loop = asyncio.get_running_loop()
+    t0 = loop.time()
+    box = await run(client)
+    dt = loop.time() - t0
+    await asyncio.sleep(0.05)
+    await client.disconnect()
+    await broker.stop()
+    extra = ' superseded=%d' % box.superseded if box else ''
+    print('%-10s msgs=%5d  msgs/s=%6d  bytes=%7d  bytes/frame=%6.1f%s' % (
+        name, len(broker.published), len(broker.published) / dt, client.bytes_out,
+        client.bytes_out / FRAMES, extra))
+
+
+async def outage():
+    # 10 windows offline with a backlog of 4: the oldest 6 are dropped,
+    # the remaining 4 go out in order as one burst on reconnect.
+    broker = await BrokerStub().start()
+    box = outbox.Outbox('womo/batt', outbox.MODE_JSON, WINDOW_MS, max_backlog=4)
+    for i, dec in enumerate(frames()):
+        if i >= 10:
+            break
+        record(box, dec)
+        await box.flush(None)
+    client = amqtt.MQTTClient('bench', '127.0.0.1', broker.port)
+    await client.connect()
+    sent = await box.flush(client)
+    await asyncio.sleep(0.05)
+    await client.disconnect()
+    await broker.stop()
+    ok = sent == 4 and box.dropped == 6 and len(broker.published) == 4
+    print('outage     backlog sent=%d dropped=%d %s' % (sent, box.dropped, 'ok' if ok else 'FAIL'))
+    return ok
+
+
+RULES = {
+    'voltage': (10, 60),
+    'current': (100, 60),
+    'soc': (0, 300),
+    'capacity': (100, 300),
+    'cell': (5, 300),
+    'temp': (5, 300),
+}
+
+
+class _Recorder:
+    # Client stand-in: records what would go on the wire with a timestamp.
+    def __init__(self, clock):
+        self.clock = clock
+        self.msgs = []
+        self.bytes = 0
+
+    def isconnected(self):
+        return True
+
+    async def publish_many(self, msgs):
+        for topic, payload in msgs:
+            self.msgs.append((self.clock[0], topic))
+            self.bytes += 4 + len(topic) + len(payload)
+
+
+async def deadband(mode, rules):
+    # One hour of frames every 2 s, flushed every 5 s, on a simulated clock.
+    clock = [0]
+    ticks = outbox.ticks_ms
+    outbox.ticks_ms = lambda: clock[0]
+    try:
+        rnd = random.Random(7)
+        box = outbox.Outbox('womo/batt', mode, 5000, rules=rules)
+        client = _Recorder(clock)
+        dec = berger.Decoder()
+        buf = bytearray(berger.MAX_FRAME)
+        mv, ma, cap = 13300.0, -1200.0, 90000.0
+        for t in range(0, 3600 * 1000, 2000):
+            clock[0] = t
+            ma = -1200 + rnd.gauss(0, 40) + (3000 if (t // 600000) % 2 else 0)  # load steps
+            cap += ma * 2 / 3600
+            mv = 13300 + ma * 0.02 + rnd.gauss(0, 3)
+            cells = [int(mv / 4) + rnd.randint(-2, 2) for _ in range(4)]
+            words = [int(mv) // 10, int(ma) // 10 & 0xFFFF, int(cap / 1000), int(cap) // 10, 4] + cells + [
+                2, 215 + t // 600000, 200]
+            n = berger.encode_frame(buf, 1, berger.CMD_READ, berger.REG_STATUS, 2 * len(words), words)
+            dec.decode(buf, n)
+            record(box, dec)
+            if t % 5000 < 2000:
+                clock[0] = t - t % 5000 + 5000
+                await box.flush(client)
+        gaps = {}
+        last = {}
+        for when, topic in client.msgs:
+            key = topic.rsplit('/', 1)[-1]
+            gaps[key] = max(gaps.get(key, 0), when - last.get(key, 0))
+            last[key] = when
+        return box, client, gaps
+    finally:
+        outbox.ticks_ms = ticks
+
+
+async def deadbands():
+    ok = True
+    base = None
+    for name, rules in (('every change', None), ('deadband', RULES)):
+        box, client, gaps = await deadband(outbox.MODE_BURST, rules)
+        if base is None:
+            base = client
+        stale_ok = all(gaps[k] <= (RULES.get(k.rstrip('0123456789'))[1] * 1000 + 5000) for k in gaps) if rules else True
+        print('burst %-13s msgs=%5d bytes=%7d suppressed=%5d max gap=%3d s %s' % (
+            name, len(client.msgs), client.bytes, box.suppressed, max(gaps.values()) // 1000,
+            'ok' if stale_ok else 'STALE'))
+        ok = ok and stale_ok
+    reduction = len(base.msgs) / len(client.msgs)
+    print('reduction %.1fx %s' % (reduction, 'ok' if reduction >= 10 else 'FAIL'))
+    # Any fresh key sends a JSON snapshot, but only with the fresh keys.
+    sizes = []
+    for name, rules in (('every change', None), ('deadband', RULES)):
+        box, client, gaps = await deadband(outbox.MODE_JSON, rules)
+        sizes.append(client.bytes)
+        print('json  %-13s msgs=%5d bytes=%7d' % (name, len(client.msgs), client.bytes))
+    json_reduction = sizes[0] / sizes[1]
+    print('json bytes reduction %.1fx %s' % (json_reduction, 'ok' if json_reduction >= 10 else 'FAIL'))
+    return ok and reduction >= 10 and json_reduction >= 10
+
+
+async def main():
+    await measure('per-value', lambda c: per_value(c))
+    await measure('json', coalesced(outbox.MODE_JSON))
+    await measure('burst', coalesced(outbox.MODE_BURST))
+    ok = await outage()
+    ok = await deadbands() and ok
+    if not ok:
+        sys.exit(1)
+
+asyncio.run(main())
@@ -0,0 +1,116 @@
+# Payload size and encode/decode speed of a full pack snapshot (header
+# values, all cell voltages and temperatures) as the str() of a dict (what
+# publish_to_mqtt did), the compact JSON Outbox snapshot and the packed
+# binary format, for a 4-cell and a 16-cell pack. Also checks that the
+# reference decoder returns what was encoded and that compat.unix_time()
+# moves a 2000-based time.time() (ESP32) to unix time.
+#   python bench/bench_packed.py
+
+import importlib
+import json
+import sys
+import time
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+sys.path.insert(0, 'bench')
+
+import berger
+import compat
+import outbox
+import packed
+
+N = 20000
+TS = 1760000000
+
+
+def decoder(ncells, ntemps):
+    words = [1330, (-1234) & 0xFFFF, 87, 9000, ncells] + [3300 + 7 * i for i in range(ncells)]
+    words += [ntemps] + [(215 - 60 * i) & 0xFFFF for i in range(ntemps)]
+    buf = bytearray(berger.MAX_FRAME)
+    n = berger.encode_frame(buf, 1, berger.CMD_READ, berger.REG_STATUS, 2 * len(words), words)
+    dec = berger.Decoder()
+    assert dec.decode(buf, n) == berger.OK
+    return dec
+
+
+def record(box, dec):
+    box.set('voltage', dec.pack_mv, 1000)
+    box.set('current', dec.current_ma, 1000)
+    box.set('soc', dec.soc)
+    box.set('capacity', dec.capacity_mah, 1000)
+    for i in range(dec.ncells):
+        box.set('cell%d' % (i + 1), dec.cells[i], 1000)
+    for i in range(dec.ntemps):
+        box.set('temp%d' % (i + 1), dec.temps[i], 10)
+
+
+def timed(fn):
+    t0 = time.perf_counter()
+    for _ in range(N):
+        out = fn()
+    return (time.perf_counter() - t0) / N * 1e6, out
+
+
+def run(ncells, ntemps):
+    dec = decoder(ncells, ntemps)
+    box = outbox.Outbox('womo/batt1')
+    record(box, dec)
+    packer = packed.Packer('womo/batt1/bin')
+    rows = []
+
+    enc, text = timed(lambda: str({k: box._value(k) for k in box._values}))
+    dt, _ = timed(lambda: eval(text))
+    rows.append(('str(dict)', len(text), enc, dt))
+
+    enc, text = timed(box.snapshot)
+    dt, values = timed(lambda: json.loads(text))
+    rows.append(('json', len(text), enc, dt))
+
+    enc, n = timed(lambda: packer.pack(dec, TS))
+    payload = bytes(packer.view[:n])
+    dt, got = timed(lambda: packed.decode(payload))
+    rows.append(('packed', n, enc, dt))
+
+    print('%d cells, %d temps' % (ncells, ntemps))
+    for name, size, enc, dt in rows:
+        print('  %-10s %4d bytes  encode %6.2f us  decode %6.2f us' % (name, size, enc, dt))
+    ok = n == packed.size(ncells, ntemps) and n * 4 < rows[1][1]
+    for k, v in values.items():
+        if k != 'ts' and abs(got[k] - v) > 1e-9:
+            ok = False
+            print('  mismatch', k, v, got[k])
+    ok = ok and got['ts'] == TS and got['seq'] == (N - 1) & 0xFFFF
+    try:
+        packed.decode(payload[:-1])
+        ok = False
+    except ValueError:
+        pass
+    return ok
+
+
+def epoch_2000():
+    # compat as imported on a port whose time.time() counts from 2000
+    gmtime, now = time.gmtime, time.time
+    time.gmtime = lambda t=None: (2000, 1, 1, 0, 0, 0, 5, 1)
+    time.time = lambda: TS - 946684800
+    try:
+        importlib.reload(compat)
+        ok = compat.unix_time() == TS
+    finally:
+        time.gmtime, time.time = gmtime, now
+        importlib.reload(compat)
+    ok = ok and abs(compat.unix_time() - time.time()) < 2
+    print('unix time on a 2000 epoch', 'ok' if ok else 'FAIL')
+    return ok
+
+
+def main():
+    ok = run(4, 2)
+    ok = run(16, 4) and ok
+    ok = epoch_2000() and ok
+    print('round trip', 'ok' if ok else 'FAIL')
+    if not ok:
+        sys.exit(1)
+
+main()
@@ -0,0 +1,93 @@
+# Replays recorded FFF6 fragment streams through berger.Assembler, checks
+# that every intact frame comes out and reports reassembly throughput.
+#   python bench/bench_reassembler.py     micropython bench/bench_reassembler.py
+
+import sys
+import time
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+
+import berger
+
+# Notification chunks as captured at the default 23-byte ATT MTU.
+RECORDED = [
+    b':01515000180532FB2E0057',
+    b'232800040CF90CFD0D020C',
+    b'F7000200D7FFF18D~',
+]
+
+def frame_bytes(pack_cv, soc):
+    words = [pack_cv, (-1234) & 0xFFFF, soc, 9000, 4, 3321, 3325, 3330, 3319, 2, 215, (-15) & 0xFFFF]
+    buf = bytearray(berger.MAX_FRAME)
+    n = berger.encode_frame(buf, berger.ADR_DEFAULT, berger.CMD_READ, berger.REG_STATUS, 2 * len(words), words)
+    return bytes(buf[:n])
+
+def chunks(data, sizes):
+    out = []
+    i = 0
+    k = 0
+    while i < len(data):
+        n = sizes[k % len(sizes)]
+        out.append(data[i:i + n])
+        i += n
+        k += 1
+    return out
+
+def replay(name, fragments, expect, **expect_counters):
+    asm = berger.Assembler()
+    dec = berger.Decoder()
+    good = []
+    for frag in fragments:
+        asm.feed(frag)
+        n = asm.pending()
+        while n:
+            if dec.decode(asm.frame(), n) == berger.OK:
+                good.append(dec.pack_mv)
+            asm.release()
+            n = asm.pending()
+    ok = good == expect
+    for key in expect_counters:
+        if getattr(asm, key) != expect_counters[key]:
+            ok = False
+    print('%-24s %s frames=%d dropped_bytes=%d resyncs=%d overflows=%d' % (
+        name, 'ok  ' if ok else 'FAIL', len(good), asm.dropped_bytes, asm.resyncs, asm.overflows))
+    return ok
+
+def main():
+    f1 = frame_bytes(1330, 87)
+    f2 = frame_bytes(1331, 86)
+    f3 = frame_bytes(1329, 86)
+    stream = f1 + f2 + f3
+    mv = [13300, 13310, 13290]
+    results = [
+        replay('recorded', RECORDED, [13300], dropped_bytes=0),
+        replay('one chunk', [stream], mv),
+        replay('20-byte chunks', chunks(stream, [20]), mv),
+        replay('1-byte chunks', chunks(stream, [1]), mv),
+        replay('uneven splits', chunks(stream, [1, 13, 2, 61, 7, 3]), mv),
+        replay('split at markers', [f1[:-1], f1[-1:] + f2[:1], f2[1:], f3], mv),
+        replay('leading garbage', [b'\x00\xffjunk' + f1, f2, f3], mv, dropped_bytes=6),
+        replay('garbage between', [f1, b'~~xx', f2, b'\r\n', f3], mv, dropped_bytes=6),
+        replay('dropped chunk', chunks(f1, [20])[:1] + chunks(f1, [20])[2:] + [f2, f3], mv[1:]),
+        replay('truncated frame', [f1[:30], f2, f3], mv[1:], resyncs=1, dropped_bytes=30),
+        replay('missing end marker', [f1[:-1] + b'x' * berger.MAX_FRAME, f2, f3], mv[1:], overflows=1),
+    ]
+
+    data = chunks(stream * 100, [20])
+    asm = berger.Assembler()
+    count = 0
+    t0 = time.ticks_ms() if hasattr(time, 'ticks_ms') else int(time.perf_counter() * 1000)
+    for _ in range(20):
+        for frag in data:
+            count += asm.feed(frag)
+            while asm.pending():
+                asm.release()
+    t1 = time.ticks_ms() if hasattr(time, 'ticks_ms') else int(time.perf_counter() * 1000)
+    dt = (time.ticks_diff(t1, t0) if hasattr(time, 'ticks_diff') else t1 - t0) or 1
+    print('reassembled frames/s:', int(count * 1000 / dt))
+    print('notifications/s:     ', int(20 * len(data) * 1000 / dt))
+    if not all(results):
+        sys.exit(1)
+
+main()
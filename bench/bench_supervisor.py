@@ -0,0 +1,153 @@
+# Supervisor recovery with injected failures: WiFi flaps, the broker
+# refuses connections and drops clients, a battery goes out of range, a
+# connect fails (rescanned at once, not after the connect timeout).
+# Checks the backoff bounds, that each link recovers on its own (BLE
+# while the broker is still down, MQTT not retried while WiFi is down)
+# and reports time-to-recover per link.
+#   python bench/bench_supervisor.py
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+sys.path.insert(0, 'bench')
+
+# MicroPython's uasyncio extension used by the modules under test
+asyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+
+import amqtt
+import bms
+import evq
+import gattcache
+import supervisor
+from broker_stub import BrokerStub
+from fake_ble import FakeBLE, FakePeripheral, SERVICE, CHAR, CCCD
+
+
+def check_backoff():
+    b = supervisor.Backoff(100, 1000)
+    ok = True
+    for i in range(8):
+        d = min(100 * 2 ** i, 1000)
+        v = b.next()
+        ok = ok and d // 2 <= v <= d
+    b.reset()
+    ok = ok and 50 <= b.next() <= 100
+    print('%-28s %s' % ('backoff bounds', 'ok' if ok else 'FAIL'))
+    return ok
+
+
+async def outage():
+    tmp = tempfile.mkdtemp()
+    broker = await BrokerStub().start()
+    wifi = {'up': True}
+    client = [None]
+
+    async def connect_wifi():
+        await asyncio.sleep(0.02)
+        return wifi['up']
+
+    async def connect_mqtt():
+        if client[0] is not None:
+            await client[0].disconnect()
+        client[0] = amqtt.MQTTClient('sup', '127.0.0.1', broker.port, keepalive=5)
+        try:
+            await client[0].connect(timeout=1)
+        except Exception:
+            return False
+        return True
+
+    def mqtt_up():
+        return wifi['up'] and client[0] is not None and client[0].isconnected()
+
+    peer = FakePeripheral(b'\x04\x7f\x0e\x00\x00\x01', frame_ms=20)
+    ble = FakeBLE([peer])
+    link = bms.BmsLink('batt1', peer.mac, 'womo/batt1')
+    central = bms.Central(ble, [link], evq.EventQueue(64), gattcache.HandleCache(os.path.join(tmp, 'gatt.json')),
+                          (SERVICE, CHAR, CCCD), scan_ms=300)
+
+    fast = dict(check_ms=20)
+    sup = supervisor.Supervisor()
+    w = sup.add('wifi', connect_wifi, lambda: wifi['up'], backoff=supervisor.Backoff(50, 400), **fast)
+    m = sup.add('mqtt', connect_mqtt, mqtt_up, depends=w, backoff=supervisor.Backoff(50, 400), **fast)
+    b = sup.add('ble', central.reconnect, central.up, backoff=supervisor.Backoff(50, 400), **fast)
+    consumer = asyncio.create_task(central.run())
+    central.start()
+    sup.start()
+    await asyncio.sleep(0.5)
+    ok = w.up and m.up and b.up
+    print('%-28s %s' % ('initial bring-up', 'ok' if ok else 'FAIL'))
+    results = [ok]
+
+    # Broker refuses and drops clients; the battery leaves range meanwhile.
+    broker.refuse = True
+    broker.drop_clients()
+    peer.hidden = True
+    ble.disconnect_peer(peer)
+    await asyncio.sleep(1.0)
+    failures = m.failures
+    peer.hidden = False
+    await asyncio.sleep(0.6)
+    ok = b.up and not m.up and failures >= 3 and link.recover_ms is not None
+    print('%-28s mqtt failures=%d ble recover_ms=%s %s' % (
+        'BLE recovers, broker down', failures, link.recover_ms, 'ok' if ok else 'FAIL'))
+    results.append(ok)
+    broker.refuse = False
+    await asyncio.sleep(0.6)
+    ok = m.up and m.recoveries == 1
+    print('%-28s recover_ms=%s %s' % ('MQTT recovers', m.last_recover_ms, 'ok' if ok else 'FAIL'))
+    results.append(ok)
+
+    # WiFi down: MQTT waits for it instead of counting failures (one
+    # attempt may race the WiFi check).
+    wifi['up'] = False
+    failures = m.failures
+    await asyncio.sleep(0.5)
+    waited = m.failures - failures <= 1 and not m.up
+    wifi['up'] = True
+    await asyncio.sleep(0.6)
+    ok = waited and w.up and m.up and w.recoveries == 1 and m.recoveries == 2
+    print('%-28s wifi recover_ms=%s mqtt recover_ms=%s %s' % (
+        'WiFi flap', w.last_recover_ms, m.last_recover_ms, 'ok' if ok else 'FAIL'))
+    results.append(ok)
+
+    print(sup.stats())
+    sup.stop()
+    consumer.cancel()
+    await client[0].disconnect()
+    await broker.stop()
+    shutil.rmtree(tmp)
+    return all(results)
+
+
+async def failed_connect():
+    # The controller reports two failed connects; no schedule() or
+    # supervisor runs, only the failure report can free the link.
+    tmp = tempfile.mkdtemp()
+    peer = FakePeripheral(b'\x04\x7f\x0e\x00\x00\x02', frame_ms=20)
+    peer.refuse_connects = 2
+    link = bms.BmsLink('batt2', peer.mac, 'womo/batt2')
+    central = bms.Central(FakeBLE([peer]), [link], evq.EventQueue(64),
+                          gattcache.HandleCache(os.path.join(tmp, 'gatt.json')), (SERVICE, CHAR, CCCD), scan_ms=300)
+    consumer = asyncio.create_task(central.run())
+    central.start()
+    await asyncio.sleep(1.0)
+    ok = peer.refuse_connects == 0 and link.conn is not None and link.decoder.frames > 0
+    print('%-28s frames=%d %s' % ('failed connect rescanned', link.decoder.frames, 'ok' if ok else 'FAIL'))
+    consumer.cancel()
+    shutil.rmtree(tmp)
+    return ok
+
+
+async def main():
+    ok = check_backoff()
+    ok = await outage() and ok
+    ok = await failed_connect() and ok
+    if not ok:
+        sys.exit(1)
+
+asyncio.run(main())
@@ -0,0 +1,126 @@
+# TLS reconnect cost against the broker stand-in with a throwaway CA.
+# Compares the old connect path (CA re-read and parsed on every connect,
+# a verified handshake on a raw socket that is thrown away, then the
+# client's own handshake) with tls.TLSClient (CA parsed once, one
+# handshake per connect), and checks session resumption on the blocking
+# wrap_socket() path used by umqtt (the stub is held to TLS 1.2 there, so
+# the session exists right after the handshake). heap_peak is only
+# measured on MicroPython (gc.mem_alloc).
+#   python bench/bench_tls.py
+
+import asyncio
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+sys.path.insert(0, 'bench')
+
+import amqtt
+import tls
+from broker_stub import BrokerStub
+
+N = 20
+
+
+def make_certs(d):
+    def run(*args):
+        subprocess.run(('openssl',) + args, check=True, capture_output=True)
+    ca_key, ca_crt = os.path.join(d, 'ca.key'), os.path.join(d, 'ca.crt')
+    key, csr, crt = os.path.join(d, 'srv.key'), os.path.join(d, 'srv.csr'), os.path.join(d, 'srv.crt')
+    ext = os.path.join(d, 'ext.cnf')
+    with open(ext, 'w') as f:
+        f.write('subjectAltName=DNS:localhost,IP:127.0.0.1\n')
+    run('req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+        '-keyout', ca_key, '-out', ca_crt, '-days', '1', '-subj', '/CN=bench-ca')
+    run('req', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+        '-keyout', key, '-out', csr, '-subj', '/CN=localhost')
+    run('x509', '-req', '-in', csr, '-CA', ca_crt, '-CAkey', ca_key, '-CAcreateserial',
+        '-out', crt, '-days', '1', '-extfile', ext)
+    return ca_crt, crt, key
+
+
+async def legacy_connect(ca_path, port):
+    # What connect_mqtt() used to do on every (re)connect.
+    with open(ca_path, 'rb') as f:
+        ca = f.read()
+    sock = socket.create_connection(('127.0.0.1', port))
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.load_verify_locations(cadata=ca.decode())
+    await asyncio.to_thread(lambda: ctx.wrap_socket(sock, server_hostname='localhost').close())
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.load_verify_locations(cadata=ca.decode())
+    client = amqtt.MQTTClient('bench', 'localhost', port, ssl=ctx)
+    await client.connect()
+    return client
+
+
+async def run(name, connect, broker):
+    accepts = broker.accepts
+    t0 = time.perf_counter()
+    for _ in range(N):
+        client = await connect()
+        await client.disconnect()
+    dt = (time.perf_counter() - t0) / N * 1000
+    handshakes = (broker.accepts - accepts) / N
+    print('%-10s %6.1f ms/connect  handshakes/connect=%.1f' % (name, dt, handshakes))
+    return dt, handshakes
+
+
+def blocking_connects(client, port, n):
+    # umqtt-style: plain socket, TLSClient.wrap_socket(), CONNECT/CONNACK.
+    for _ in range(n):
+        sock = socket.create_connection(('127.0.0.1', port))
+        s = client.wrap_socket(sock, server_hostname='localhost')
+        s.sendall(b'\x10\x0d\x00\x04MQTT\x04\x02\x00\x3c\x00\x01b')
+        s.recv(4)
+        s.sendall(b'\xe0\x00')
+        s.recv(16)  # EOF, after the session ticket
+        s.close()
+
+
+async def main():
+    d = tempfile.mkdtemp()
+    try:
+        ca, crt, key = make_certs(d)
+        server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_ctx.load_cert_chain(crt, key)
+        broker = await BrokerStub(ssl=server_ctx).start()
+
+        legacy_ms, legacy_hs = await run('legacy', lambda: legacy_connect(ca, broker.port), broker)
+        client_tls = tls.TLSClient(ca)
+        lazy = tls.ssl is None  # not before the first connect
+
+        async def cached():
+            client = amqtt.MQTTClient('bench', 'localhost', broker.port, ssl=client_tls)
+            await client.connect()
+            return client
+        cached_ms, cached_hs = await run('cached', cached, broker)
+        print(client_tls.stats())
+        lazy = lazy and tls.ssl is not None
+        print('ssl imported on first connect %s' % ('ok' if lazy else 'FAIL'))
+
+        await broker.stop()
+
+        server_ctx.maximum_version = ssl.TLSVersion.TLSv1_2
+        broker = await BrokerStub(ssl=server_ctx).start()
+        blocking = tls.TLSClient(ca)
+        await asyncio.to_thread(blocking_connects, blocking, broker.port, N)
+        print('blocking   ' + blocking.stats())
+        await broker.stop()
+
+        ok = (cached_hs == 1 and legacy_hs == 2 and client_tls.ca_loads == 1
+              and cached_ms < legacy_ms and blocking.resumed >= N - 1 and lazy)
+        print('speedup %.2fx %s' % (legacy_ms / cached_ms, 'ok' if ok else 'FAIL'))
+        if not ok:
+            sys.exit(1)
+    finally:
+        shutil.rmtree(d)
+
+asyncio.run(main())
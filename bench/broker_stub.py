@@ -0,0 +1,152 @@
+# Minimal in-process MQTT 3.1.1 broker for host runs (CPython asyncio).
+#
+# Accepts any CONNECT, answers SUBSCRIBE and PINGREQ, fans QoS 0 PUBLISH
+# out to matching subscribers and records everything it receives so
+# benchmarks can count messages and bytes on the wire.
+#
+#   broker = BrokerStub()
+#   await broker.start()            # broker.port is the bound port
+#   ...
+#   await broker.stop()
+
+import asyncio
+import time
+
+
+def _varlen(n):
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        out.append(b | 0x80 if n else b)
+        if not n:
+            return bytes(out)
+
+
+def topic_matches(pattern, topic):
+    p = pattern.split('/')
+    t = topic.split('/')
+    for i, part in enumerate(p):
+        if part == '#':
+            return True
+        if i >= len(t) or (part != '+' and part != t[i]):
+            return False
+    return len(p) == len(t)
+
+
+class BrokerStub:
+    def __init__(self, host='127.0.0.1', port=0, ssl=None):
+        self.host = host
+        self.port = port
+        self.ssl = ssl  # server SSLContext for TLS listeners
+        self.server = None
+        self.clients = []
+        self._handlers = set()
+        self.published = []  # (monotonic time, topic, payload)
+        self.accepts = 0  # TCP (and TLS) sessions, including refused ones
+        self.connects = 0
+        self.pings = 0
+        self.bytes_in = 0
+        self.packets_in = 0
+        # Set to make the next CONNECTs fail, e.g. to inject outages.
+        self.refuse = False
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._client, self.host, self.port, ssl=self.ssl)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        for _, w in list(self.clients):
+            w.close()
+        self.server.close()
+        if self._handlers:
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+        await self.server.wait_closed()
+
+    def drop_clients(self):
+        # Simulate a broker-side connection loss.
+        for _, w in list(self.clients):
+            w.close()
+
+    async def _read_packet(self, reader):
+        hdr = await reader.readexactly(1)
+        n = 0
+        shift = 0
+        while True:
+            b = (await reader.readexactly(1))[0]
+            n |= (b & 0x7F) << shift
+            if not b & 0x80:
+                break
+            shift += 7
+        body = await reader.readexactly(n) if n else b''
+        self.bytes_in += 2 + n
+        self.packets_in += 1
+        return hdr[0], body
+
+    async def _client(self, reader, writer):
+        subs = []
+        entry = (subs, writer)
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        self.accepts += 1
+        try:
+            kind, body = await self._read_packet(reader)
+            if kind != 0x10 or self.refuse:
+                writer.write(b'\x20\x02\x00\x05')
+                await writer.drain()
+                return
+            self.connects += 1
+            writer.write(b'\x20\x02\x00\x00')
+            await writer.drain()
+            self.clients.append(entry)
+            while True:
+                kind, body = await self._read_packet(reader)
+                t = kind & 0xF0
+                if t == 0x30:
+                    tlen = int.from_bytes(body[:2], 'big')
+                    topic = body[2:2 + tlen].decode()
+                    pos = 2 + tlen + (2 if kind & 0x06 else 0)
+                    payload = body[pos:]
+                    self.published.append((time.monotonic(), topic, payload))
+                    await self._fanout(kind, body)
+                elif t == 0x80:
+                    pid = body[:2]
+                    pos = 2
+                    granted = bytearray()
+                    while pos < len(body):
+                        tlen = int.from_bytes(body[pos:pos + 2], 'big')
+                        subs.append(body[pos + 2:pos + 2 + tlen].decode())
+                        granted.append(min(body[pos + 2 + tlen], 1))
+                        pos += 3 + tlen
+                    writer.write(bytes([0x90]) + _varlen(2 + len(granted)) + pid + granted)
+                    await writer.drain()
+                elif t == 0xC0:
+                    self.pings += 1
+                    writer.write(b'\xd0\x00')
+                    await writer.drain()
+                elif t == 0xE0:
+                    return
+        except (asyncio.IncompleteReadError, OSError):  # incl. TLS errors
+            pass
+        finally:
+            self._handlers.discard(task)
+            if entry in self.clients:
+                self.clients.remove(entry)
+            writer.close()
+
+    async def _fanout(self, kind, body):
+        tlen = int.from_bytes(body[:2], 'big')
+        topic = body[2:2 + tlen].decode()
+        pkt = bytes([kind & 0xF1]) + _varlen(len(body)) + body
+        for subs, w in list(self.clients):
+            if any(topic_matches(s, topic) for s in subs):
+                w.write(pkt)
+                await w.drain()
+
+    async def inject(self, topic, payload):
+        # Publish from the broker side, e.g. an OTA or reset command.
+        if isinstance(payload, str):
+            payload = payload.encode()
+        t = topic.encode()
+        await self._fanout(0x30, len(t).to_bytes(2, 'big') + t + payload)
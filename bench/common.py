@@ -0,0 +1,13 @@
+# Helpers shared by the benches.
+
+
+def check(name, ok, detail=''):
+    # One result line; returns ok, so results can be collected for all()
+    print('%-34s %s %s' % (name, 'ok' if ok else 'FAIL', detail))
+    return ok
+
+
+class NoCache:
+    # gattcache.HandleCache stand-in that never has handles
+    def get(self, *a):
+        return None
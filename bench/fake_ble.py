@@ -0,0 +1,372 @@
+# Scripted stand-in for ubluetooth.BLE on the host (CPython asyncio).
+#
+# Simulates Berger peripherals that advertise, accept connections, expose
+# service FFF0 / characteristic FFF6 / CCCD and, once notifications are
+# enabled, push status frames split into MTU-sized notification chunks.
+# Events are delivered to the registered irq handler from the event loop,
+# with memoryview payloads like the real stack.
+#
+# Instead of generated frames a peripheral can replay a notification trace
+# (load_trace()): one line per FFF6 notification, "<ms> <hex>", with the ms
+# since the previous notification, so chunking and timing are the recorded
+# ones. bench/traces/ has a synthetic one written by write_trace().
+#
+# Connection parameters: gap_connect()'s interval arguments and
+# gap_update_params() (an optional backend call, see bms.Central) set the
+# connection interval; an update is answered with event 27, the
+# peripheral's own preference when it does not accept requests
+# (accept_params). With FakeBLE(conn_events=True) generated frames go out
+# one notification per connection interval; otherwise all at once.
+# FakeBLE(update_params=False) has no gap_update_params, like MicroPython.
+#
+# Notifications and reads carry at most ATT MTU - 3 and MTU - 1 bytes: 23
+# until gattc_exchange_mtu() agrees on the smaller of config(mtu=...) and
+# the peripheral's mtu. A peripheral with notify=False offers only reads.
+
+import asyncio
+import sys
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+
+import berger
+
+SERVICE = 0xfff0
+CHAR = 0xfff6
+CCCD = 0x2902
+
+# Handles as a typical peripheral lays them out
+H_SERVICE_START = 0x20
+H_CHAR_DEF = 0x21
+H_CHAR_VALUE = 0x22
+H_CCCD = 0x23
+H_SERVICE_END = 0x24
+
+# Flags plus the complete 16-bit service list (FFF0)
+ADV_DATA = b'\x02\x01\x06\x03\x03\xf0\xff'
+
+
+def status_frame(seq=0, cells=(3321, 3325, 3330, 3319), temps=(215, -15), pack=None, current=-1234, soc=87,
+                 capacity=9000):
+    # pack [10 mV], current [10 mA], capacity [10 mAh] as on the wire
+    if pack is None:
+        pack = 1330 + seq % 5
+    words = [pack, current & 0xFFFF, soc, capacity, len(cells)] + list(cells) + [len(temps)] + [t & 0xFFFF for t in temps]
+    buf = bytearray(berger.MAX_FRAME)
+    n = berger.encode_frame(buf, berger.ADR_DEFAULT, berger.CMD_READ, berger.REG_STATUS, 2 * len(words), words)
+    return bytes(buf[:n])
+
+
+def load_trace(path):
+    # [(ms since the previous notification, chunk)]; '#' starts a comment
+    trace = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if fields:
+                trace.append((int(fields[0]), bytes.fromhex(fields[1])))
+    return trace
+
+
+def write_trace(path, frames, frame_ms=1000, chunk=20, gap_ms=8, comment=''):
+    # Notification trace of frames sent every frame_ms in chunk-byte
+    # notifications gap_ms apart (one per connection interval)
+    with open(path, 'w') as f:
+        for line in comment.splitlines():
+            f.write('# %s\n' % line)
+        for frame in frames:
+            for k in range(0, len(frame), chunk):
+                delay = gap_ms if k else frame_ms - gap_ms * ((len(frame) - 1) // chunk)
+                f.write('%d %s\n' % (delay, frame[k:k + chunk].hex()))
+
+
+def _units(min_us, max_us):
+    # The interval a controller picks from a requested range, 1.25 ms units
+    return (min_us + max_us) // 2 // 1250
+
+
+class FakePeripheral:
+    def __init__(self, mac, frame_ms=100, mtu=23, rssi=-60, frames=None, trace=None, speed=1):
+        self.mac = mac
+        self.frame_ms = frame_ms
+        self.mtu = mtu
+        self.rssi = rssi
+        self.frames = frames  # optional list of recorded frames to replay
+        self.trace = trace  # optional load_trace() result, replayed in a loop
+        self.speed = speed  # trace time scale: 10 replays ten times faster
+        self.hidden = False  # out of range: no advertising
+        self.conn = None
+        self.notify = False
+        self.sent_frames = 0
+        self.sent_chunks = 0
+        self.polls = 0
+        self.task = None
+        self.interval = 24  # connection interval, 1.25 ms units
+        self.latency = 0
+        self.timeout = 400  # supervision timeout, 10 ms units
+        self.accept_params = True
+        self.preferred = (40, 0, 500)  # answer to a refused request
+        self.param_requests = 0
+        self.att_mtu = 23  # negotiated on the current connection
+        self.notify_supported = True
+        self.has_cccd = True  # False: notify flag set but no CCCD descriptor
+        self.refuse_connects = 0  # connects to fail, as the ESP32 reports them
+
+
+class FakeBLE:
+    def __init__(self, peripherals, max_connections=4, connect_ms=30, gatt_ms=5, adv_ms=50,
+                 conn_events=False, update_params=True):
+        self.peripherals = peripherals
+        self.conn_events = conn_events
+        if not update_params:
+            self.gap_update_params = None
+        self.max_connections = max_connections
+        self.connect_ms = connect_ms
+        self.gatt_ms = gatt_ms
+        self.adv_ms = adv_ms
+        self._irq = None
+        self._active = True
+        self._scan = None
+        self._pending = None
+        self._next_conn = 1
+        self._conns = {}
+        self._config = {'mtu': 23, 'rxbuf': 1024}
+        self.irq_calls = 0
+        self.scans = 0
+        self.gatt_ops = 0
+
+    # -- ubluetooth.BLE API -------------------------------------------------
+
+    def active(self, *args):
+        if args:
+            self._active = bool(args[0])
+        return self._active
+
+    def irq(self, handler):
+        self._irq = handler
+
+    def config(self, *args, **kwargs):
+        self._config.update(kwargs)
+        return self._config.get(args[0]) if args else None
+
+    def gap_scan(self, duration_ms, interval_us=1280000, window_us=11250, active=False):
+        if self._scan:
+            self._scan.cancel()
+            self._scan = None
+        if duration_ms is None:
+            return
+        self.scans += 1
+        self._scan = asyncio.get_running_loop().create_task(self._advertise(duration_ms))
+
+    def gap_connect(self, addr_type, addr=None, *args):
+        if addr_type is None:
+            if self._pending:
+                self._pending.cancel()
+                self._pending = None
+            return
+        if self._pending is not None or len(self._conns) >= self.max_connections:
+            raise OSError(114)  # EALREADY, as the controller refuses
+        p = self._find(bytes(addr))
+        if len(args) >= 3 and args[1]:
+            # scan_duration_ms, min_conn_interval_us, max_conn_interval_us
+            p.interval = _units(args[1], args[2])
+            p.latency = 0
+        self._pending = asyncio.get_running_loop().create_task(self._connect(p, addr_type))
+
+    def gap_disconnect(self, conn):
+        p = self._conns.get(conn)
+        if p is None:
+            return False
+        self._drop(p)
+        return True
+
+    def gattc_discover_services(self, conn, uuid=None):
+        self._later(self._services(conn))
+
+    def gattc_discover_characteristics(self, conn, start, end, uuid=None):
+        self._later(self._chars(conn))
+
+    def gattc_discover_descriptors(self, conn, start, end):
+        self._later(self._descs(conn))
+
+    def gattc_read(self, conn, handle):
+        p = self._conns[conn]
+        self._later(self._read(p, handle))
+
+    def gattc_write(self, conn, handle, data, mode=0):
+        p = self._conns.get(conn)
+        if p is None:
+            raise OSError(128)  # ENOTCONN
+        self.gatt_ops += 1
+        if handle == H_CCCD:
+            p.notify = bytes(data) == b'\x01\x00'
+            if p.notify and p.task is None:
+                p.task = asyncio.get_running_loop().create_task(self._stream(p))
+        elif handle == H_CHAR_VALUE:
+            p.polls += 1
+        if mode == 1:
+            self._later(self._write_done(conn, handle))
+
+    def gap_update_params(self, conn, min_interval_us, max_interval_us, latency, timeout_ms):
+        p = self._conns.get(conn)
+        if p is None:
+            raise OSError(128)
+        p.param_requests += 1
+        if p.accept_params:
+            params = (_units(min_interval_us, max_interval_us), latency, timeout_ms // 10)
+        else:
+            params = p.preferred
+        self._later(self._params(conn, p, params))
+
+    def gattc_exchange_mtu(self, conn):
+        p = self._conns[conn]
+        self._later(self._mtu(conn, p))
+
+    # -- simulation ---------------------------------------------------------
+
+    def _emit(self, event, data):
+        self.irq_calls += 1
+        if self._irq:
+            self._irq(event, data)
+
+    def _later(self, coro):
+        self.gatt_ops += 1
+        asyncio.get_running_loop().create_task(coro)
+
+    def _find(self, mac):
+        for p in self.peripherals:
+            if p.mac == mac:
+                return p
+        raise OSError(2)
+
+    def disconnect_peer(self, p):
+        # Peripheral-side link loss, e.g. out of range.
+        if p.conn is not None:
+            self._drop(p)
+
+    def _drop(self, p):
+        conn = p.conn
+        del self._conns[conn]
+        p.conn = None
+        p.notify = False
+        if p.task:
+            p.task.cancel()
+            p.task = None
+        asyncio.get_running_loop().call_soon(self._emit, 8, (conn, 0, memoryview(p.mac)))
+
+    async def _advertise(self, duration_ms):
+        loop = asyncio.get_running_loop()
+        end = loop.time() + duration_ms / 1000
+        try:
+            while duration_ms == 0 or loop.time() < end:
+                for p in self.peripherals:
+                    if p.conn is None and not p.hidden:
+                        self._emit(5, (0, memoryview(p.mac), 0, p.rssi, memoryview(ADV_DATA)))
+                await asyncio.sleep(self.adv_ms / 1000)
+        except asyncio.CancelledError:
+            return
+        self._scan = None
+        self._emit(6, ())
+
+    async def _connect(self, p, addr_type):
+        await asyncio.sleep(self.connect_ms / 1000)
+        self._pending = None
+        if p.refuse_connects:
+            p.refuse_connects -= 1
+            self._emit(8, (0xFFFF, addr_type, memoryview(p.mac)))
+            return
+        conn = self._next_conn
+        self._next_conn += 1
+        p.conn = conn
+        p.att_mtu = 23
+        self._conns[conn] = p
+        self._emit(7, (conn, addr_type, memoryview(p.mac)))
+
+    async def _services(self, conn):
+        await asyncio.sleep(self.gatt_ms / 1000)
+        self._emit(9, (conn, 1, 0x0B, 0x1800))
+        self._emit(9, (conn, H_SERVICE_START, H_SERVICE_END, SERVICE))
+        await asyncio.sleep(self.gatt_ms / 1000)
+        self._emit(10, (conn, 0))
+
+    async def _chars(self, conn):
+        await asyncio.sleep(self.gatt_ms / 1000)
+        props = 0x1A if self._conns[conn].notify_supported else 0x0A  # read, write-no-rsp, notify
+        self._emit(11, (conn, H_CHAR_DEF, H_CHAR_VALUE, props, CHAR))
+        await asyncio.sleep(self.gatt_ms / 1000)
+        self._emit(12, (conn, 0))
+
+    async def _descs(self, conn):
+        await asyncio.sleep(self.gatt_ms / 1000)
+        if self._conns[conn].has_cccd:
+            self._emit(13, (conn, H_CCCD, CCCD))
+        await asyncio.sleep(self.gatt_ms / 1000)
+        self._emit(14, (conn, 0))
+
+    async def _read(self, p, handle):
+        await asyncio.sleep(self.gatt_ms / 1000)
+        if handle != H_CHAR_VALUE:
+            self._emit(16, (p.conn, handle, 1))
+            return
+        frame = p.frames[p.sent_frames % len(p.frames)] if p.frames else status_frame(p.sent_frames)
+        p.sent_frames += 1
+        self._emit(15, (p.conn, handle, memoryview(frame[:p.att_mtu - 1])))
+        self._emit(16, (p.conn, handle, 0))
+
+    async def _write_done(self, conn, handle):
+        await asyncio.sleep(self.gatt_ms / 1000)
+        status = 0 if handle in (H_CCCD, H_CHAR_VALUE) else 1
+        self._emit(17, (conn, handle, status))
+
+    async def _params(self, conn, p, params):
+        # Takes effect a few connection events later
+        await asyncio.sleep(3 * p.interval * 1.25 / 1000)
+        if p.conn != conn:
+            return
+        p.interval, p.latency, p.timeout = params
+        self._emit(27, (conn, p.interval, p.latency, p.timeout, 0))
+
+    async def _mtu(self, conn, p):
+        await asyncio.sleep(self.gatt_ms / 1000)
+        if p.conn != conn:
+            return
+        p.att_mtu = min(p.mtu, self._config['mtu'])
+        self._emit(21, (conn, p.att_mtu))
+
+    async def _replay(self, p):
+        trace = p.trace
+        i = 0
+        while p.notify and p.conn is not None:
+            delay, data = trace[i % len(trace)]
+            i += 1
+            if delay:
+                await asyncio.sleep(delay / 1000 / p.speed)
+                if not p.notify or p.conn is None:
+                    break
+            self._emit(18, (p.conn, H_CHAR_VALUE, memoryview(data)))
+            p.sent_chunks += 1
+            if data[-1] == berger.FRAME_END:
+                p.sent_frames += 1
+
+    async def _stream(self, p):
+        if p.trace:
+            await self._replay(p)
+            return
+        chunk = p.att_mtu - 3
+        i = 0
+        while p.notify and p.conn is not None:
+            if p.frames:
+                frame = p.frames[i % len(p.frames)]
+            else:
+                frame = status_frame(i)
+            i += 1
+            t0 = asyncio.get_running_loop().time()
+            for k in range(0, len(frame), chunk):
+                if self.conn_events:  # one notification per connection event
+                    await asyncio.sleep(p.interval * 1.25 / 1000)
+                    if not p.notify or p.conn is None:
+                        return
+                self._emit(18, (p.conn, H_CHAR_VALUE, memoryview(frame[k:k + chunk])))
+                p.sent_chunks += 1
+            p.sent_frames += 1
+            await asyncio.sleep(max(0, p.frame_ms / 1000 - (asyncio.get_running_loop().time() - t0)))
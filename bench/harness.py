@@ -0,0 +1,310 @@
+# Runs the firmware entry points on the host.
+#
+# bench/sim/ holds stand-ins for the MicroPython-only modules: ubluetooth
+# (a fake_ble controller), network (a WLAN with association delay and
+# outages), machine, ntptime, umqtt.simple, ota, ubinascii and uasyncio.
+# BROKER and WIFI_CONFIG are generated, the broker is broker_stub and the
+# time server sntp_stub in the same event loop, and every battery a
+# fake_ble peripheral replaying a notification trace. main.py is imported fresh for every Firmware, so its
+# module-level setup runs as on boot, in a scratch working directory.
+#
+#   fw = Firmware(batteries=2, speed=10)
+#   await fw.start()
+#   await fw.run(5)
+#   fw.wifi_drop(1000)
+#   await fw.run(5)
+#   print(fw.report())
+#   await fw.stop()
+#
+# Heap figures come from tracemalloc: the peak covers the firmware, the
+# stand-ins and the broker, firmware_heap only allocations made by the
+# repo's modules. They compare runs; they do not size the ESP32 heap.
+
+import asyncio
+import gc
+import importlib
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+for _p in (ROOT, HERE, os.path.join(HERE, 'sim')):
+    if _p not in sys.path:
+        sys.path.insert(0, _p)
+
+TRACE = os.path.join(HERE, 'traces', 'berger_4s_discharge.txt')
+HEAP_BYTES = 8 * 1024 * 1024  # notional heap behind gc.mem_free()
+
+# BROKER.py and WIFI_CONFIG.py of the simulated van; Firmware(config=...)
+# overrides or adds BROKER entries.
+BROKER = {
+    'MQTT_BROKER': '127.0.0.1',
+    'MQTT_USER': 'womo',
+    'MQTT_PW': 'secret',
+    'MQTT_TOPIC': 'womo',
+    'MQTT_OTA_UPDATE': 'womo/ota',
+    'MQTT_ESP32_DEBUG': 'womo/debug',
+    'MQTT_ESP32_RESET': 'womo/reset',
+    'MQTT_SSL': False,
+    'LOG_ECHO': False,
+    'POLL_INTERVAL_MS': 0,
+    'PUBLISH_WINDOW_MS': 200,
+    'PUBLISH_RULES': {},
+    'METRICS_INTERVAL_S': 2,
+}
+WIFI_CONFIG = {
+    'SSID': 'womo',
+    'PASSWORD': 'wifi-secret',
+    'SSID_TEST': 'womo-test',
+    'PASSWORD_TEST': 'wifi-test',
+}
+
+
+def _mem_alloc():
+    return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+
+
+_reset_at = [time.monotonic()]  # ticks count from the last simulated reset
+
+
+def install():
+    # The MicroPython extensions of time and gc the firmware calls directly
+    if hasattr(time, 'ticks_ms'):
+        return
+    time.ticks_ms = lambda: int((time.monotonic() - _reset_at[0]) * 1000)
+    time.ticks_us = lambda: int((time.monotonic() - _reset_at[0]) * 1000000)
+    time.ticks_diff = lambda a, b: a - b
+    time.ticks_add = lambda a, b: a + b
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    time.sleep_us = lambda us: time.sleep(us / 1000000)
+    gc.mem_alloc = _mem_alloc
+    gc.mem_free = lambda: max(0, HEAP_BYTES - _mem_alloc())
+
+
+install()
+
+import network
+import ubluetooth
+from broker_stub import BrokerStub
+from sntp_stub import SntpStub
+from fake_ble import FakePeripheral, load_trace
+
+
+def _module(name, values):
+    m = types.ModuleType(name)
+    m.__dict__.update(values)
+    sys.modules[name] = m
+    return m
+
+
+def import_entry(path, name=None):
+    # A fresh module from an entry point file, e.g. ota-mqtt.py
+    name = name or os.path.basename(path)[:-3].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def percentiles(values, ps=(50, 95, 99)):
+    # Exact percentiles (nearest rank) plus the maximum
+    if not values:
+        return [0] * (len(ps) + 1)
+    v = sorted(values)
+    return [v[max(0, (len(v) * p + 99) // 100 - 1)] for p in ps] + [v[-1]]
+
+
+def firmware_heap():
+    # Bytes currently allocated by the repo's own modules
+    snap = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(True, os.path.join(ROOT, '*.py')),
+        tracemalloc.Filter(False, os.path.join(HERE, '*')),
+    ))
+    return sum(s.size for s in snap.statistics('filename'))
+
+
+class Firmware:
+    """main.py against fake batteries, WiFi and broker.
+
+    trace is a fake_ble.load_trace() file or list, replayed speed times
+    faster than recorded; config entries override BROKER. With workdir
+    the flash (gattcache, flash logs) survives into the next Firmware, as
+    across a deep sleep.
+    """
+
+    def __init__(self, batteries=1, trace=TRACE, speed=1, config=None, assoc_ms=300, workdir=None):
+        self.batteries = batteries
+        self.trace = load_trace(trace) if isinstance(trace, str) else trace
+        self.speed = speed
+        self.config = config or {}
+        self.assoc_ms = assoc_ms
+        self.workdir = workdir
+        self.main = None
+        self.broker = None
+        self.sntp = None
+        self.ble = None
+        self.peers = []
+        self.frames = {}  # battery name -> [monotonic time of each frame]
+        self.faults = []  # (monotonic time, kind, battery link or None)
+        self.exit = None
+        self._before = set()
+
+    async def start(self):
+        self._cwd = os.getcwd()
+        self.tmp = self.workdir or tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        _reset_at[0] = time.monotonic()
+        self.broker = await BrokerStub().start()
+        self.sntp = await SntpStub().start()
+        self.peers = [FakePeripheral(bytes([4, 0x7f, 0x0e, 0, 0, i + 1]), trace=self.trace, speed=self.speed)
+                      for i in range(self.batteries)]
+        config = dict(BROKER)
+        config['MQTT_PORT'] = self.broker.port
+        config['NTP_SERVER'] = ('127.0.0.1', self.sntp.port)
+        config['BATTERIES'] = tuple(('batt%d' % (i + 1), p.mac) for i, p in enumerate(self.peers))
+        config['MAX_CONNECTIONS'] = max(3, self.batteries)
+        config.update(self.config)
+        _module('BROKER', config)
+        _module('WIFI_CONFIG', WIFI_CONFIG)
+        network.reset({WIFI_CONFIG['SSID']: WIFI_CONFIG['PASSWORD']}, self.assoc_ms)
+        self.ble = ubluetooth.reset(self.peers, max_connections=max(4, self.batteries))
+        tracemalloc.start()
+        self._before = asyncio.all_tasks()
+        sys.modules.pop('main', None)
+        self.main = importlib.import_module('main')
+        self._hook_frames()
+        self.t0 = time.monotonic()
+        asyncio.create_task(self._main())
+
+    async def _main(self):
+        main = self.main
+        try:
+            await (main.duty_cycle_async() if main.DUTY_CYCLE_S else main.main_async())
+        except SystemExit as e:
+            self.exit = str(e)
+
+    def _hook_frames(self):
+        # Times every decoded frame on its way into the outbox
+        main = self.main
+        on_frame = main.publish_battery_values
+        frames = self.frames
+
+        def publish_battery_values(link):
+            frames.setdefault(link.name, []).append(time.monotonic())
+            on_frame(link)
+
+        main.publish_battery_values = publish_battery_values
+
+    async def run(self, seconds):
+        await asyncio.sleep(seconds)
+
+    async def stop(self):
+        main = self.main
+        if main.links_supervisor is not None:
+            main.links_supervisor.stop()
+        client = main.mqtt_client
+        if client is not None and client.isconnected():
+            try:
+                await client.disconnect()
+            except OSError:
+                pass
+        await self.broker.stop()
+        await self.sntp.stop()
+        tasks = asyncio.all_tasks() - self._before - {asyncio.current_task()}
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        tracemalloc.stop()
+        os.chdir(self._cwd)
+        if self.workdir is None:
+            shutil.rmtree(self.tmp)
+        for name in ('main', 'BROKER', 'WIFI_CONFIG'):
+            sys.modules.pop(name, None)
+
+    # -- faults -------------------------------------------------------------
+
+    def _fault(self, kind, link=None):
+        self.faults.append((time.monotonic(), kind, link))
+
+    def wifi_drop(self, outage_ms=0):
+        # AP out of range: the WLAN drops and the broker loses the session
+        self._fault('wifi')
+        network.drop(outage_ms)
+        self.broker.drop_clients()
+
+    def broker_drop(self):
+        self._fault('mqtt')
+        self.broker.drop_clients()
+
+    def ble_drop(self, i=0, outage_ms=0):
+        # Battery i goes out of range for outage_ms
+        p = self.peers[i]
+        self._fault('ble', self.main.links[i])
+        p.hidden = True
+        self.ble.disconnect_peer(p)
+        asyncio.get_running_loop().call_later(outage_ms / 1000, setattr, p, 'hidden', False)
+
+    # -- results ------------------------------------------------------------
+
+    def telemetry(self, topic=None):
+        # Broker receive times of telemetry publishes (one battery's topic,
+        # or all of them)
+        topics = [topic] if topic else [link.topic for link in self.main.links]
+        return [t for t, tp, _ in self.broker.published if tp in topics]
+
+    def latencies_ms(self):
+        # Per publish: ms from the first frame it carries (the first after
+        # the previous publish of that battery) to the broker receiving it
+        out = []
+        for link in self.main.links:
+            frames = self.frames.get(link.name, [])
+            i = 0
+            for t in self.telemetry(link.topic):
+                first = None
+                while i < len(frames) and frames[i] <= t:
+                    if first is None:
+                        first = frames[i]
+                    i += 1
+                if first is not None:
+                    out.append((t - first) * 1000)
+        return out
+
+    def gaps_ms(self):
+        # Per fault: ms until telemetry reached the broker again; for a
+        # battery, telemetry carrying a frame decoded after the fault
+        out = []
+        for t0, kind, link in self.faults:
+            if link is None:
+                after = [t for t in self.telemetry() if t > t0]
+            else:
+                frames = [t for t in self.frames.get(link.name, []) if t > t0]
+                after = [t for t in self.telemetry(link.topic) if frames and t >= frames[0]]
+            out.append((kind, (after[0] - t0) * 1000 if after else None))
+        return out
+
+    def report(self):
+        main = self.main
+        seconds = time.monotonic() - self.t0
+        frames = sum(link.decoder.frames for link in main.links)
+        lat = percentiles(self.latencies_ms())
+        return {
+            'seconds': round(seconds, 2),
+            'frames': frames,
+            'frames_s': round(frames / seconds, 1),
+            'offered_s': round(sum(p.sent_frames for p in self.peers) / seconds, 1),
+            'decode_errors': sum(link.decoder.errors for link in main.links),
+            'publishes': len(self.telemetry()),
+            'latency_ms': [round(v) for v in lat],
+            'recover_ms': {link.name: link.last_recover_ms for link in main.links_supervisor.links},
+            'ble_recover_ms': [link.recover_ms for link in main.links],
+            'gaps_ms': [(kind, round(ms) if ms is not None else None) for kind, ms in self.gaps_ms()],
+            'heap_peak': tracemalloc.get_traced_memory()[1],
+            'firmware_heap': firmware_heap(),
+            'exit': self.exit,
+        }
@@ -0,0 +1,59 @@
+# Minimal HTTP/1.0 file server for host runs (CPython asyncio), standing in
+# for the OTA download host.
+#
+#   server = HttpStub({'/main.py': b'...', '/manifest.json': b'...'})
+#   await server.start()            # server.port is the bound port
+#   ...
+#   await server.stop()
+#
+# truncate maps a path to a byte count after which the connection is
+# dropped; rate limits the bytes per second sent per response.
+
+import asyncio
+
+
+class HttpStub:
+    def __init__(self, files, host='127.0.0.1', port=0, rate=None):
+        self.files = files
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.truncate = {}
+        self.requests = []
+        self.bytes_sent = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _client(self, reader, writer):
+        try:
+            line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b''):
+                pass
+            path = line.split()[1].decode()
+            self.requests.append(path)
+            body = self.files.get(path)
+            if body is None:
+                writer.write(b'HTTP/1.0 404 Not Found\r\n\r\n')
+                return
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body))
+            end = self.truncate.get(path, len(body))
+            step = 4096
+            for i in range(0, end, step):
+                chunk = body[i:min(i + step, end)]
+                writer.write(chunk)
+                await writer.drain()
+                self.bytes_sent += len(chunk)
+                if self.rate:
+                    await asyncio.sleep(len(chunk) / self.rate)
+        except (OSError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,50 @@
+# machine stand-in: reset() and deepsleep() end the firmware run with
+# SystemExit (the harness records why); RTC memory survives like on the
+# device, as long as the process runs. RTC().datetime() records the time
+# it is set to and leaves the host clock alone.
+
+import time
+
+resets = []  # ("reset" | "deepsleep", ms)
+rtc_set = []  # RTC().datetime() tuples, oldest first
+
+_rtc_memory = [b""]
+
+
+def reset():
+    resets.append(("reset", 0))
+    raise SystemExit("machine.reset()")
+
+
+def soft_reset():
+    reset()
+
+
+def deepsleep(ms=0):
+    resets.append(("deepsleep", ms))
+    raise SystemExit("machine.deepsleep(%d)" % ms)
+
+
+def lightsleep(ms=0):
+    time.sleep(ms / 1000)
+
+
+def unique_id():
+    return b"\x24\x0a\xc4\x00\x00\x01"
+
+
+def freq(hz=None):
+    return 240000000
+
+
+class RTC:
+    def memory(self, data=None):
+        if data is None:
+            return _rtc_memory[0]
+        _rtc_memory[0] = bytes(data)
+
+    def datetime(self, dt=None):
+        if dt is None:
+            tm = time.gmtime()
+            return (tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0)
+        rtc_set.append(tuple(dt))
@@ -0,0 +1,118 @@
+# network stand-in: a WLAN that associates with the access points listed
+# in NETWORKS after ASSOC_MS. drop() takes the link down like an AP going
+# out of range; a connect() only completes ASSOC_MS after the outage.
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 1000
+STAT_CONNECTING = 1001
+STAT_GOT_IP = 1010
+STAT_NO_AP_FOUND = 201
+STAT_WRONG_PASSWORD = 202
+
+NETWORKS = {}  # ssid -> password of the access points in range
+ASSOC_MS = 300
+
+_ifs = {}
+_down_until = [None]
+
+
+def reset(networks=None, assoc_ms=300):
+    global ASSOC_MS
+    _ifs.clear()
+    _down_until[0] = None
+    NETWORKS.clear()
+    NETWORKS.update(networks or {})
+    ASSOC_MS = assoc_ms
+
+
+def drop(outage_ms=0):
+    # Every interface loses its link; no AP is found for outage_ms.
+    _down_until[0] = ticks_ms() + outage_ms
+    for w in _ifs.values():
+        if w._status in (STAT_CONNECTING, STAT_GOT_IP):
+            w._status = STAT_IDLE
+
+
+class _WLAN:
+    def __init__(self, interface):
+        self.interface = interface
+        self._active = False
+        self._status = STAT_IDLE
+        self._ssid = None
+        self._key = None
+        self._t0 = 0
+        self.connects = 0
+
+    def active(self, *args):
+        if args:
+            self._active = bool(args[0])
+            if not self._active:
+                self._status = STAT_IDLE
+        return self._active
+
+    def connect(self, ssid=None, key=None, bssid=None):
+        if not self._active:
+            raise OSError("STA must be active")
+        self.connects += 1
+        self._ssid = ssid
+        self._key = key
+        self._status = STAT_CONNECTING
+        self._t0 = ticks_ms()
+
+    def disconnect(self):
+        self._status = STAT_IDLE
+
+    def status(self, param=None):
+        if param == "rssi":
+            return -58
+        if self._status == STAT_CONNECTING:
+            # Keeps scanning through an outage, like the ESP32 station
+            ready = self._t0 + ASSOC_MS
+            t = _down_until[0]
+            if t is not None and ticks_diff(t + ASSOC_MS, ready) > 0:
+                ready = t + ASSOC_MS
+            if ticks_diff(ticks_ms(), ready) >= 0:
+                if self._ssid not in NETWORKS:
+                    self._status = STAT_NO_AP_FOUND
+                elif NETWORKS[self._ssid] != self._key:
+                    self._status = STAT_WRONG_PASSWORD
+                else:
+                    self._status = STAT_GOT_IP
+        return self._status
+
+    def isconnected(self):
+        return self.status() == STAT_GOT_IP
+
+    def ifconfig(self, *args):
+        return ("192.168.4.%d" % (10 + self.interface), "255.255.255.0", "192.168.4.1", "192.168.4.1")
+
+    def config(self, *args, **kwargs):
+        if args == ("mac",):
+            return b"\x24\x0a\xc4\x00\x00\x01"
+        if args == ("ssid",) or args == ("essid",):
+            return self._ssid or ""
+        return None
+
+    def scan(self):
+        return [(ssid.encode(), b"\x00\x11\x22\x33\x44\x55", 6, -58, 3, False) for ssid in NETWORKS]
+
+
+def WLAN(interface=STA_IF):
+    # One object per interface, as on the device
+    w = _ifs.get(interface)
+    if w is None:
+        w = _ifs[interface] = _WLAN(interface)
+    return w
@@ -0,0 +1,19 @@
+# ntptime stand-in: settime() blocks for DELAY_MS like the UDP round trip
+# and leaves the host clock alone.
+
+import time as _time
+
+host = "pool.ntp.org"
+timeout = 1
+DELAY_MS = 50
+syncs = 0
+
+
+def time():
+    return int(_time.time()) - 946684800  # seconds since 2000-01-01
+
+
+def settime():
+    global syncs
+    _time.sleep(DELAY_MS / 1000)
+    syncs += 1
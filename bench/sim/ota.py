@@ -0,0 +1,15 @@
+# ota stand-in for the legacy OTAUpdater used by ota-mqtt.py: reports
+# that the running version is current.
+
+
+class OTAUpdater:
+    def __init__(self, ssid, password, repo_url, filename):
+        self.ssid = ssid
+        self.password = password
+        self.repo_url = repo_url
+        self.filename = filename
+        self.checks = 0
+
+    def download_and_install_update_if_available(self):
+        self.checks += 1
+        return False
@@ -0,0 +1,11 @@
+# uasyncio stand-in: CPython's asyncio plus sleep_ms().
+
+from asyncio import *
+import asyncio as _asyncio
+
+
+def sleep_ms(ms):
+    return _asyncio.sleep(ms / 1000)
+
+
+_asyncio.sleep_ms = sleep_ms  # for modules that import asyncio directly
@@ -0,0 +1,2 @@
+# ubinascii stand-in
+from binascii import *
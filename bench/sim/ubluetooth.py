@@ -0,0 +1,28 @@
+# ubluetooth stand-in: BLE() is the fake_ble.FakeBLE the harness set up
+# with reset(), so the firmware talks to scripted Berger peripherals.
+
+from fake_ble import FakeBLE
+
+FLAG_READ = 0x0002
+FLAG_WRITE_NO_RESPONSE = 0x0004
+FLAG_WRITE = 0x0008
+FLAG_NOTIFY = 0x0010
+
+_ble = [None]
+
+
+def reset(peripherals=(), **kwargs):
+    # A fresh controller with these peripherals in range; returns it.
+    _ble[0] = FakeBLE(list(peripherals), **kwargs)
+    return _ble[0]
+
+
+def BLE():
+    if _ble[0] is None:
+        reset()
+    return _ble[0]
+
+
+def UUID(value):
+    # fake_ble reports 16-bit UUIDs as ints
+    return value
@@ -0,0 +1,179 @@
+# umqtt.simple stand-in: the blocking MQTT 3.1.1 client API of
+# micropython-lib on a CPython socket (QoS 0 and 1, no will), enough for
+# ota-mqtt.py against bench/broker_stub.py.
+
+import socket
+import struct
+
+
+class MQTTException(Exception):
+    pass
+
+
+class MQTTClient:
+    def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0, ssl=None,
+                 ssl_params={}):
+        if port == 0:
+            port = 8883 if ssl else 1883
+        self.client_id = client_id
+        self.server = server
+        self.port = port
+        self.user = user
+        self.pswd = password
+        self.keepalive = keepalive
+        self.ssl = ssl
+        self.sock = None
+        self.cb = None
+        self.pid = 0
+
+    def _send_str(self, s):
+        if isinstance(s, str):
+            s = s.encode()
+        self.sock.write(struct.pack("!H", len(s)) + s)
+
+    def _recv_len(self):
+        n = 0
+        sh = 0
+        while True:
+            b = self.sock.read(1)[0]
+            n |= (b & 0x7F) << sh
+            if not b & 0x80:
+                return n
+            sh += 7
+
+    def _header(self, op, n):
+        out = bytearray([op])
+        while True:
+            b = n & 0x7F
+            n >>= 7
+            out.append(b | 0x80 if n else b)
+            if not n:
+                return out
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def connect(self, clean_session=True, timeout=None):
+        sock = socket.create_connection((self.server, self.port), timeout)
+        if self.ssl is not None:
+            sock = self.ssl.wrap_socket(sock, server_hostname=self.server)
+        self.sock = _Stream(sock)
+        body = bytearray(b"\x00\x04MQTT\x04\x02\x00\x00")
+        if not clean_session:
+            body[7] &= ~0x02
+        n = 10 + 2 + len(self.client_id)
+        if self.user is not None:
+            body[7] |= 0xC0
+            n += 2 + len(self.user) + 2 + len(self.pswd)
+        struct.pack_into("!H", body, 8, self.keepalive)
+        self.sock.write(self._header(0x10, n) + body)
+        self._send_str(self.client_id)
+        if self.user is not None:
+            self._send_str(self.user)
+            self._send_str(self.pswd)
+        resp = self.sock.read(4)
+        if resp[0] != 0x20 or resp[1] != 0x02:
+            raise MQTTException("bad CONNACK")
+        if resp[3]:
+            raise MQTTException(resp[3])
+        established = getattr(self.ssl, "established", None)
+        if established is not None:
+            established()
+        return resp[2] & 1
+
+    def disconnect(self):
+        try:
+            self.sock.write(b"\xe0\x00")
+        finally:
+            self.sock.close()
+
+    def ping(self):
+        self.sock.write(b"\xc0\x00")
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(msg, str):
+            msg = msg.encode()
+        n = 2 + len(topic) + len(msg) + (2 if qos else 0)
+        self.sock.write(self._header(0x30 | qos << 1 | retain, n))
+        self._send_str(topic)
+        if qos:
+            self.pid += 1
+            self.sock.write(struct.pack("!H", self.pid))
+        self.sock.write(msg)
+
+    def subscribe(self, topic, qos=0):
+        if isinstance(topic, str):
+            topic = topic.encode()
+        self.pid += 1
+        self.sock.write(self._header(0x82, 2 + 2 + len(topic) + 1) + struct.pack("!H", self.pid))
+        self._send_str(topic)
+        self.sock.write(bytes([qos]))
+        while True:
+            op = self.wait_msg()
+            if op == 0x90:
+                resp = self.sock.read(4)
+                if resp[3] == 0x80:
+                    raise MQTTException(resp[3])
+                return
+
+    def wait_msg(self):
+        # One incoming packet; PUBLISH goes to the callback. Returns the
+        # type byte of anything else for the caller to read.
+        res = self.sock.read(1)
+        if not res:
+            raise OSError(-1)
+        op = res[0]
+        if op == 0xD0:  # PINGRESP
+            self.sock.read(1)
+            return None
+        if op & 0xF0 != 0x30:
+            return op
+        n = self._recv_len()
+        tlen = struct.unpack("!H", self.sock.read(2))[0]
+        topic = self.sock.read(tlen)
+        n -= tlen + 2
+        if op & 6:
+            pid = struct.unpack("!H", self.sock.read(2))[0]
+            n -= 2
+        msg = self.sock.read(n)
+        if self.cb is not None:
+            self.cb(topic, msg)
+        if op & 6 == 2:
+            self.sock.write(b"\x40\x02" + struct.pack("!H", pid))
+        return None
+
+    def check_msg(self):
+        self.sock.setblocking(False)
+        try:
+            return self.wait_msg()
+        except BlockingIOError:
+            return None
+        finally:
+            self.sock.setblocking(True)
+
+
+class _Stream:
+    # MicroPython socket read()/write() semantics on a CPython socket
+    def __init__(self, sock):
+        self._sock = sock
+
+    def read(self, n):
+        out = b""
+        while len(out) < n:
+            data = self._sock.recv(n - len(out))
+            if not data:
+                break
+            out += data
+        return out
+
+    def write(self, data):
+        self._sock.sendall(data)
+        return len(data)
+
+    def setblocking(self, flag):
+        self._sock.setblocking(flag)
+
+    def close(self):
+        self._sock.close()
@@ -0,0 +1,45 @@
+# Minimal SNTP server for host runs (CPython asyncio), standing in for
+# pool.ntp.org: answers every client request with the host clock.
+#
+#   server = await SntpStub().start()   # server.port is the bound port
+#   ...
+#   await server.stop()
+#
+# delay_ms holds each reply back, like a slow round trip.
+
+import asyncio
+import struct
+import time
+
+NTP_DELTA = 2208988800  # seconds from 1900-01-01 to 1970-01-01
+
+
+class SntpStub(asyncio.DatagramProtocol):
+    def __init__(self, host='127.0.0.1', port=0, delay_ms=0):
+        self.host = host
+        self.port = port
+        self.delay_ms = delay_ms
+        self.requests = 0
+        self._transport = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=(self.host, self.port))
+        self.port = self._transport.get_extra_info('sockname')[1]
+        return self
+
+    async def stop(self):
+        self._transport.close()
+
+    def datagram_received(self, data, addr):
+        if len(data) < 48 or data[0] & 7 != 3:  # client mode only
+            return
+        self.requests += 1
+        t = int(time.time()) + NTP_DELTA
+        reply = bytearray(48)
+        reply[0] = 0x1C  # LI 0, version 3, server
+        reply[1] = 2  # stratum
+        reply[24:32] = data[40:48]  # originate = the client's transmit time
+        struct.pack_into('!II', reply, 32, t, 0)  # receive
+        struct.pack_into('!II', reply, 40, t, 0)  # transmit
+        asyncio.get_running_loop().call_later(self.delay_ms / 1000, self._transport.sendto, bytes(reply), addr)
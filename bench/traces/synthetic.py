@@ -0,0 +1,37 @@
+# Writes berger_4s_discharge.txt: two minutes of status frames from a 4S
+# pack discharging at about 12 A, one frame per second in 20-byte
+# notifications (default MTU) one 7.5 ms connection interval apart.
+# Synthetic, from fake_ble.status_frame(); a capture from a real pack in
+# the same "<ms> <hex>" format can be dropped in next to it.
+#   python bench/traces/synthetic.py
+
+import os
+import random
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+from fake_ble import status_frame, write_trace
+
+FRAMES = 120
+
+
+def frames(n):
+    rnd = random.Random(4)
+    cells = [3321, 3325, 3330, 3319]
+    out = []
+    for i in range(n):
+        cells = [c - (i % 7 == 0) + rnd.choice((-1, 0, 0, 1)) for c in cells]
+        current = -1230 + rnd.randrange(-40, 41)
+        capacity = 9000 - i * 12 // 36
+        temps = (215 + i // 20, -15 + i // 40)
+        out.append(status_frame(cells=cells, temps=temps, pack=sum(cells) // 10, current=current,
+                                soc=capacity * 100 // 10000, capacity=capacity))
+    return out
+
+
+if __name__ == '__main__':
+    write_trace(os.path.join(here, 'berger_4s_discharge.txt'), frames(FRAMES), frame_ms=1000, chunk=20, gap_ms=8,
+                comment='Synthetic Berger FFF6 notification trace, written by bench/traces/synthetic.py.\n'
+                        '<ms since the previous notification> <payload hex>')
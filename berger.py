@@ -0,0 +1,334 @@
+# Berger LiFePo4 BMS protocol on characteristic FFF6.
+#
+# Frames are ASCII-hex between ':' and '~', two characters per byte:
+#
+#   ':' ADR CMD REG CNT(2) DATA(...) CHK '~'
+#
+# CHK is the inverted low byte of the sum of all ASCII characters between
+# ':' and CHK, e.g. the status poll ":015150000EFE~" (ADR 01, CMD 51,
+# REG 50, CNT 000E, no data, CHK FE). Responses to a status poll carry the
+# status block as big-endian 16-bit words in DATA:
+#
+#   pack voltage [10 mV], current [10 mA, +charge/-discharge], SOC [%],
+#   remaining capacity [10 mAh], cell count n, n cell voltages [mV],
+#   temperature count t, t temperatures [0.1 degC, signed]
+#
+# Frames are longer than one default-MTU notification; Assembler stitches
+# the chunks back together. Everything here works on preallocated storage,
+# so reassembling and decoding a frame does not touch the heap.
+
+from array import array
+
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+FRAME_START = const(0x3A)  # ':'
+FRAME_END = const(0x7E)  # '~'
+
+ADR_DEFAULT = const(0x01)
+CMD_READ = const(0x51)
+REG_STATUS = const(0x50)
+
+MAX_CELLS = const(16)
+MAX_TEMPS = const(4)
+# ':' + 5 header bytes + status block + CHK + '~'
+MAX_FRAME = const(2 + 2 * (5 + 2 * (6 + MAX_CELLS + MAX_TEMPS) + 1))
+
+# decode() results
+OK = const(0)
+E_SHORT = const(1)  # too short to hold header and checksum
+E_DELIM = const(2)  # missing ':' or '~'
+E_HEX = const(3)  # non-hex character or odd number of digits
+E_CHECKSUM = const(4)
+E_LAYOUT = const(5)  # status block does not fit the declared counts
+
+
+def _nibble(c):
+    if 48 <= c <= 57:
+        return c - 48
+    c |= 0x20
+    if 97 <= c <= 102:
+        return c - 87
+    return -1
+
+
+def _hexchar(v):
+    return v + 48 if v < 10 else v + 55
+
+
+class Decoder:
+    """Decodes one frame at a time into fixed fields.
+
+    After decode() returns OK, adr/cmd/reg/count describe the header and,
+    when has_status is set, the typed battery values are valid. Cell
+    voltages and temperatures live in preallocated arrays; only the first
+    ncells/ntemps entries belong to the last frame.
+    """
+
+    def __init__(self, max_cells=MAX_CELLS, max_temps=MAX_TEMPS):
+        self.cells = array('H', [0] * max_cells)
+        self.temps = array('h', [0] * max_temps)
+        self._words = array('H', [0] * (6 + max_cells + max_temps))
+        self.adr = 0
+        self.cmd = 0
+        self.reg = 0
+        self.count = 0
+        self.has_status = False
+        self.pack_mv = 0
+        self.current_ma = 0
+        self.soc = 0
+        self.capacity_mah = 0
+        self.ncells = 0
+        self.ntemps = 0
+        self.frames = 0
+        self.errors = 0
+
+    def decode(self, buf, n=-1):
+        if n < 0:
+            n = len(buf)
+        rc = self._decode(buf, n)
+        if rc == OK:
+            self.frames += 1
+        else:
+            self.errors += 1
+        return rc
+
+    def _decode(self, buf, n):
+        self.has_status = False
+        # ':' + ADR CMD REG CNT(2) + CHK + '~'
+        if n < 14:
+            return E_SHORT
+        if buf[0] != FRAME_START or buf[n - 1] != FRAME_END:
+            return E_DELIM
+        if n & 1:
+            return E_HEX
+        end = n - 3  # first checksum digit
+        total = 0
+        words = self._words
+        nwords = 0
+        hi = 0
+        i = 1
+        while i < end:
+            a = buf[i]
+            b = buf[i + 1]
+            va = _nibble(a)
+            vb = _nibble(b)
+            if va < 0 or vb < 0:
+                return E_HEX
+            total += a + b
+            v = (va << 4) | vb
+            k = (i - 1) >> 1  # byte index behind ':'
+            if k == 0:
+                self.adr = v
+            elif k == 1:
+                self.cmd = v
+            elif k == 2:
+                self.reg = v
+            elif k == 3:
+                hi = v
+            elif k == 4:
+                self.count = (hi << 8) | v
+            elif k & 1:
+                hi = v
+            else:
+                if nwords == len(words):
+                    return E_LAYOUT
+                words[nwords] = (hi << 8) | v
+                nwords += 1
+            i += 2
+        va = _nibble(buf[end])
+        vb = _nibble(buf[end + 1])
+        if va < 0 or vb < 0:
+            return E_HEX
+        if ((va << 4) | vb) != (~total & 0xFF):
+            return E_CHECKSUM
+        if (end - 11) & 3:
+            return E_LAYOUT  # odd number of data bytes
+        if self.reg == REG_STATUS and nwords:
+            return self._status(words, nwords)
+        return OK
+
+    def _status(self, words, nwords):
+        if nwords < 6:
+            return E_LAYOUT
+        ncells = words[4]
+        if ncells > len(self.cells) or nwords < 6 + ncells:
+            return E_LAYOUT
+        ntemps = words[5 + ncells]
+        if ntemps > len(self.temps) or nwords < 6 + ncells + ntemps:
+            return E_LAYOUT
+        self.pack_mv = words[0] * 10
+        cur = words[1]
+        if cur & 0x8000:
+            cur -= 0x10000
+        self.current_ma = cur * 10
+        self.soc = words[2]
+        self.capacity_mah = words[3] * 10
+        cells = self.cells
+        for j in range(ncells):
+            cells[j] = words[5 + j]
+        temps = self.temps
+        base = 6 + ncells
+        for j in range(ntemps):
+            t = words[base + j]
+            if t & 0x8000:
+                t -= 0x10000
+            temps[j] = t
+        self.ncells = ncells
+        self.ntemps = ntemps
+        self.has_status = True
+        return OK
+
+
+class Assembler:
+    """Reassembles frames from notification chunks into a ring of slots.
+
+    feed() runs in the BLE callback and copies each byte once into the
+    slot being filled; a frame starts at ':' and completes at '~'. The
+    consumer takes complete frames in order:
+
+        n = asm.pending()
+        while n:
+            decoder.decode(asm.frame(), n)
+            asm.release()
+            n = asm.pending()
+
+    frame() is a view into the slot, valid until release(). feed() only
+    writes the produced side and release() only the consumed side, so the
+    two may run from IRQ and task without a lock.
+
+    Counters: dropped_bytes (garbage outside frames and bytes of abandoned
+    frames), resyncs (':' inside a frame restarts it), overflows (no '~'
+    within a slot), dropped_frames (ring full).
+    """
+
+    def __init__(self, slots=4, size=MAX_FRAME):
+        self._size = size
+        self._slots = slots
+        buf = memoryview(bytearray(slots * size))
+        self._views = [buf[i * size:(i + 1) * size] for i in range(slots)]
+        self._lens = array('H', [0] * slots)
+        self._produced = 0
+        self._consumed = 0
+        self._slot = self._views[0]
+        self._pos = -1  # -1: hunting for ':', -2: discarding until '~'
+        self.frames = 0
+        self.dropped_bytes = 0
+        self.resyncs = 0
+        self.overflows = 0
+        self.dropped_frames = 0
+
+    def reset(self):
+        # Drop a partial frame, e.g. after a disconnect.
+        if self._pos > 0:
+            self.dropped_bytes += self._pos
+        self._pos = -1
+
+    def filling(self):
+        # A frame has started and not completed yet
+        return self._pos > 0
+
+    def feed(self, data, n=-1):
+        if n < 0:
+            n = len(data)
+        done = 0
+        pos = self._pos
+        slot = self._slot
+        size = self._size
+        for i in range(n):
+            c = data[i]
+            if c == FRAME_START:
+                if pos > 0:
+                    self.resyncs += 1
+                    self.dropped_bytes += pos
+                elif pos == -2:
+                    self.resyncs += 1
+                if self._produced - self._consumed >= self._slots:
+                    self.dropped_frames += 1
+                    pos = -2
+                    continue
+                slot = self._views[self._produced % self._slots]
+                slot[0] = c
+                pos = 1
+            elif pos < 0:
+                if pos == -1:
+                    self.dropped_bytes += 1
+                elif c == FRAME_END:
+                    pos = -1
+            elif pos == size - 1 and c != FRAME_END:
+                self.overflows += 1
+                self.dropped_bytes += pos + 1
+                pos = -1
+            else:
+                slot[pos] = c
+                pos += 1
+                if c == FRAME_END:
+                    self._lens[self._produced % self._slots] = pos
+                    self._produced += 1
+                    self.frames += 1
+                    done += 1
+                    pos = -1
+        self._pos = pos
+        self._slot = slot
+        return done
+
+    def pending(self):
+        # Length of the oldest complete frame, 0 if there is none.
+        if self._consumed == self._produced:
+            return 0
+        return self._lens[self._consumed % self._slots]
+
+    def frame(self):
+        return self._views[self._consumed % self._slots]
+
+    def release(self):
+        if self._consumed != self._produced:
+            self._consumed += 1
+
+
+def encode_frame(buf, adr, cmd, reg, count, data=None):
+    """Write a frame into buf and return its length.
+
+    data is an optional sequence of 16-bit words appended after CNT.
+    """
+    total = 0
+    i = 1
+    buf[0] = FRAME_START
+    for j in range(5 + (2 * len(data) if data else 0)):
+        if j == 0:
+            v = adr
+        elif j == 1:
+            v = cmd
+        elif j == 2:
+            v = reg
+        elif j == 3:
+            v = count >> 8
+        elif j == 4:
+            v = count & 0xFF
+        else:
+            w = data[(j - 5) >> 1]
+            v = (w >> 8) & 0xFF if (j - 5) & 1 == 0 else w & 0xFF
+        a = _hexchar(v >> 4)
+        b = _hexchar(v & 0x0F)
+        buf[i] = a
+        buf[i + 1] = b
+        total += a + b
+        i += 2
+    c = ~total & 0xFF
+    buf[i] = _hexchar(c >> 4)
+    buf[i + 1] = _hexchar(c & 0x0F)
+    buf[i + 2] = FRAME_END
+    return i + 3
+
+
+def status_request(adr=ADR_DEFAULT, count=0x0E):
+    buf = bytearray(14)
+    encode_frame(buf, adr, CMD_READ, REG_STATUS, count)
+    return bytes(buf)
+
+
+# The poll the BMS app sends: ":015150000EFE~"
+STATUS_REQUEST = status_request()
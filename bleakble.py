@@ -0,0 +1,315 @@
+# The ubluetooth.BLE central API on top of bleak (CPython: BlueZ, CoreBLE,
+# WinRT), so bms.Central runs unchanged on a Linux gateway.
+#
+# Calls return at once like on the ESP32; the work runs as tasks on the
+# event loop and its results come back through the IRQ handler with the
+# ubluetooth event codes and tuples (scan results, connect/disconnect,
+# service/characteristic/descriptor discovery, read, write done, notify,
+# MTU). Addresses are 6-byte MACs, UUIDs of the Bluetooth base are
+# 16-bit ints as bms compares them, others their string form. Writing the
+# CCCD of a characteristic starts or stops its notifications, also with
+# handles from gattcache that were not discovered on this connection. A
+# failed connect is reported as a disconnect of conn 0xFFFF, as on the
+# ESP32.
+#
+#   ble = BleakBLE("hci0")
+#   central = bms.Central(ble, links, evq.EventQueue(64), cache,
+#                         (bms.SERVICE_UUID_16, bms.CHARACTERISTIC_UUID_16, bms.CCCD_UUID_16))
+#
+# bleak is only imported when this module is; the firmware never does.
+
+import asyncio
+
+from bleak import BleakClient, BleakScanner
+
+import log
+
+_IRQ_SCAN_RESULT = 5
+_IRQ_SCAN_DONE = 6
+_IRQ_PERIPHERAL_CONNECT = 7
+_IRQ_PERIPHERAL_DISCONNECT = 8
+_IRQ_GATTC_SERVICE_RESULT = 9
+_IRQ_GATTC_SERVICE_DONE = 10
+_IRQ_GATTC_CHARACTERISTIC_RESULT = 11
+_IRQ_GATTC_CHARACTERISTIC_DONE = 12
+_IRQ_GATTC_DESCRIPTOR_RESULT = 13
+_IRQ_GATTC_DESCRIPTOR_DONE = 14
+_IRQ_GATTC_READ_RESULT = 15
+_IRQ_GATTC_READ_DONE = 16
+_IRQ_GATTC_WRITE_DONE = 17
+_IRQ_GATTC_NOTIFY = 18
+_IRQ_MTU_EXCHANGED = 21
+
+_ADV_IND = 0
+_BASE_UUID = "-0000-1000-8000-00805f9b34fb"
+_PROPS = {"broadcast": 0x01, "read": 0x02, "write-without-response": 0x04, "write": 0x08,
+          "notify": 0x10, "indicate": 0x20, "authenticated-signed-writes": 0x40}
+_STATUS_ERROR = 1  # any non-zero ATT status
+_CCCD = 0x2902
+_NO_CONN = 0xFFFF
+
+
+def _uuid(s):
+    s = str(s).lower()
+    if len(s) == 36 and s.startswith("0000") and s.endswith(_BASE_UUID):
+        return int(s[4:8], 16)
+    return s
+
+
+def _mac(address):
+    return bytes.fromhex(address.replace(":", "").replace("-", ""))
+
+
+def _address(mac):
+    return ":".join("%02X" % b for b in mac)
+
+
+def _adv_data(adv):
+    # The advertising payload bms filters on: flags and 16-bit services
+    out = bytearray(b"\x02\x01\x06")
+    services = [u for u in map(_uuid, adv.service_uuids or ()) if isinstance(u, int)]
+    if services:
+        out.append(1 + 2 * len(services))
+        out.append(0x03)
+        for u in services:
+            out += u.to_bytes(2, "little")
+    name = (adv.local_name or "").encode()[:20]
+    if name:
+        out += bytes([1 + len(name), 0x09]) + name
+    return bytes(out)
+
+
+class _Connection:
+    def __init__(self, conn, mac, client):
+        self.conn = conn
+        self.mac = mac
+        self.client = client
+        self.chars = {}  # value handle -> bleak characteristic
+        self.cccds = {}  # CCCD handle -> value handle
+        self.notifying = set()
+
+
+class BleakBLE:
+    """ubluetooth.BLE central calls on one adapter (None: the default)."""
+
+    def __init__(self, adapter=None, connect_timeout=10.0):
+        self.adapter = adapter
+        self.connect_timeout = connect_timeout
+        self._handler = None
+        self._active = False
+        self._scan_task = None
+        self._connect_task = None
+        self._conns = {}
+        self._next_conn = 0
+        self.errors = 0
+
+    def active(self, *args):
+        if args:
+            self._active = bool(args[0])
+        return self._active
+
+    def irq(self, handler):
+        self._handler = handler
+
+    def config(self, *args, **kwargs):
+        return None
+
+    def _emit(self, event, data):
+        if self._handler is not None:
+            self._handler(event, data)
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.errors += 1
+            log.warning("bleak (%s): %s", self.adapter, task.exception())
+
+    def _conn(self, conn):
+        c = self._conns.get(conn)
+        if c is None:
+            raise OSError(128)  # ENOTCONN, as ubluetooth
+        return c
+
+    # -- GAP ----------------------------------------------------------------
+
+    def gap_scan(self, duration_ms, interval_us=1280000, window_us=11250, active=False):
+        if self._scan_task is not None:
+            self._scan_task.cancel()
+            self._scan_task = None
+        if duration_ms is not None:
+            self._scan_task = self._spawn(self._scan(duration_ms or None))
+
+    async def _scan(self, duration_ms):
+        def found(device, adv):
+            rssi = adv.rssi if adv.rssi is not None else -127
+            self._emit(_IRQ_SCAN_RESULT, (0, _mac(device.address), _ADV_IND, rssi, _adv_data(adv)))
+
+        kwargs = {"adapter": self.adapter} if self.adapter else {}
+        scanner = BleakScanner(detection_callback=found, **kwargs)
+        await scanner.start()
+        try:
+            if duration_ms is None:
+                await asyncio.Event().wait()  # until gap_scan(None)
+            else:
+                await asyncio.sleep(duration_ms / 1000)
+        finally:
+            await scanner.stop()
+            self._scan_task = None
+            self._emit(_IRQ_SCAN_DONE, (0,))
+
+    def gap_connect(self, addr_type, addr=None, *args):
+        if addr is None:
+            if self._connect_task is not None:
+                self._connect_task.cancel()
+                self._connect_task = None
+            return
+        if self._connect_task is not None:
+            raise OSError(114)  # EALREADY: one pending connect, as the controller
+        self._connect_task = self._spawn(self._connect(addr_type, bytes(addr)))
+
+    async def _connect(self, addr_type, mac):
+        self._next_conn += 1
+        conn = self._next_conn
+
+        def lost(client):
+            if self._conns.pop(conn, None) is not None:
+                self._emit(_IRQ_PERIPHERAL_DISCONNECT, (conn, addr_type, mac))
+
+        kwargs = {"adapter": self.adapter} if self.adapter else {}
+        client = BleakClient(_address(mac), disconnected_callback=lost, timeout=self.connect_timeout, **kwargs)
+        try:
+            await client.connect()
+        except Exception:
+            self._connect_task = None  # free for the next gap_connect()
+            self._emit(_IRQ_PERIPHERAL_DISCONNECT, (_NO_CONN, addr_type, mac))
+            raise
+        finally:
+            self._connect_task = None
+        self._conns[conn] = _Connection(conn, mac, client)
+        self._emit(_IRQ_PERIPHERAL_CONNECT, (conn, addr_type, mac))
+
+    def gap_disconnect(self, conn):
+        c = self._conns.get(conn)
+        if c is None:
+            return False
+        self._spawn(c.client.disconnect())
+        return True
+
+    # -- GATT client ----------------------------------------------------------
+
+    def gattc_discover_services(self, conn, uuid=None):
+        c = self._conn(conn)
+        self._spawn(self._discover(c, _IRQ_GATTC_SERVICE_RESULT, _IRQ_GATTC_SERVICE_DONE, self._services, c))
+
+    def gattc_discover_characteristics(self, conn, start, end, uuid=None):
+        c = self._conn(conn)
+        self._spawn(self._discover(c, _IRQ_GATTC_CHARACTERISTIC_RESULT, _IRQ_GATTC_CHARACTERISTIC_DONE,
+                                   self._characteristics, c, start, end))
+
+    def gattc_discover_descriptors(self, conn, start, end):
+        c = self._conn(conn)
+        self._spawn(self._discover(c, _IRQ_GATTC_DESCRIPTOR_RESULT, _IRQ_GATTC_DESCRIPTOR_DONE,
+                                   self._descriptors, c, start, end))
+
+    async def _discover(self, c, result, done, items, *args):
+        # bleak resolved the whole table on connect; replay the part asked for
+        status = 0
+        try:
+            for item in items(*args):
+                self._emit(result, (c.conn,) + item)
+        except Exception as e:
+            log.warning("bleak discovery failed: %s", e)
+            status = _STATUS_ERROR
+        self._emit(done, (c.conn, status))
+
+    def _services(self, c):
+        for service in c.client.services:
+            handles = [service.handle]
+            for char in service.characteristics:
+                handles.append(char.handle)
+                handles.extend(d.handle for d in char.descriptors)
+            yield service.handle, max(handles), _uuid(service.uuid)
+
+    def _characteristics(self, c, start, end):
+        for service in c.client.services:
+            for char in service.characteristics:
+                if start <= char.handle <= end:
+                    props = 0
+                    for p in char.properties:
+                        props |= _PROPS.get(p, 0)
+                    c.chars[char.handle] = char
+                    yield char.handle - 1, char.handle, props, _uuid(char.uuid)
+
+    def _descriptors(self, c, start, end):
+        for service in c.client.services:
+            for char in service.characteristics:
+                for d in char.descriptors:
+                    if start <= d.handle <= end:
+                        uuid = _uuid(d.uuid)
+                        if uuid == _CCCD:
+                            c.cccds[d.handle] = char.handle
+                            c.chars[char.handle] = char
+                        yield d.handle, uuid
+
+    def _cccd_of(self, c, handle):
+        # Value handle of the characteristic whose CCCD is handle, or None;
+        # looked up in the services bleak resolved when not discovered
+        value = c.cccds.get(handle)
+        if value is None:
+            services = c.client.services
+            d = services.get_descriptor(handle)
+            if d is None or _uuid(d.uuid) != _CCCD:
+                return None
+            value = d.characteristic_handle
+            c.cccds[handle] = value
+            c.chars[value] = services.get_characteristic(value)
+        return value
+
+    def gattc_read(self, conn, handle):
+        self._spawn(self._read(self._conn(conn), handle))
+
+    async def _read(self, c, handle):
+        status = 0
+        try:
+            data = await c.client.read_gatt_char(handle)
+            self._emit(_IRQ_GATTC_READ_RESULT, (c.conn, handle, bytes(data)))
+        except Exception as e:
+            log.warning("bleak read failed: %s", e)
+            status = _STATUS_ERROR
+        self._emit(_IRQ_GATTC_READ_DONE, (c.conn, handle, status))
+
+    def gattc_write(self, conn, handle, data, mode=0):
+        self._spawn(self._write(self._conn(conn), handle, bytes(data), mode))
+
+    async def _write(self, c, handle, data, mode):
+        status = 0
+        try:
+            value = self._cccd_of(c, handle)
+            if value is not None:
+                await self._subscribe(c, value, data[0] & 0x03 != 0)
+            else:
+                await c.client.write_gatt_char(handle, data, response=mode == 1)
+        except Exception as e:
+            log.warning("bleak write failed: %s", e)
+            status = _STATUS_ERROR
+        if mode == 1:
+            self._emit(_IRQ_GATTC_WRITE_DONE, (c.conn, handle, status))
+
+    async def _subscribe(self, c, handle, on):
+        if on and handle not in c.notifying:
+            conn = c.conn
+            await c.client.start_notify(c.chars[handle], lambda sender, data: self._emit(
+                _IRQ_GATTC_NOTIFY, (conn, handle, bytes(data))))
+            c.notifying.add(handle)
+        elif not on and handle in c.notifying:
+            await c.client.stop_notify(c.chars[handle])
+            c.notifying.discard(handle)
+
+    def gattc_exchange_mtu(self, conn):
+        # BlueZ negotiates the MTU itself on connect; report the result
+        c = self._conn(conn)
+        self._emit(_IRQ_MTU_EXCHANGED, (conn, c.client.mtu_size))
@@ -0,0 +1,729 @@
+# BLE central for one or more Berger BMS units.
+#
+# Every battery is a BmsLink holding its own connection state, GATT
+# handles, frame reassembler, decoder and counters. Central owns the BLE
+# IRQ: it routes raw events to the right link by connection handle,
+# queues them through evq and runs the per-link GAP/GATT state machine in
+# the consumer task. A scheduler (or the supervisor, through recover()
+# and reconnect()) keeps up to max_connections links open,
+# connecting one at a time (the controller allows a single pending
+# connection) and rescanning while any battery is missing.
+#
+# Nothing here imports ubluetooth: the BLE object and UUIDs are passed
+# in, so the same code runs against a fake BLE on the host.
+
+import berger
+import log
+import scanfilter
+from array import array
+from binascii import hexlify
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+from compat import ticks_ms, ticks_us, ticks_diff
+
+# BLE IRQ event codes
+_IRQ_CENTRAL_CONNECT = const(1)
+_IRQ_CENTRAL_DISCONNECT = const(2)
+_IRQ_SCAN_RESULT = const(5)
+_IRQ_SCAN_DONE = const(6)
+_IRQ_PERIPHERAL_CONNECT = const(7)
+_IRQ_PERIPHERAL_DISCONNECT = const(8)
+_IRQ_GATTC_SERVICE_RESULT = const(9)
+_IRQ_GATTC_SERVICE_DONE = const(10)
+_IRQ_GATTC_CHARACTERISTIC_RESULT = const(11)
+_IRQ_GATTC_CHARACTERISTIC_DONE = const(12)
+_IRQ_GATTC_DESCRIPTOR_RESULT = const(13)
+_IRQ_GATTC_DESCRIPTOR_DONE = const(14)
+_IRQ_GATTC_READ_RESULT = const(15)
+_IRQ_GATTC_READ_DONE = const(16)
+_IRQ_GATTC_WRITE_DONE = const(17)
+_IRQ_GATTC_NOTIFY = const(18)
+_IRQ_MTU_EXCHANGED = const(21)
+_IRQ_CONNECTION_UPDATE = const(27)
+
+_FLAG_NOTIFY = const(0x10)
+
+SERVICE_UUID_16 = const(0xfff0)
+CHARACTERISTIC_UUID_16 = const(0xfff6)
+CCCD_UUID_16 = const(0x2902)
+
+# Link states
+IDLE = const(0)
+CONNECTING = const(1)
+DISCOVERING = const(2)
+SUBSCRIBING = const(3)
+STREAMING = const(4)
+
+CONNECT_TIMEOUT_MS = const(10000)
+
+# ATT MTU asked for on every connection. A Berger status frame is at most
+# berger.MAX_FRAME (118) bytes, so from MTU 121 on it arrives in one
+# notification or read instead of 20-byte pieces; 247 fills one LE data
+# packet. Peripherals that do not answer get MTU_TIMEOUT_MS, then setup
+# goes on with the default of 23.
+MTU = const(247)
+DEFAULT_MTU = const(23)
+MTU_TIMEOUT_MS = const(1000)
+# Events per connection the BLE event buffer (rxbuf) holds at the MTU
+RXBUF_EVENTS = const(4)
+
+# Connection parameter profiles: FAST while connecting, discovering and
+# reading, RELAXED while notifications stream in. Each is (min and max
+# connection interval in us, peripheral latency in intervals, supervision
+# timeout in ms). Parameters matching neither count as OTHER.
+FAST = const(0)
+RELAXED = const(1)
+OTHER = const(2)
+PROFILE_NAMES = ("fast", "relaxed", "other")
+PROFILES = ((7500, 30000, 0, 4000), (100000, 200000, 4, 6000))
+# Requests of the wanted profile per connection before keeping what the
+# peripheral insists on
+MAX_PARAM_REQUESTS = const(3)
+
+
+class BmsLink:
+    """State of one battery: connection, handles, frames and counters."""
+
+    def __init__(self, name, mac, topic):
+        self.name = name
+        self.mac = mac
+        self.topic = topic
+        self.state = IDLE
+        self.conn = None
+        self.addr_type = 0
+        self.char_handle = None
+        self.char_props = 0
+        self.cccd_handle = None
+        self.service_range = None
+        self.handles_cached = False
+        self.assembler = berger.Assembler()
+        self.decoder = berger.Decoder()
+        self.connect_t0 = None
+        self.first_frame_ms = {"cached": None, "discovered": None}
+        self.connects = 0
+        self.disconnects = 0
+        # Time from a disconnect to the next decoded frame
+        self.down_t0 = None
+        self.recover_ms = None
+        self.max_recover_ms = 0
+        # Connection parameters: profile asked for, profile and values in
+        # effect (interval in 1.25 ms units, supervision timeout in 10 ms)
+        self.want_profile = FAST
+        self.profile = OTHER
+        self.conn_params = None
+        self.param_requests = 0
+        self.chunk_t0 = None  # first notification of the frame being filled
+        self.mtu = DEFAULT_MTU
+        self.truncated_reads = 0  # reads that ended inside a frame
+        # Set by the application, e.g. the outbox and flash log of this battery
+        self.telemetry = None
+        self.history = None
+        self.packer = None
+        self.aggregate = None
+
+    @property
+    def notifying(self):
+        # Only with a CCCD to enable them; otherwise poll() reads
+        return self.state == STREAMING and self.cccd_handle is not None and bool(self.char_props & _FLAG_NOTIFY)
+
+    def stats(self):
+        a = self.assembler
+        d = self.decoder
+        return (f"{self.name} state={self.state} frames={d.frames} errors={d.errors} "
+                f"dropped_bytes={a.dropped_bytes} resyncs={a.resyncs} connects={self.connects} "
+                f"first_frame_ms={self.first_frame_ms} recover_ms={self.recover_ms} max_recover_ms={self.max_recover_ms} "
+                f"profile={PROFILE_NAMES[self.profile]} conn_params={self.conn_params} mtu={self.mtu} "
+                f"truncated_reads={self.truncated_reads}")
+
+
+class Central:
+    """Keeps up to max_connections BmsLinks connected and streaming.
+
+        central = Central(ble, links, events, cache, uuids)
+        central.on_frame = lambda link: ...   # decoded frame in link.decoder
+        central.on_debug = lambda msg: ...
+        central.start()
+        asyncio.create_task(central.run())    # IRQ queue consumer
+        asyncio.create_task(central.schedule())
+    """
+
+    def __init__(self, ble, links, events, cache, uuids, max_connections=3,
+                 scan_ms=10000, rescan_ms=15000, poll_request=berger.STATUS_REQUEST, min_rssi=-100,
+                 profiles=PROFILES, mtu=MTU):
+        self.ble = ble
+        self.links = links
+        self.events = events
+        self.cache = cache
+        self.service_uuid, self.char_uuid, self.cccd_uuid = uuids
+        self.max_connections = max_connections
+        self.scan_ms = scan_ms
+        self.rescan_ms = rescan_ms
+        self.poll_request = poll_request
+        self.on_frame = None
+        self.on_debug = None
+        # Optional callable(link, frame bytes) decoding elsewhere (gateway.py
+        # uses a process pool); it fills link.decoder and calls decoded().
+        self.offload = None
+        self._by_conn = {}
+        self._pending = None  # link with a gap_connect() in flight
+        self._pending_t0 = 0
+        self._scanning = False
+        # IRQs per event code, and optional metrics.Histograms of decode
+        # time and of the time from the IRQ completing a frame to on_frame.
+        self.irq_events = array('L', [0] * 32)
+        self.decode_us = None
+        self.frame_latency_us = None
+        # Connection parameters. The central sets them on connect through
+        # gap_connect()'s interval arguments; backends with
+        # gap_update_params(conn, min_us, max_us, latency, timeout_ms)
+        # also switch live (MicroPython has no such call: there the
+        # profile holds until the next connect). Per profile: connection
+        # updates seen, notifications, frames and optional
+        # metrics.Histograms of ms from a frame's first notification to
+        # its last.
+        self.profiles = profiles
+        self._update_params = getattr(ble, "gap_update_params", None)
+        self._connect_params = True
+        self.profile_updates = array('L', [0] * 3)
+        self.profile_chunks = array('L', [0] * 3)
+        self.profile_frames = array('L', [0] * 3)
+        self.frame_span_ms = [None, None, None]
+        # ATT MTU to negotiate after connecting; 0 keeps the default
+        self.mtu = mtu
+        # Scan results are filtered in the IRQ by advertising type, RSSI
+        # and MAC; links without a MAC bind to the first connectable
+        # device advertising service FFF0.
+        self.scan_filter = scanfilter.ScanFilter(min_rssi, SERVICE_UUID_16)
+        self._unbound = 0
+        for link in links:
+            if link.mac is None:
+                self._unbound += 1
+            else:
+                self.scan_filter.add_mac(link.mac)
+
+    # -- IRQ side: filter, feed reassemblers, queue -------------------------
+
+    def irq(self, event, data):
+        events = self.events
+        events.irq_begin()
+        if event < 32:
+            self.irq_events[event] += 1
+        if event == _IRQ_SCAN_RESULT:
+            addr_type, addr, adv_type, rssi, adv_data = data
+            if log.level <= log.DEBUG:
+                log.debug("scan %s type %d rssi %d adv %s", hexlify(addr), adv_type, rssi, hexlify(adv_data))
+            f = self.scan_filter
+            if f.accept(adv_type, rssi):
+                known = False
+                if f.maybe_known(addr):
+                    for i in range(len(self.links)):
+                        link = self.links[i]
+                        if link.mac == addr:  # bytes on the left: no copy
+                            known = True
+                            if link.conn is None:
+                                events.put(event, i, addr_type, rssi)
+                            break
+                if not known and self._unbound and f.is_candidate(adv_data):
+                    for i in range(len(self.links)):
+                        if self.links[i].mac is None:
+                            events.put(event, i, addr_type, rssi, 0, addr)
+                            break
+        elif event == _IRQ_GATTC_NOTIFY or event == _IRQ_GATTC_READ_RESULT:
+            conn, value_handle, char_data = data
+            link = self._by_conn.get(conn)
+            if link is not None and value_handle == link.char_handle:
+                now = ticks_ms()
+                self.profile_chunks[link.profile] += 1
+                if link.chunk_t0 is None:
+                    link.chunk_t0 = now
+                if link.assembler.feed(char_data):
+                    events.put(event, conn, value_handle, ticks_diff(now, link.chunk_t0))
+                    link.chunk_t0 = now if link.assembler.filling() else None
+        elif event == _IRQ_PERIPHERAL_CONNECT or event == _IRQ_CENTRAL_CONNECT:
+            conn, addr_type, addr = data
+            events.put(event, conn, addr_type, 0, 0, addr)
+        elif event == _IRQ_PERIPHERAL_DISCONNECT or event == _IRQ_CENTRAL_DISCONNECT:
+            conn, addr_type, addr = data
+            link = self._by_conn.get(conn)
+            if link is not None:
+                link.assembler.reset()
+                link.chunk_t0 = None
+            events.put(event, conn, addr_type, 0, 0, addr)
+        elif event == _IRQ_GATTC_SERVICE_RESULT:
+            conn, start_handle, end_handle, uuid = data
+            if uuid == self.service_uuid:
+                events.put(event, conn, start_handle, end_handle)
+        elif event == _IRQ_GATTC_CHARACTERISTIC_RESULT:
+            conn, def_handle, value_handle, properties, uuid = data
+            if uuid == self.char_uuid:
+                events.put(event, conn, def_handle, value_handle, properties)
+        elif event == _IRQ_GATTC_DESCRIPTOR_RESULT:
+            conn, dsc_handle, uuid = data
+            if uuid == self.cccd_uuid:
+                events.put(event, conn, dsc_handle)
+        elif event == _IRQ_GATTC_WRITE_DONE:
+            conn, value_handle, status = data
+            events.put(event, conn, value_handle, status)
+        elif event == _IRQ_MTU_EXCHANGED:
+            conn, mtu = data
+            events.put(event, conn, mtu)
+        elif event == _IRQ_CONNECTION_UPDATE:
+            conn, conn_interval, conn_latency, supervision_timeout, status = data
+            events.put(event, conn, conn_interval, conn_latency, supervision_timeout)
+        elif event == _IRQ_SCAN_DONE:
+            events.put(event)
+        elif (event == _IRQ_GATTC_SERVICE_DONE or event == _IRQ_GATTC_CHARACTERISTIC_DONE
+              or event == _IRQ_GATTC_DESCRIPTOR_DONE or event == _IRQ_GATTC_READ_DONE):
+            events.put(event, data[0], data[-1])  # conn_handle, status
+        events.irq_end()
+
+    # -- consumer side ------------------------------------------------------
+
+    def start(self):
+        if self.mtu:
+            self._configure_mtu()
+        self.ble.irq(self.irq)
+        self.scan()
+
+    def _configure_mtu(self):
+        # The MTU offered in exchanges, and an event buffer that holds a
+        # few full-size values per connection
+        ble = self.ble
+        rxbuf = self.max_connections * RXBUF_EVENTS * (self.mtu + 8)
+        try:
+            ble.config(mtu=self.mtu)
+            current = ble.config("rxbuf")
+            if current is not None and current < rxbuf:
+                ble.config(rxbuf=rxbuf)
+        except (OSError, ValueError, TypeError) as e:
+            log.warning("BLE MTU %d / rxbuf %d not configured: %s", self.mtu, rxbuf, e)
+
+    async def run(self):
+        events = self.events
+        while True:
+            await events.wait()
+            event = events.get()
+            while event >= 0:
+                try:
+                    self.handle(event)
+                except Exception as e:
+                    log.error("Error handling BLE event %d: %s", event, e)
+                events.release()
+                event = events.get()
+
+    async def schedule(self):
+        # Fixed-interval recovery for setups without a supervisor.
+        while True:
+            await asyncio.sleep_ms(self.rescan_ms)
+            self.recover()
+
+    def _connect_failed(self, addr):
+        # gap_connect() gave up (conn 0xFFFF on the ESP32): free the slot and
+        # scan again instead of waiting for CONNECT_TIMEOUT_MS
+        link = self._pending
+        if link is None or link.mac != addr:
+            return
+        self._pending = None
+        link.state = IDLE
+        link.connect_t0 = None
+        self._debug(f"{link.name}: connect failed")
+        self.scan()
+
+    def recover(self):
+        # Expire a stuck connect and rescan while batteries are missing.
+        if self._pending is not None and ticks_diff(ticks_ms(), self._pending_t0) > CONNECT_TIMEOUT_MS:
+            self._debug(f"{self._pending.name}: connect timed out")
+            self._pending.state = IDLE
+            self._pending = None
+            try:
+                self.ble.gap_connect(None)  # cancel
+            except OSError:
+                pass
+        self.scan()
+
+    async def reconnect(self):
+        # One recovery attempt for the supervisor: scan and wait until every
+        # battery is back or the scan and a connect have had their time.
+        self.recover()
+        t0 = ticks_ms()
+        while self.missing() and ticks_diff(ticks_ms(), t0) < self.scan_ms + CONNECT_TIMEOUT_MS:
+            if not self._scanning and self._pending is None:
+                break  # scan finished without finding the rest
+            await asyncio.sleep_ms(100)
+        return not self.missing()
+
+    def up(self):
+        # Every battery connected, or as many as the controller allows.
+        return not self.missing() or self.connected() >= self.max_connections
+
+    def connected(self):
+        return len(self._by_conn)
+
+    def missing(self):
+        for link in self.links:
+            if link.conn is None and link.state == IDLE:
+                return True
+        return False
+
+    def scan(self):
+        if self._scanning or self._pending is not None:
+            return
+        if not self.missing() or self.connected() >= self.max_connections:
+            return
+        self._scanning = True
+        self.ble.gap_scan(self.scan_ms, 30000, 30000)
+
+    def _stop_scan(self):
+        if self._scanning:
+            self._scanning = False
+            self.ble.gap_scan(None)
+
+    def _debug(self, msg):
+        log.info(msg)
+        if self.on_debug:
+            self.on_debug(msg)
+
+    def poll(self):
+        # Status request on every streaming link (none with poll_request
+        # None); without notify support the characteristic is read back.
+        for link in self.links:
+            if link.state != STREAMING:
+                continue
+            try:
+                if self.poll_request is not None:
+                    self.ble.gattc_write(link.conn, link.char_handle, self.poll_request, 0)
+                if not link.notifying:
+                    self.ble.gattc_read(link.conn, link.char_handle)
+            except OSError as e:
+                log.warning("%s: poll failed: %s", link.name, e)
+
+    def disconnect(self, link):
+        if link.conn is not None:
+            self.ble.gap_disconnect(link.conn)
+
+    def _exchange_mtu(self, link):
+        # Starts the exchange; False if there is none to wait for
+        exchange = getattr(self.ble, "gattc_exchange_mtu", None)
+        if not self.mtu or exchange is None:
+            return False
+        try:
+            exchange(link.conn)
+        except OSError as e:
+            log.warning("%s: MTU exchange failed: %s", link.name, e)
+            return False
+        asyncio.create_task(self._mtu_timeout(link, link.conn))
+        return True
+
+    async def _mtu_timeout(self, link, conn):
+        await asyncio.sleep_ms(MTU_TIMEOUT_MS)
+        if link.conn == conn and link.state == CONNECTING:
+            self._debug(f"{link.name}: no MTU exchange, using {link.mtu}")
+            self._setup(link)
+
+    def _setup(self, link):
+        cached = self.cache.get(link.mac, SERVICE_UUID_16, CHARACTERISTIC_UUID_16)
+        if cached:
+            link.char_handle = cached["value"]
+            link.char_props = cached.get("props", 0)
+            link.cccd_handle = cached.get("cccd")
+            link.handles_cached = True
+            self._start_streaming(link)  # Use the cached handles right away
+        else:
+            self._discover(link)
+
+    def _discover(self, link):
+        link.char_handle = None
+        link.cccd_handle = None
+        link.service_range = None
+        link.handles_cached = False
+        link.state = DISCOVERING
+        self.ble.gattc_discover_services(link.conn)
+
+    def _start_streaming(self, link):
+        # Enable notifications through the CCCD; without notify support
+        # fall back to reading the characteristic (repeated by poll()).
+        if link.cccd_handle is not None and link.char_props & _FLAG_NOTIFY:
+            link.state = SUBSCRIBING
+            self.ble.gattc_write(link.conn, link.cccd_handle, b"\x01\x00", 1)
+        else:
+            link.state = STREAMING
+            self.ble.gattc_read(link.conn, link.char_handle)
+
+    def _rediscover(self, link, reason):
+        self._debug(f"{link.name}: cached handles failed ({reason}), rediscovering")
+        self.cache.invalidate(link.mac, SERVICE_UUID_16, CHARACTERISTIC_UUID_16)
+        self._request_profile(link, FAST)
+        self._discover(link)
+
+    def _connect(self, link):
+        # With cached handles only the CCCD write is left before streaming,
+        # so connect relaxed right away; otherwise fast for discovery.
+        cached = self.cache.get(link.mac, SERVICE_UUID_16, CHARACTERISTIC_UUID_16)
+        notify = cached and cached.get("cccd") is not None and cached.get("props", 0) & _FLAG_NOTIFY
+        profile = RELAXED if notify else FAST
+        link.want_profile = profile
+        link.profile = OTHER
+        if self._connect_params:
+            lo, hi, _, _ = self.profiles[profile]
+            try:
+                self.ble.gap_connect(link.addr_type, link.mac, 2000, lo, hi)
+                link.profile = profile
+                return
+            except TypeError:
+                # Port without interval arguments: controller defaults
+                self._connect_params = False
+                link.want_profile = OTHER
+        self.ble.gap_connect(link.addr_type, link.mac)
+
+    def _request_profile(self, link, profile):
+        link.want_profile = profile
+        if link.profile == profile or self._update_params is None or link.conn is None:
+            return
+        if link.param_requests >= MAX_PARAM_REQUESTS:
+            return
+        lo, hi, latency, timeout_ms = self.profiles[profile]
+        link.param_requests += 1
+        try:
+            self._update_params(link.conn, lo, hi, latency, timeout_ms)
+        except OSError as e:
+            log.warning("%s: connection parameter request failed: %s", link.name, e)
+
+    def _profile_of(self, interval, latency):
+        us = interval * 1250
+        for i in range(len(self.profiles)):
+            lo, hi, max_latency, _ = self.profiles[i]
+            if lo <= us <= hi and latency <= max_latency:
+                return i
+        return OTHER
+
+    def profile_stats(self):
+        # {profile: [connection updates, notifications, frames]}
+        d = {}
+        for i in range(3):
+            if self.profile_updates[i] or self.profile_chunks[i] or self.profile_frames[i]:
+                d[PROFILE_NAMES[i]] = [self.profile_updates[i], self.profile_chunks[i], self.profile_frames[i]]
+        return d
+
+    def _cache_handles(self, link):
+        self.cache.put(link.mac, SERVICE_UUID_16, CHARACTERISTIC_UUID_16, value=link.char_handle,
+                       props=link.char_props, cccd=link.cccd_handle)
+
+    def _find_addr(self, addr):
+        for link in self.links:
+            if link.mac == addr:
+                return link
+        return None
+
+    def handle(self, event):
+        events = self.events
+
+        if event == _IRQ_SCAN_RESULT:
+            link = self.links[events.arg(0)]
+            if link.conn is not None or self._pending is not None:
+                return
+            if link.mac is None:
+                mac = bytes(events.data())
+                if self._find_addr(mac) is not None:
+                    return  # already bound to another battery
+                link.mac = mac
+                self.scan_filter.add_mac(mac)
+                self._unbound -= 1
+                self._debug(f"{link.name}: bound to {hexlify(mac).decode()}")
+            self._stop_scan()
+            link.state = CONNECTING
+            link.addr_type = events.arg(1)
+            link.connect_t0 = self._pending_t0 = ticks_ms()
+            self._pending = link
+            self._connect(link)
+            self._debug(f"{link.name}: found, connecting")
+            return
+
+        if event == _IRQ_SCAN_DONE:
+            self._scanning = False
+            return
+
+        conn = events.arg(0)
+
+        if event == _IRQ_PERIPHERAL_CONNECT or event == _IRQ_CENTRAL_CONNECT:
+            link = self._find_addr(bytes(events.data()))
+            if link is None:
+                self.ble.gap_disconnect(conn)
+                return
+            if link is self._pending:
+                self._pending = None
+            link.conn = conn
+            link.connects += 1
+            link.param_requests = 0
+            link.conn_params = None
+            self._by_conn[conn] = link
+            link.mtu = DEFAULT_MTU
+            self._debug(f"{link.name}: connected")
+            # The MTU first: nothing else is in flight on the link yet, and
+            # every later read and notification can use it
+            if not self._exchange_mtu(link):
+                self._setup(link)
+            self.scan()  # look for the next missing battery
+            return
+
+        link = self._by_conn.get(conn)
+        if link is None:
+            if event == _IRQ_PERIPHERAL_DISCONNECT:
+                self._connect_failed(bytes(events.data()))
+            return
+
+        if event == _IRQ_PERIPHERAL_DISCONNECT or event == _IRQ_CENTRAL_DISCONNECT:
+            del self._by_conn[conn]
+            link.conn = None
+            link.char_handle = None
+            link.state = IDLE
+            link.disconnects += 1
+            link.down_t0 = ticks_ms()
+            self._debug(f"{link.name}: disconnected")
+            self.scan()
+
+        elif event == _IRQ_GATTC_SERVICE_RESULT:
+            link.service_range = (events.arg(1), events.arg(2))
+
+        elif event == _IRQ_GATTC_SERVICE_DONE:
+            if link.service_range:
+                self.ble.gattc_discover_characteristics(conn, link.service_range[0], link.service_range[1])
+            else:
+                self._debug(f"{link.name}: service FFF0 not found")
+
+        elif event == _IRQ_GATTC_CHARACTERISTIC_RESULT:
+            link.char_handle = events.arg(2)
+            link.char_props = events.arg(3)
+
+        elif event == _IRQ_GATTC_CHARACTERISTIC_DONE:
+            if link.char_handle is None:
+                self._debug(f"{link.name}: characteristic FFF6 not found")
+            elif link.char_props & _FLAG_NOTIFY:
+                # The CCCD follows the value handle within the service.
+                self.ble.gattc_discover_descriptors(conn, link.char_handle + 1, link.service_range[1])
+            else:
+                self._cache_handles(link)
+                self._start_streaming(link)
+
+        elif event == _IRQ_GATTC_DESCRIPTOR_RESULT:
+            if link.cccd_handle is None:
+                link.cccd_handle = events.arg(1)
+
+        elif event == _IRQ_GATTC_DESCRIPTOR_DONE:
+            if link.cccd_handle is None:
+                self._debug(f"{link.name}: CCCD of FFF6 not found, reading instead")
+            self._cache_handles(link)
+            self._start_streaming(link)
+
+        elif event == _IRQ_GATTC_WRITE_DONE:
+            if events.arg(1) == link.cccd_handle and link.state == SUBSCRIBING:
+                if events.arg(2) == 0:
+                    link.state = STREAMING
+                    self._request_profile(link, RELAXED)
+                    if self.poll_request:
+                        self.ble.gattc_write(conn, link.char_handle, self.poll_request, 0)
+                elif link.handles_cached:
+                    self._rediscover(link, f"CCCD write status {events.arg(2)}")
+                else:
+                    self._debug(f"{link.name}: enabling notifications failed with status {events.arg(2)}")
+
+        elif event == _IRQ_GATTC_NOTIFY or event == _IRQ_GATTC_READ_RESULT:
+            span = self.frame_span_ms[link.profile]
+            if span is not None and event == _IRQ_GATTC_NOTIFY:
+                span.observe(events.arg(2))
+            self._frames(link)
+
+        elif event == _IRQ_GATTC_READ_DONE:
+            if events.arg(1) != 0 and link.handles_cached:
+                self._rediscover(link, f"read status {events.arg(1)}")
+            elif link.assembler.filling():
+                # The value did not fit the read (MTU too small); the next
+                # read starts over at ':'
+                link.assembler.reset()
+                link.chunk_t0 = None
+                link.truncated_reads += 1
+                if link.truncated_reads == 1:
+                    self._debug(f"{link.name}: frame longer than a read at MTU {link.mtu}")
+
+        elif event == _IRQ_MTU_EXCHANGED:
+            link.mtu = events.arg(1)
+            self._debug(f"{link.name}: MTU {link.mtu}")
+            if link.state == CONNECTING:
+                self._setup(link)
+
+        elif event == _IRQ_CONNECTION_UPDATE:
+            self._connection_update(link, events.arg(1), events.arg(2), events.arg(3))
+
+    def _frames(self, link):
+        assembler = link.assembler
+        n = assembler.pending()
+        while n:
+            if self.offload is not None:
+                self.offload(link, bytes(assembler.frame()[:n]))
+                assembler.release()
+            else:
+                t0 = ticks_us()
+                rc = link.decoder.decode(assembler.frame(), n)
+                if self.decode_us is not None:
+                    self.decode_us.since_us(t0)
+                assembler.release()
+                if rc == berger.OK and self.frame_latency_us is not None:
+                    self.frame_latency_us.since_us(self.events.time())
+                self.decoded(link, rc)
+            n = assembler.pending()
+
+    def decoded(self, link, rc):
+        # A frame is in link.decoder (rc from decode()): bookkeeping, on_frame
+        if rc != berger.OK:
+            log.warning("%s: invalid Berger frame, error %d", link.name, rc)
+            return
+        if link.connect_t0 is not None:
+            path = "cached" if link.handles_cached else "discovered"
+            link.first_frame_ms[path] = ticks_diff(ticks_ms(), link.connect_t0)
+            link.connect_t0 = None
+            self._debug(f"{link.name}: first frame after {link.first_frame_ms[path]} ms ({path} handles)")
+        if link.down_t0 is not None:
+            link.recover_ms = ticks_diff(ticks_ms(), link.down_t0)
+            link.down_t0 = None
+            if link.recover_ms > link.max_recover_ms:
+                link.max_recover_ms = link.recover_ms
+        self.profile_frames[link.profile] += 1
+        if self.on_frame:
+            self.on_frame(link)
+
+    def _connection_update(self, link, conn_interval, conn_latency, supervision_timeout):
+        # Sanity bounds of the spec
+        MIN_CONN_INTERVAL = 6  # 7.5ms
+        MAX_CONN_INTERVAL = 3200  # 4s
+        MAX_CONN_LATENCY = 499  # 499 intervals
+        MAX_SUPERVISION_TIMEOUT = 3200  # 32s
+
+        log.debug("%s: connection updated: interval=%d, latency=%d, timeout=%d", link.name, conn_interval, conn_latency, supervision_timeout)
+        link.conn_params = (conn_interval, conn_latency, supervision_timeout)
+        link.profile = self._profile_of(conn_interval, conn_latency)
+        self.profile_updates[link.profile] += 1
+        if not (MIN_CONN_INTERVAL <= conn_interval <= MAX_CONN_INTERVAL and
+                conn_latency <= MAX_CONN_LATENCY and
+                supervision_timeout <= MAX_SUPERVISION_TIMEOUT):
+            self._debug(f"{link.name}: connection parameters outside acceptable range")
+        if link.profile == link.want_profile or link.want_profile == OTHER:
+            link.param_requests = 0
+            return
+        # The peripheral (or controller) chose something else: ask again a
+        # few times, then keep the link as it is. Tearing it down costs a
+        # reconnect and a rescan; if it really fails the supervision
+        # timeout drops it.
+        if link.param_requests >= MAX_PARAM_REQUESTS or self._update_params is None:
+            self._debug(f"{link.name}: keeping connection parameters {link.conn_params} "
+                        f"instead of {PROFILE_NAMES[link.want_profile]}")
+            return
+        self._request_profile(link, link.want_profile)
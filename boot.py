@@ -0,0 +1,16 @@
+# Runs before main.py: completes an interrupted OTA switch and rolls back
+# a new version that keeps failing before it is confirmed (otaupdate.py).
+# /ota/state only exists while an update is in progress; otaupdate is not
+# imported otherwise.
+import os
+
+try:
+    os.stat("/ota/state")
+except OSError:
+    pass
+else:
+    try:
+        import otaupdate
+        otaupdate.boot_check()
+    except Exception as e:
+        print("OTA boot check failed:", e)
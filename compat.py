@@ -0,0 +1,53 @@
+# What differs between MicroPython ports and CPython, kept in one place.
+#
+# ticks_ms(), ticks_us(), ticks_diff(): MicroPython's time extensions, on
+# CPython from the monotonic clock (without the wrap-around, so
+# ticks_diff() is a plain difference).
+#
+# compact_json(obj): json.dumps() without the blanks after ',' and ':';
+# older MicroPython json.dumps() takes no separators but is compact anyway.
+#
+# unix_time(): time.time() counts from 2000-01-01 on the ESP32 port and
+# from 1970-01-01 on CPython and the unix port. Every timestamp that leaves
+# the device - packed payloads, JSON snapshots and summaries, flash log
+# records - is unix time, so they all take it from here.
+
+import json
+import time
+
+try:
+    from time import ticks_ms, ticks_us, ticks_diff
+except ImportError:
+    from time import monotonic, perf_counter_ns
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_us():
+        return perf_counter_ns() // 1000
+
+    def ticks_diff(a, b):
+        return a - b
+
+try:
+    json.dumps({}, separators=(',', ':'))
+    _SEPARATORS = True
+except TypeError:
+    _SEPARATORS = False
+
+
+def compact_json(obj):
+    return json.dumps(obj, separators=(',', ':')) if _SEPARATORS else json.dumps(obj)
+
+
+try:
+    _EPOCH_YEAR = time.gmtime(0)[0]
+except AttributeError:
+    _EPOCH_YEAR = time.localtime(0)[0]  # older MicroPython: no gmtime()
+
+# Seconds from 1970-01-01 to the epoch of time.time()
+EPOCH_OFFSET = 946684800 if _EPOCH_YEAR == 2000 else 0
+
+
+def unix_time():
+    return int(time.time()) + EPOCH_OFFSET
@@ -0,0 +1,151 @@
+# Duty-cycled operation for parked vehicles.
+#
+# Instead of keeping WiFi, TLS and the BLE scan up all the time, each
+# cycle wakes from deep sleep, connects to the batteries (with the cached
+# GATT handles, so no discovery), collects a few frames into the flash
+# log and goes back to deep sleep. Only every flush_every cycles are WiFi
+# and MQTT brought up to replay the stored frames in one batch.
+#
+# The cycle counter and per-phase timing totals survive deep sleep in RTC
+# memory. Awake time is split into phases (boot, ble, net); multiplied by
+# typical currents per phase this gives the charge and energy estimates
+# reported with every flush. The currents are rough ESP32 figures and can
+# be replaced by measured ones.
+
+import struct
+
+from compat import ticks_ms, ticks_diff
+
+try:
+    import machine
+except ImportError:
+    machine = None
+
+PHASES = ("boot", "ble", "net")
+
+# Supply current [mA] while in each phase, and in deep sleep
+CURRENTS_MA = {"boot": 45, "ble": 95, "net": 150, "sleep": 0.15}
+SUPPLY_V = 3.3
+
+# magic, cycle, cycles since report, sleep ms, first frame ms, then the
+# phase totals [ms] since the last report
+_MAGIC = b"DC01"
+_FMT = "<4sIIIIIII"
+
+_rtc_fallback = [None]  # stands in for RTC memory on the host
+
+
+def _rtc_read():
+    if machine is None:
+        return _rtc_fallback[0] or b""
+    return machine.RTC().memory()
+
+
+def _rtc_write(data):
+    if machine is None:
+        _rtc_fallback[0] = data
+    else:
+        machine.RTC().memory(data)
+
+
+class DutyCycle:
+    """Phase timing and persistent state of one wake cycle.
+
+        dc = DutyCycle(period_s=300, flush_every=12)
+        dc.phase("ble")            # boot ends here (ticks count from wake)
+        ... collect frames, dc.first_frame() on the first one ...
+        if dc.flush_due():
+            dc.phase("net")
+            ... connect, replay, publish dc.report() ...
+        dc.sleep()                 # saves state and deep-sleeps
+
+    t0 is the ticks_ms() value at wake; after a deep sleep reset that is 0.
+    """
+
+    def __init__(self, period_s, flush_every, currents=None, t0=0):
+        self.period_ms = period_s * 1000
+        self.flush_every = max(1, flush_every)
+        self.currents = currents or CURRENTS_MA
+        self._t = t0
+        self._phase = 0
+        self.first_frame_ms = 0
+        self._t0 = t0
+        self.cycle = 0
+        self.cycles = 0  # since the last report
+        self.sleep_ms = 0
+        self.totals = [0] * len(PHASES)
+        self.load()
+
+    def load(self):
+        data = _rtc_read()
+        if len(data) >= struct.calcsize(_FMT):
+            v = struct.unpack_from(_FMT, data)
+            if v[0] == _MAGIC:
+                self.cycle, self.cycles, self.sleep_ms, _ = v[1:5]
+                self.totals = list(v[5:])
+        self.cycle += 1
+        self.cycles += 1
+
+    def save(self):
+        _rtc_write(struct.pack(_FMT, _MAGIC, self.cycle, self.cycles, self.sleep_ms,
+                               self.first_frame_ms, *self.totals))
+
+    def phase(self, name):
+        # Closes the running phase and starts the named one.
+        now = ticks_ms()
+        self.totals[self._phase] += ticks_diff(now, self._t)
+        self._t = now
+        self._phase = PHASES.index(name)
+
+    def first_frame(self):
+        if not self.first_frame_ms:
+            self.first_frame_ms = ticks_diff(ticks_ms(), self._t0)
+
+    def awake_ms(self):
+        return ticks_diff(ticks_ms(), self._t0)
+
+    def flush_due(self):
+        return self.cycle % self.flush_every == 0
+
+    def estimate(self):
+        # (charge [mAh], energy [mWh], mean current [mA]) per cycle, from
+        # the totals since the last report
+        c = self.currents
+        n = self.cycles or 1
+        mas = self.sleep_ms * c["sleep"]
+        ms = self.sleep_ms
+        for i, name in enumerate(PHASES):
+            mas += self.totals[i] * c[name]
+            ms += self.totals[i]
+        mah = mas / 3600000 / n
+        return mah, mah * SUPPLY_V, mas / ms if ms else 0
+
+    def report(self):
+        # Per-cycle averages since the last report; resets the totals.
+        self.phase(PHASES[self._phase])
+        n = self.cycles or 1
+        mah, mwh, ma = self.estimate()
+        d = {"cycle": self.cycle, "cycles": self.cycles, "first_frame_ms": self.first_frame_ms}
+        for i, name in enumerate(PHASES):
+            d[name + "_ms"] = self.totals[i] // n
+        d["sleep_ms"] = self.sleep_ms // n
+        d["mAh"] = round(mah, 4)
+        d["mWh"] = round(mwh, 4)
+        d["mA"] = round(ma, 3)
+        self.cycles = 0
+        self.sleep_ms = 0
+        self.totals = [0] * len(PHASES)
+        return d
+
+    def sleep_for(self):
+        # Sleep for the rest of the period, at least a second.
+        return max(1000, self.period_ms - self.awake_ms())
+
+    def sleep(self):
+        self.phase(PHASES[self._phase])
+        ms = self.sleep_for()
+        self.sleep_ms += ms
+        self.save()
+        if machine is not None:
+            machine.deepsleep(ms)
+        return ms
@@ -0,0 +1,132 @@
+# Fixed-size event queue between the BLE IRQ and an asyncio task.
+#
+# The IRQ handler only copies the event code, a few integers and at most
+# one short buffer (an address, a chunk of data) into preallocated slots
+# and sets a ThreadSafeFlag. All real work - connecting, GATT discovery,
+# publishing - runs in the consumer task. Nothing here allocates after
+# construction, so put() is safe and cheap inside the IRQ.
+
+from array import array
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from compat import ticks_us, ticks_diff
+
+NARGS = 4
+
+
+class EventQueue:
+    """Single-producer, single-consumer ring of BLE events.
+
+    Producer (IRQ):   events.put(event, a, b, c, d, data)
+    Consumer (task):  await events.wait()
+                      ev = events.get()
+                      while ev >= 0:
+                          ... events.arg(0) ... events.data() ...
+                          events.release()
+                          ev = events.get()
+
+    When the ring is full the new event is dropped and counted in
+    overflows. Data longer than bufsize is truncated and counted in
+    truncated. irq_begin()/irq_end() bracket the IRQ handler and keep the
+    count, total and maximum time spent in it.
+    """
+
+    def __init__(self, size=32, bufsize=32):
+        self._size = size
+        self._bufsize = bufsize
+        self._events = array('B', [0] * size)
+        self._args = array('i', [0] * (size * NARGS))
+        self._lens = array('H', [0] * size)
+        self._times = array('L', [0] * size)  # ticks_us of irq_begin()
+        buf = memoryview(bytearray(size * bufsize))
+        self._bufs = [buf[i * bufsize:(i + 1) * bufsize] for i in range(size)]
+        self._put = 0
+        self._get = 0
+        if hasattr(asyncio, 'ThreadSafeFlag'):
+            self._flag = asyncio.ThreadSafeFlag()
+            self._event = None
+        else:
+            # CPython stand-in for host runs; put() then has to be called
+            # from the loop thread.
+            self._flag = self._event = asyncio.Event()
+        self.overflows = 0
+        self.truncated = 0
+        self.irq_count = 0
+        self.irq_total_us = 0
+        self.irq_max_us = 0
+        self.irq_hist = None  # optional metrics.Histogram of IRQ times
+        self._irq_t0 = 0
+
+    def put(self, event, a=0, b=0, c=0, d=0, data=None):
+        if self._put - self._get >= self._size:
+            self.overflows += 1
+            return False
+        i = self._put % self._size
+        self._events[i] = event
+        j = i * NARGS
+        args = self._args
+        args[j] = a
+        args[j + 1] = b
+        args[j + 2] = c
+        args[j + 3] = d
+        n = 0
+        if data is not None:
+            n = len(data)
+            if n > self._bufsize:
+                n = self._bufsize
+                self.truncated += 1
+            self._bufs[i][0:n] = data[0:n]
+        self._lens[i] = n
+        self._times[i] = self._irq_t0
+        self._put += 1
+        self._flag.set()
+        return True
+
+    def __len__(self):
+        return self._put - self._get
+
+    async def wait(self):
+        await self._flag.wait()
+        if self._event is not None:
+            self._event.clear()
+
+    def get(self):
+        # Event code of the oldest entry, -1 if the queue is empty.
+        if self._get == self._put:
+            return -1
+        return self._events[self._get % self._size]
+
+    def arg(self, k):
+        return self._args[(self._get % self._size) * NARGS + k]
+
+    def data(self):
+        i = self._get % self._size
+        return self._bufs[i][:self._lens[i]]
+
+    def time(self):
+        # ticks_us at which the oldest entry's IRQ started.
+        return self._times[self._get % self._size]
+
+    def release(self):
+        if self._get != self._put:
+            self._get += 1
+
+    def irq_begin(self):
+        self._irq_t0 = ticks_us()
+
+    def irq_end(self):
+        dt = ticks_diff(ticks_us(), self._irq_t0)
+        self.irq_count += 1
+        self.irq_total_us += dt
+        if dt > self.irq_max_us:
+            self.irq_max_us = dt
+        if self.irq_hist is not None:
+            self.irq_hist.observe(dt)
+
+    def stats(self):
+        avg = self.irq_total_us // self.irq_count if self.irq_count else 0
+        return f"irq n={self.irq_count} avg_us={avg} max_us={self.irq_max_us} queued={len(self)} overflows={self.overflows}"
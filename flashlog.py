@@ -0,0 +1,231 @@
+# Store-and-forward telemetry log on the flash filesystem.
+#
+# While the broker is unreachable, decoded snapshots are appended as
+# fixed-size binary records to segment files /log/00000001.bin, ... .
+# Records are buffered in RAM and written in blocks of flush_records to
+# keep the number of flash page writes low (a reset loses at most one
+# block); a segment is closed once it reaches
+# segment_bytes and the oldest segment is deleted when there are more
+# than max_segments (its unreplayed records are counted as lost).
+#
+# Replay reads forward from a cursor (segment, offset) persisted in
+# /log/cursor, so a crash or reset during replay resumes close to where
+# it left off instead of starting over or losing the rest.
+
+import os
+import struct
+
+# ts, pack_mv, current_ma, capacity [10 mAh], soc, ncells, cells[16],
+# temps[4] [0.1 degC], ntemps, check
+RECORD_FMT = '<IHiHBB16H4hBB'
+RECORD_SIZE = struct.calcsize(RECORD_FMT)
+MAX_CELLS = 16
+MAX_TEMPS = 4
+
+
+def _exists(path):
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+
+def _check(buf, n):
+    s = 0
+    for i in range(n):
+        s += buf[i]
+    return s & 0xFF
+
+
+class FlashLog:
+    """Append-only ring of segment files with a persisted replay cursor.
+
+        log = FlashLog('/log')
+        log.append(ts, decoder)              # buffered; ts = compat.unix_time()
+        log.flush()                          # write buffered records
+        recs = log.read(20)                  # oldest unreplayed records
+        ... publish recs ...
+        log.commit()                         # advance the cursor
+    """
+
+    def __init__(self, path='/log', segment_bytes=32 * 1024, max_segments=8, flush_records=8, sync_every=10):
+        self.path = path
+        self.sync_every = sync_every
+        self._unsaved = 0
+        self.segment_records = segment_bytes // RECORD_SIZE
+        self.max_segments = max_segments
+        self.flush_records = flush_records
+        self._buf = bytearray(RECORD_SIZE * flush_records)
+        self._buffered = 0
+        self._zeros = (0,) * MAX_CELLS
+        self.appended = 0
+        self.replayed = 0
+        self.lost = 0
+        self.corrupt = 0
+        if not _exists(path):
+            os.mkdir(path)
+        self._segments = self._scan()
+        if not self._segments:
+            self._segments = [1]
+        self._cursor = self._load_cursor()
+        self._pending = None  # cursor after the last read(), until commit()
+        self._pending_count = 0
+        if self._size(self._segments[-1]) % RECORD_SIZE:
+            # Torn write before a reset: keep new records aligned.
+            self._rotate()
+
+    def _seg_path(self, seq):
+        return '%s/%08d.bin' % (self.path, seq)
+
+    def _scan(self):
+        segs = []
+        for name in os.listdir(self.path):
+            if name.endswith('.bin'):
+                try:
+                    segs.append(int(name[:-4]))
+                except ValueError:
+                    pass
+        segs.sort()
+        return segs
+
+    def _size(self, seq):
+        try:
+            return os.stat(self._seg_path(seq))[6]
+        except OSError:
+            return 0
+
+    def _load_cursor(self):
+        try:
+            with open(self.path + '/cursor') as f:
+                seq, off = f.read().split()
+            seq = int(seq)
+            off = int(off)
+        except (OSError, ValueError):
+            return (self._segments[0], 0)
+        if seq < self._segments[0]:
+            return (self._segments[0], 0)
+        return (seq, off)
+
+    def _save_cursor(self):
+        # littlefs commits a file atomically on close, so no temp file.
+        with open(self.path + '/cursor', 'w') as f:
+            f.write('%d %d' % self._cursor)
+        self._unsaved = 0
+
+    def append(self, ts, dec):
+        if self._buffered == self.flush_records:
+            self.flush()
+        off = self._buffered * RECORD_SIZE
+        cells = tuple(dec.cells[:dec.ncells]) + self._zeros[dec.ncells:]
+        temps = tuple(dec.temps[:dec.ntemps]) + self._zeros[:MAX_TEMPS - dec.ntemps]
+        struct.pack_into(RECORD_FMT, self._buf, off, ts, dec.pack_mv, dec.current_ma,
+                         dec.capacity_mah // 10, dec.soc, dec.ncells, *(cells + temps), dec.ntemps, 0)
+        mv = memoryview(self._buf)[off:off + RECORD_SIZE]
+        mv[RECORD_SIZE - 1] = _check(mv, RECORD_SIZE - 1)
+        self._buffered += 1
+        self.appended += 1
+
+    def flush(self):
+        if not self._buffered:
+            return
+        seq = self._segments[-1]
+        room = self.segment_records - self._size(seq) // RECORD_SIZE
+        done = 0
+        mv = memoryview(self._buf)
+        while done < self._buffered:
+            if room <= 0:
+                seq = self._rotate()
+                room = self.segment_records
+            n = min(room, self._buffered - done)
+            with open(self._seg_path(seq), 'ab') as f:
+                f.write(mv[done * RECORD_SIZE:(done + n) * RECORD_SIZE])
+            done += n
+            room -= n
+        self._buffered = 0
+
+    def _rotate(self):
+        seq = self._segments[-1] + 1
+        self._segments.append(seq)
+        while len(self._segments) > self.max_segments:
+            old = self._segments.pop(0)
+            if self._cursor[0] <= old:
+                # Unreplayed records of the dropped segment are gone.
+                skipped = self._size(old) // RECORD_SIZE
+                if self._cursor[0] == old:
+                    skipped -= self._cursor[1] // RECORD_SIZE
+                self.lost += skipped
+                self._cursor = (self._segments[0], 0)
+                self._pending = None
+            try:
+                os.remove(self._seg_path(old))
+            except OSError:
+                pass
+        return seq
+
+    def backlog(self):
+        # Number of unreplayed records, including those still in RAM.
+        seq, off = self._cursor
+        n = self._buffered
+        for s in self._segments:
+            if s >= seq:
+                n += self._size(s) // RECORD_SIZE - (off // RECORD_SIZE if s == seq else 0)
+        return n
+
+    def read(self, max_records):
+        # Oldest unreplayed records as tuples (ts, pack_mv, current_ma,
+        # capacity_mah, soc, cells, temps); call commit() once published.
+        self.flush()
+        seq, off = self._cursor
+        out = []
+        rec = bytearray(RECORD_SIZE)
+        while len(out) < max_records:
+            size = self._size(seq)
+            if off + RECORD_SIZE > size:
+                if seq >= self._segments[-1]:
+                    break
+                seq = self._next_segment(seq)
+                off = 0
+                continue
+            with open(self._seg_path(seq), 'rb') as f:
+                f.seek(off)
+                while len(out) < max_records and off + RECORD_SIZE <= size:
+                    f.readinto(rec)
+                    off += RECORD_SIZE
+                    if _check(rec, RECORD_SIZE - 1) != rec[RECORD_SIZE - 1]:
+                        self.corrupt += 1
+                        continue
+                    v = struct.unpack(RECORD_FMT, rec)
+                    ncells = v[5]
+                    ntemps = v[6 + MAX_CELLS + MAX_TEMPS]
+                    out.append((v[0], v[1], v[2], v[3] * 10, v[4],
+                                v[6:6 + ncells], v[6 + MAX_CELLS:6 + MAX_CELLS + ntemps]))
+        self._pending = (seq, off)
+        self._pending_count = len(out)
+        return out
+
+    def _next_segment(self, seq):
+        for s in self._segments:
+            if s > seq:
+                return s
+        return seq
+
+    def commit(self):
+        # Persist the cursor behind the records returned by read().
+        if self._pending is None:
+            return
+        self._cursor = self._pending
+        self._pending = None
+        self.replayed += self._pending_count
+        self._unsaved += 1
+        # Fully replayed segments are deleted, except the one being written.
+        while self._segments[0] < self._cursor[0]:
+            try:
+                os.remove(self._seg_path(self._segments.pop(0)))
+            except OSError:
+                pass
+        # The cursor is persisted every sync_every commits and when the log
+        # is drained; after a reset at most that many batches are replayed
+        # twice, which costs far less flash wear than a write per batch.
+        if self._unsaved >= self.sync_every or self._cursor == (self._segments[-1], self._size(self._segments[-1])):
+            self._save_cursor()
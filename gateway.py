@@ -0,0 +1,341 @@
+# Linux gateway: many batteries from one CPython process.
+#
+# The same core as the ESP32 firmware - bms.Central for the GAP/GATT state
+# machine, berger for the frames, outbox and aggregate for what gets
+# published, amqtt, supervisor - with bleakble.BleakBLE in place of the
+# ESP32 controller. Every adapter gets its own Central (BlueZ keeps about
+# 7 to 10 connections per adapter) and all of them share one event loop,
+# one gattcache and one broker connection. Batteries are spread over the
+# adapters by free connection slots.
+#
+#   python3 gateway.py gateway.json
+#
+# gateway.json (every key but batteries optional):
+#
+#   {"broker": {"host": "192.168.1.2", "port": 1883, "user": "womo",
+#               "password": "...", "ca": null},
+#    "topic": "womo",
+#    "adapters": {"hci0": 7, "hci1": 7},
+#    "batteries": [["batt1", "04:7F:0E:9E:D1:64"], ["batt2", null]],
+#    "publish_window_ms": 5000, "stats_window_s": 60,
+#    "poll_interval_ms": 2000, "metrics_interval_s": 60,
+#    "decode_workers": 0, "log_level": 20}
+#
+# A battery without a MAC binds to the first unknown FFF0 device. With
+# decode_workers set, frames are decoded in a process pool instead of the
+# loop (see DecodePool); below a few hundred frames/s the inline decode is
+# cheaper than shipping frames to another process.
+
+import argparse
+import json
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+import aggregate
+import amqtt
+import berger
+import bms
+import evq
+import gattcache
+import log
+import metrics
+import outbox
+import supervisor
+import tls
+
+if not hasattr(asyncio, "sleep_ms"):
+    # The uasyncio extension bms and supervisor sleep with
+    asyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+
+CLIENT_ID = "WoMoGateway"
+
+DEFAULTS = {
+    "broker": {},
+    "topic": "womo",
+    "adapters": {"hci0": 7},
+    "batteries": [],
+    "publish_window_ms": 5000,
+    "publish_rules": None,
+    "stats_window_s": 60,
+    "poll_interval_ms": 2000,
+    "metrics_interval_s": 60,
+    "decode_workers": 0,
+    "log_level": log.INFO,
+}
+
+UUIDS = (bms.SERVICE_UUID_16, bms.CHARACTERISTIC_UUID_16, bms.CCCD_UUID_16)
+
+
+def _mac(s):
+    return bytes.fromhex(s.replace(":", "").replace("-", "")) if s else None
+
+
+# -- process-pool decoding -----------------------------------------------------
+
+_decoder = None
+
+
+def decode_batch(frames):
+    # In a worker: decode frames, return what Decoder.decode() left behind
+    global _decoder
+    if _decoder is None:
+        _decoder = berger.Decoder()
+    d = _decoder
+    out = []
+    for frame in frames:
+        rc = d.decode(frame)
+        if rc == berger.OK and d.has_status:
+            out.append((rc, d.pack_mv, d.current_ma, d.soc, d.capacity_mah,
+                        tuple(d.cells[:d.ncells]), tuple(d.temps[:d.ntemps])))
+        else:
+            out.append((rc,))
+    return out
+
+
+def _load(dec, result):
+    # A decode_batch() result into the link's decoder, counters included
+    rc = result[0]
+    if rc != berger.OK:
+        dec.has_status = False
+        dec.errors += 1
+        return rc
+    dec.frames += 1
+    dec.has_status = len(result) > 1
+    if dec.has_status:
+        _, dec.pack_mv, dec.current_ma, dec.soc, dec.capacity_mah, cells, temps = result
+        dec.ncells = len(cells)
+        dec.ntemps = len(temps)
+        for i in range(dec.ncells):
+            dec.cells[i] = cells[i]
+        for i in range(dec.ntemps):
+            dec.temps[i] = temps[i]
+    return rc
+
+
+class DecodePool:
+    """Decodes frames of all Centrals in worker processes.
+
+    Frames collected during one loop iteration go out as one batch; the
+    results are applied in submission order, so on_frame sees every
+    link's frames in sequence.
+    """
+
+    def __init__(self, workers):
+        self.executor = ProcessPoolExecutor(workers)
+        self._batch = []  # (central, link, frame)
+        self._inflight = deque()  # (batch, future)
+        self.batches = 0
+        self.frames = 0
+
+    def attach(self, central):
+        central.offload = lambda link, frame: self.submit(central, link, frame)
+
+    def submit(self, central, link, frame):
+        if not self._batch:
+            asyncio.get_running_loop().call_soon(self._flush)
+        self._batch.append((central, link, frame))
+
+    def _flush(self):
+        batch = self._batch
+        self._batch = []
+        future = asyncio.get_running_loop().run_in_executor(self.executor, decode_batch, [f for _, _, f in batch])
+        future.add_done_callback(self._done)
+        self._inflight.append((batch, future))
+        self.batches += 1
+
+    def _done(self, _):
+        inflight = self._inflight
+        while inflight and inflight[0][1].done():
+            batch, future = inflight.popleft()
+            if future.cancelled() or future.exception() is not None:
+                log.warning("Decode batch of %d frames failed: %s", len(batch),
+                            "cancelled" if future.cancelled() else future.exception())
+                continue
+            for (central, link, _), result in zip(batch, future.result()):
+                self.frames += 1
+                central.decoded(link, _load(link.decoder, result))
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+# -- gateway -------------------------------------------------------------------
+
+class Gateway:
+    """Centrals per adapter, one MQTT client, the publish and stats tasks.
+
+        gw = Gateway(config, make_ble)    # make_ble(adapter) -> BLE object
+        await gw.run()
+    """
+
+    def __init__(self, config, make_ble, cache_path="gattcache.json"):
+        c = dict(DEFAULTS)
+        c.update(config)
+        self.config = c
+        self.runtime = metrics.Metrics()
+        self.cache = gattcache.HandleCache(cache_path)
+        self.client = None
+        broker = c["broker"]
+        self.tls = tls.TLSClient(broker["ca"]) if broker.get("ca") else None
+
+        adapters = list(c["adapters"].items())
+        groups = [[] for _ in adapters]
+        self.links = []
+        for name, mac in c["batteries"]:
+            link = bms.BmsLink(name, _mac(mac), "%s/%s" % (c["topic"], name))
+            link.telemetry = outbox.Outbox(link.topic, outbox.MODE_JSON, c["publish_window_ms"],
+                                           rules=c["publish_rules"])
+            if c["stats_window_s"]:
+                link.aggregate = aggregate.Aggregator(link.topic + "/stats", berger.MAX_TEMPS)
+            # Adapter with the most free connection slots
+            i = min(range(len(adapters)), key=lambda k: len(groups[k]) / adapters[k][1])
+            groups[i].append(link)
+            self.links.append(link)
+
+        self.decode_us = self.runtime.histogram("decode_us")
+        self.frame_latency_us = self.runtime.histogram("frame_latency_us")
+        self.pool = DecodePool(c["decode_workers"]) if c["decode_workers"] else None
+        self.centrals = []
+        self.supervisor = supervisor.Supervisor()
+        mqtt = self.supervisor.add("mqtt", self.connect_mqtt, self.mqtt_online,
+                                   backoff=supervisor.Backoff(1000, 120000))
+        mqtt.recover_hist = self.runtime.histogram("mqtt_recover_ms", metrics.MS_BUCKETS)
+        poll = berger.STATUS_REQUEST if c["poll_interval_ms"] else None
+        for (adapter, max_connections), links in zip(adapters, groups):
+            if not links:
+                continue
+            central = bms.Central(make_ble(adapter), links, evq.EventQueue(64), self.cache, UUIDS,
+                                  min(max_connections, len(links)), poll_request=poll)
+            central.adapter = adapter
+            central.on_frame = self.on_frame
+            central.decode_us = self.decode_us
+            central.frame_latency_us = self.frame_latency_us
+            if self.pool is not None:
+                self.pool.attach(central)
+            sup = self.supervisor.add("ble-" + adapter, central.reconnect, central.up,
+                                      backoff=supervisor.Backoff(2000, 60000))
+            sup.recover_hist = self.runtime.histogram(sup.name + "_recover_ms", metrics.MS_BUCKETS)
+            self.centrals.append(central)
+        self.runtime.gauge("ble_connected", lambda: {ct.adapter: ct.connected() for ct in self.centrals})
+        self.runtime.gauge("frames", lambda: sum(link.decoder.frames for link in self.links))
+        self.runtime.gauge("decode_errors", lambda: sum(link.decoder.errors for link in self.links))
+        self._tasks = []
+
+    def on_frame(self, link):
+        decoder = link.decoder
+        if not decoder.has_status:
+            return
+        if link.aggregate is not None:
+            link.aggregate.add(decoder)
+        link.telemetry.record(decoder)
+
+    def mqtt_online(self):
+        return self.client is not None and self.client.isconnected()
+
+    async def connect_mqtt(self):
+        broker = self.config["broker"]
+        if self.client is not None:
+            await self.client.disconnect()
+            self.client = None
+        try:
+            self.client = amqtt.MQTTClient(CLIENT_ID, server=broker.get("host", "127.0.0.1"),
+                                           port=broker.get("port", 8883 if self.tls else 1883),
+                                           user=broker.get("user"), password=broker.get("password"),
+                                           ssl=self.tls, max_queue=256)
+            await self.client.connect()
+            log.info("Connected to MQTT-Broker")
+            return True
+        except Exception as e:
+            log.warning("Failed to connect to MQTT broker: %s", e)
+            return False
+
+    async def poll_task(self):
+        while self.config["poll_interval_ms"]:
+            await asyncio.sleep_ms(self.config["poll_interval_ms"])
+            for central in self.centrals:
+                central.poll()
+
+    async def publish_task(self):
+        while True:
+            await asyncio.sleep_ms(self.config["publish_window_ms"])
+            for link in self.links:
+                try:
+                    await link.telemetry.flush(self.client)
+                except Exception as e:
+                    log.warning("%s: telemetry flush failed: %s", link.name, e)
+
+    async def stats_task(self):
+        while self.config["stats_window_s"]:
+            await asyncio.sleep(self.config["stats_window_s"])
+            for link in self.links:
+                try:
+                    link.aggregate.close()
+                    await link.aggregate.flush(self.client)
+                except Exception as e:
+                    log.warning("%s: stats flush failed: %s", link.name, e)
+
+    async def metrics_task(self):
+        while self.config["metrics_interval_s"]:
+            await asyncio.sleep(self.config["metrics_interval_s"])
+            if self.mqtt_online():
+                self.client.publish_nowait(self.config["topic"] + "/gateway", self.runtime.snapshot())
+
+    def start(self):
+        for central in self.centrals:
+            self._tasks.append(asyncio.create_task(central.run()))
+        for task in (self.poll_task, self.publish_task, self.stats_task, self.metrics_task):
+            self._tasks.append(asyncio.create_task(task()))
+        for central in self.centrals:
+            central.start()
+        self.supervisor.start()
+
+    async def stop(self):
+        self.supervisor.stop()
+        for central in self.centrals:
+            for link in central.links:
+                central.disconnect(link)
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.mqtt_online():
+            await self.client.disconnect()
+        if self.pool is not None:
+            self.pool.close()
+
+    async def run(self):
+        self.start()
+        try:
+            while True:
+                await asyncio.sleep(3600)
+        finally:
+            await self.stop()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="BMS to MQTT gateway for Berger batteries")
+    ap.add_argument("config", help="gateway.json")
+    ap.add_argument("--cache", default="gattcache.json", help="GATT handle cache")
+    args = ap.parse_args()
+    with open(args.config) as f:
+        config = json.load(f)
+    log.configure(config.get("log_level", log.INFO), 256, True)
+    if not config.get("batteries"):
+        sys.exit("gateway: no batteries configured")
+    import bleakble
+
+    gw = Gateway(config, bleakble.BleakBLE, args.cache)
+    try:
+        asyncio.run(gw.run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# Persistent cache of GATT handles per peripheral.
+#
+# Service and characteristic discovery costs several round trips per
+# connection. Handles of a given firmware do not change, so after the
+# first discovery they are stored in flash keyed by MAC address and
+# service/characteristic UUID, and a reconnect can use them right away.
+# A handle that fails (GATT error) is invalidated and the caller falls
+# back to discovery.
+
+import json
+import log
+
+
+def _key(mac, service, char):
+    return '%s/%04x/%04x' % (''.join('%02x' % b for b in mac), service, char)
+
+
+class HandleCache:
+    def __init__(self, path='/gattcache.json'):
+        self.path = path
+        try:
+            with open(path) as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, mac, service, char):
+        # Dict of handles, e.g. {'value': 42}, or None when not cached.
+        entry = self._entries.get(_key(mac, service, char))
+        if entry:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return entry
+
+    def put(self, mac, service, char, **handles):
+        key = _key(mac, service, char)
+        if self._entries.get(key) == handles:
+            return
+        self._entries[key] = handles
+        self._save()
+
+    def invalidate(self, mac, service, char):
+        if self._entries.pop(_key(mac, service, char), None) is not None:
+            self.invalidations += 1
+            self._save()
+
+    def _save(self):
+        try:
+            with open(self.path, 'w') as f:
+                json.dump(self._entries, f)
+        except OSError as e:
+            log.error("Failed to write GATT cache: %s", e)
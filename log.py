@@ -0,0 +1,86 @@
+# Leveled logger with an in-RAM ring buffer.
+#
+# Messages take printf-style arguments and are only formatted when their
+# level is enabled, so a disabled debug() costs a call and a compare. Hot
+# paths (the BLE IRQ) check the level themselves before building any
+# arguments:
+#
+#     if log.level <= log.DEBUG:
+#         log.debug("scan %s rssi %d", hexlify(addr), rssi)
+#
+# Enabled messages go into a ring of the last `size` lines, which can be
+# dumped on request (e.g. over MQTT), and are printed to the console only
+# when echo is set; UART output is the expensive part on a busy site.
+
+from compat import ticks_ms
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+_NAMES = {DEBUG: "D", INFO: "I", WARNING: "W", ERROR: "E"}
+
+level = INFO
+echo = True
+_ring = [None] * 64
+_next = 0
+dropped = 0  # lines overwritten in the ring
+
+
+def configure(lvl=INFO, size=64, to_console=True):
+    global level, echo, _ring, _next, dropped
+    level = lvl
+    echo = to_console
+    _ring = [None] * size
+    _next = 0
+    dropped = 0
+
+
+def log(lvl, msg, *args):
+    global _next, dropped
+    if lvl < level:
+        return
+    if args:
+        msg = msg % args
+    line = "%d %s %s" % (ticks_ms(), _NAMES.get(lvl, "?"), msg)
+    i = _next % len(_ring)
+    if _ring[i] is not None:
+        dropped += 1
+    _ring[i] = line
+    _next += 1
+    if echo:
+        print(line)
+
+
+def debug(msg, *args):
+    if DEBUG >= level:
+        log(DEBUG, msg, *args)
+
+
+def info(msg, *args):
+    if INFO >= level:
+        log(INFO, msg, *args)
+
+
+def warning(msg, *args):
+    if WARNING >= level:
+        log(WARNING, msg, *args)
+
+
+def error(msg, *args):
+    if ERROR >= level:
+        log(ERROR, msg, *args)
+
+
+def dump(clear=False):
+    # Buffered lines, oldest first.
+    global _next
+    n = len(_ring)
+    lines = [_ring[(_next + k) % n] for k in range(n)]
+    lines = [l for l in lines if l is not None]
+    if clear:
+        for k in range(n):
+            _ring[k] = None
+        _next = 0
+    return lines
@@ -1,36 +1,194 @@
+import time
+# ticks_ms() counts from reset, so boot_marks holds ms since reset for
+# main.py starting, WiFi, MQTT, the first decoded frame and the first
+# telemetry publish (see mark_boot()).
+boot_marks = {"main": time.ticks_ms()}
 import uasyncio as asyncio
 import machine
 import gc
-import ntptime  # Import NTP module
-import time
+import os
 import network
-import usocket
-import ussl
 import ubluetooth as bluetooth
-import ubinascii
-import struct
-from umqtt.simple import MQTTClient
-from ota import OTAUpdater
+import berger
+import evq
+import flashlog
+import gattcache
+import bms
+import log
+import json
+from compat import unix_time, EPOCH_OFFSET
 from WIFI_CONFIG import SSID, PASSWORD, SSID_TEST, PASSWORD_TEST
 from BROKER import MQTT_BROKER, MQTT_PORT, MQTT_USER, MQTT_PW, MQTT_TOPIC, MQTT_OTA_UPDATE, MQTT_ESP32_DEBUG, MQTT_ESP32_RESET, MQTT_SSL
 
+# Log level and ring size; lines go to the console only with LOG_ECHO,
+# the ring can be dumped by sending 'log' to debug_topic.
+try:
+    from BROKER import LOG_LEVEL
+except ImportError:
+    LOG_LEVEL = log.INFO
+try:
+    from BROKER import LOG_ECHO
+except ImportError:
+    LOG_ECHO = True
+log.configure(LOG_LEVEL, 64, LOG_ECHO)
+
 # Define the MAC address and UUID of the target BLE device
 TARGET_MAC = b'\x04\x7f\x0e\x9e\xd1\x64'
 
-SERVICE_UUID = bluetooth.UUID(0xfff0)
+# Batteries to monitor as (name, MAC); each publishes below
+# mqtt_topic/<name>. Set BATTERIES in BROKER.py for rigs with several packs;
+# a MAC of None binds to the first battery found advertising service FFF0.
+try:
+    from BROKER import BATTERIES
+except ImportError:
+    BATTERIES = (("batt1", TARGET_MAC),)
+# Simultaneous central connections; the ESP32 controller supports a few.
+try:
+    from BROKER import MAX_CONNECTIONS
+except ImportError:
+    MAX_CONNECTIONS = 3
+
+# Scan results weaker than this are dropped in the IRQ
+try:
+    from BROKER import MIN_RSSI
+except ImportError:
+    MIN_RSSI = -95
+
+# Connection parameter profiles (see bms.PROFILES): fast while connecting
+# and discovering, relaxed while notifications stream. A wider relaxed
+# interval saves power on both ends and delays each frame by a few
+# intervals; ble_profiles in the metrics shows the effect.
+try:
+    from BROKER import CONN_PROFILES
+except ImportError:
+    CONN_PROFILES = bms.PROFILES
 
-CHARACTERISTIC_UUID = bluetooth.UUID(0xfff6)
+# ATT MTU negotiated on every connection (see bms.MTU): from 121 on a
+# whole status frame comes in one notification or read. 0 keeps 23.
+try:
+    from BROKER import BLE_MTU
+except ImportError:
+    BLE_MTU = bms.MTU
+
+SERVICE_UUID = bluetooth.UUID(bms.SERVICE_UUID_16)
+CHARACTERISTIC_UUID = bluetooth.UUID(bms.CHARACTERISTIC_UUID_16)
+CCCD_UUID = bluetooth.UUID(bms.CCCD_UUID_16)
+
+# The BMS answers the status request with notifications. Every
+# POLL_INTERVAL_MS the request is written to FFF6 (0 disables polling);
+# without notify support the characteristic is read back instead.
+try:
+    from BROKER import POLL_INTERVAL_MS
+except ImportError:
+    POLL_INTERVAL_MS = 2000
 
 # Create a BLE object
 ble = bluetooth.BLE()
 ble.active(True)
 
-# Global variables to hold the connection handle and characteristic handle
-conn_handle = None
-char_handle = None
+# GATT handles from earlier connections, so reconnects skip discovery.
+# Data files are relative to the working directory (the flash root on the
+# ESP32), so host runs (bench/harness.py) keep them in a scratch directory.
+gatt_cache = gattcache.HandleCache("gattcache.json")
+
+# Runtime metrics (heap, gc cost, IRQ/decode/publish latency, reconnect
+# times), published as one compact JSON snapshot to debug_topic every
+# METRICS_INTERVAL_S; always-on mode only (see setup_metrics())
+try:
+    from BROKER import METRICS_INTERVAL_S
+except ImportError:
+    METRICS_INTERVAL_S = 60
+runtime = None
+publish_us = None
+publish_dropped = None
+
+# Events handed from the BLE IRQ to the central's consumer task
+events = evq.EventQueue()
+
+# Telemetry is coalesced per key and published once per window, either as
+# one JSON object on mqtt_topic (the keys that changed, per PUBLISH_RULES)
+# or as a burst of per-key topics.
+try:
+    from BROKER import PUBLISH_WINDOW_MS
+except ImportError:
+    PUBLISH_WINDOW_MS = 5000
+try:
+    from BROKER import PUBLISH_MODE
+except ImportError:
+    PUBLISH_MODE = None  # JSON, see setup_network()
+# Payloads per window: the JSON/str telemetry above and/or one packed
+# binary snapshot (see packed.py for the layout) on <topic>/bin.
+try:
+    from BROKER import PUBLISH_TEXT
+except ImportError:
+    PUBLISH_TEXT = True
+try:
+    from BROKER import PUBLISH_BINARY
+except ImportError:
+    PUBLISH_BINARY = False
+# Per-value change rules (deadband in mV, mA, mAh, % and 0.1 degC; maximum
+# interval in s): a value is only republished when it moved by more than
+# the deadband or the interval has passed. An empty dict publishes every
+# change.
+try:
+    from BROKER import PUBLISH_RULES
+except ImportError:
+    PUBLISH_RULES = {
+        "voltage": (10, 60),
+        "current": (100, 60),
+        "soc": (0, 300),
+        "capacity": (100, 300),
+        "cell": (5, 300),
+        "temp": (5, 300),
+    }
+# Every STATS_WINDOW_S each battery publishes a summary of the window on
+# <topic>/stats: min/mean/max of voltage, current, temperatures and cell
+# spread, and the charge and energy in and out (see aggregate.py). With
+# it, PUBLISH_WINDOW_MS can be raised a lot without losing information.
+# 0 disables it.
+try:
+    from BROKER import STATS_WINDOW_S
+except ImportError:
+    STATS_WINDOW_S = 60
+# While the broker is unreachable a snapshot is stored on flash every
+# STORE_INTERVAL_S and replayed on reconnect in batches of REPLAY_BATCH
+# records per REPLAY_INTERVAL_MS, so live data keeps flowing meanwhile.
+try:
+    from BROKER import STORE_INTERVAL_S
+except ImportError:
+    STORE_INTERVAL_S = 30
+REPLAY_BATCH = 20
+REPLAY_INTERVAL_MS = 1000
+# Duty-cycled mode for a parked van (see dutycycle.py): with DUTY_CYCLE_S
+# set, the ESP32 wakes every DUTY_CYCLE_S, stores DUTY_FRAMES frames per
+# battery (waiting at most DUTY_WAKE_MS) and deep-sleeps again; every
+# DUTY_FLUSH_EVERY cycles WiFi and MQTT come up to replay them.
+try:
+    from BROKER import DUTY_CYCLE_S
+except ImportError:
+    DUTY_CYCLE_S = 0
+try:
+    from BROKER import DUTY_FRAMES
+except ImportError:
+    DUTY_FRAMES = 3
+try:
+    from BROKER import DUTY_FLUSH_EVERY
+except ImportError:
+    DUTY_FLUSH_EVERY = 12
+DUTY_WAKE_MS = 15000
+
+# Updates are fetched from OTA_URL (manifest.json, version.json and the
+# files listed in the manifest) on the 'now' command on ota_topic
+try:
+    from BROKER import OTA_URL
+except ImportError:
+    OTA_URL = "https://raw.githubusercontent.com/gkutyi/Berger-LiFePo4-BLE2MQTT/main/"
+OTA_STATE = "/ota/state"  # only there while an update is switching or on trial
 
 # SSL/TLS Parameters
 CA_CRT_PATH = "/ssl/ca.crt"  # Path to the root CA certificate
+# The CA is parsed once; reconnects reuse the context (and session)
+tls_client = None
 
 # MQTT Connection Details
 CLIENT_ID = 'ESP32WoMoClient'
@@ -47,248 +205,469 @@ wifi_password_test = PASSWORD_TEST
 
 # MQTT Client Instance
 mqtt_client = None
+ota_running = None  # the ota_task while it runs
 
-def perform_ota_update():
-    print("Starting OTA update...")
-    # Disable BLE before starting OTA update to free up memory
-    ble.active(False)
-    gc.collect()
-
-    firmware_url = "https://raw.githubusercontent.com/gkutyi/Berger-LiFePo4-BLE2MQTT/"
-    ota_updater = OTAUpdater(SSID, PASSWORD, firmware_url, "main.py")
-    
-    success = False
-    if ota_updater.download_and_install_update_if_available():
-        success = True
-
-    # Re-enable BLE after OTA update
-    ble.active(True)
-    gc.collect()
-    print("OTA update completed.")
-    return success
-
-def ble_irq(event, data):
-    global conn_handle, char_handle
-
-    print('BLE-Scan Event:', event, 'with data:', data)
-    # publish_to_mqtt(debug_topic, event)
-    # publish_to_mqtt(debug_topic, data)
+# One link per battery, each with a flash log of snapshots taken while
+# offline (replayed to <topic>/history) and, once the network is set up,
+# its own outbox of latest values (see setup_network())
+links = []
+for name, mac in BATTERIES:
+    link = bms.BmsLink(name, mac, f"{mqtt_topic}/{name}")
+    link.history = flashlog.FlashLog('log_' + name)
+    links.append(link)
+
+central = bms.Central(ble, links, events, gatt_cache, (SERVICE_UUID, CHARACTERISTIC_UUID, CCCD_UUID),
+                      MAX_CONNECTIONS, poll_request=berger.STATUS_REQUEST if POLL_INTERVAL_MS else None,
+                      min_rssi=MIN_RSSI, profiles=CONN_PROFILES, mtu=BLE_MTU)
+
+# WiFi, MQTT and BLE supervision; always-on mode only (see setup_supervisor())
+links_supervisor = None
+wifi_link = None
+mqtt_link = None
+
+def setup_network():
+    # MQTT, TLS and the telemetry outboxes are only loaded when the network
+    # is used: at once when always on, on a flush when duty-cycled.
+    global tls_client
+    if tls_client is not None:
+        return
+    import tls
+    import outbox
+    tls_client = tls.TLSClient(CA_CRT_PATH)
+    mode = outbox.MODE_JSON if PUBLISH_MODE is None else PUBLISH_MODE
+    for link in links:
+        link.telemetry = outbox.Outbox(link.topic, mode, PUBLISH_WINDOW_MS, rules=PUBLISH_RULES)
+        if PUBLISH_BINARY:
+            import packed
+            link.packer = packed.Packer(link.topic + "/bin", berger.MAX_CELLS, berger.MAX_TEMPS)
+        if STATS_WINDOW_S and not DUTY_CYCLE_S:
+            import aggregate
+            link.aggregate = aggregate.Aggregator(link.topic + "/stats", berger.MAX_TEMPS)
+
+def setup_metrics():
+    # Hooks the histograms and gauges into BLE, telemetry and supervision
+    global runtime, publish_us, publish_dropped
+    import metrics
+    runtime = metrics.Metrics()
+    runtime.gauge("heap_free", gc.mem_free)
+    runtime.gauge("heap_alloc", gc.mem_alloc)
+    publish_us = runtime.histogram("publish_us")
+    publish_dropped = runtime.counter("publish_dropped")
+    events.irq_hist = runtime.histogram("irq_us")
+    for link in links:
+        link.telemetry.latency_ms = runtime.histogram("publish_latency_ms", metrics.MS_BUCKETS)
+    central.decode_us = runtime.histogram("decode_us")
+    for i, name in enumerate(bms.PROFILE_NAMES):
+        central.frame_span_ms[i] = runtime.histogram("frame_ms_" + name, metrics.MS_BUCKETS)
+    runtime.gauge("ble_profiles", central.profile_stats)
+    runtime.gauge("ble_mtu", lambda: {link.name: link.mtu for link in links if link.conn is not None})
+    runtime.gauge("scan_filter", central.scan_filter.counts)
+    central.frame_latency_us = runtime.histogram("frame_latency_us")
+    runtime.gauge("ble_connected", central.connected)
+    runtime.gauge("evq_overflows", lambda: events.overflows)
+    runtime.gauge("ble_irq_per_min", ble_event_rates)
+    for sup_link in links_supervisor.links:
+        sup_link.recover_hist = runtime.histogram(sup_link.name + "_recover_ms", metrics.MS_BUCKETS)
+    runtime.gauge("tls_handshake_ms", lambda: tls_client.handshake_ms)
+    runtime.gauge("boot_ms", lambda: boot_marks)
+
+_irq_seen = [0] * len(central.irq_events)
+_irq_seen_t = [time.ticks_ms()]
+
+def ble_event_rates():
+    # BLE IRQs per minute by event code since the last snapshot
+    now = time.ticks_ms()
+    dt = time.ticks_diff(now, _irq_seen_t[0]) or 1
+    rates = {}
+    for code, n in enumerate(central.irq_events):
+        if n != _irq_seen[code]:
+            rates[code] = (n - _irq_seen[code]) * 60000 // dt
+            _irq_seen[code] = n
+    _irq_seen_t[0] = now
+    return rates
+
+def mark_boot(name):
+    if name not in boot_marks:
+        boot_marks[name] = time.ticks_ms()
+        log.info("Boot: %s after %d ms", name, boot_marks[name])
+
+async def ota_task():
+    # Streams the update next to the running firmware (see otaupdate.py);
+    # BLE and telemetry keep running until the reset into the new version.
+    import otaupdate
+    log.info("Starting OTA update...")
+    result = "failure"
     try:
-        if event == 1:  # Connection established
-            conn_handle, addr_type, addr = data
-            print(f"ESP32 has connected with MAC: {ubinascii.hexlify(addr)}")
-            publish_to_mqtt(debug_topic, "Connection established")
-            ble.gattc_discover_services(conn_handle)  # Discover services
-        
-        elif event == 2:  # Disconnection event
-            conn_handle, addr_type, addr = data
-            print("CENTRAL:DISCONNECT")
-            # publish_to_mqtt(debug_topic, "Central Disconnect")
-
-        elif event == 5:  # GAP scan result
-            addr_type, addr, adv_type, rssi, adv_data = data
-            print(f"Found device with address: {ubinascii.hexlify(addr)}")
-            print(f"TARGET_MAC:", TARGET_MAC)
-            print("Address type:", addr_type)
-            print(f"Advertisement data: {ubinascii.hexlify(adv_data)}")
-            if addr == TARGET_MAC:
-                print(f"Found Berger-BATT with MAC: {ubinascii.hexlify(addr)}")
-                # publish_to_mqtt(debug_topic, "found BERGER-BATT")
-                ble.gap_scan(None)  # Stop scanning
-                print("Scanning stopped")
-                # publish_to_mqtt(debug_topic, "scanning stoped")
-                ble.gap_connect(addr_type, addr)  # Connect to the device
-                print("Berger-BATT connected")
-                publish_to_mqtt(debug_topic, "Berger-BATT connected")
-            
-        elif event == 7:  # Connection complete
-            conn_handle, addr_type, addr = data
-            print(f"Berger-BATT Connected with MAC: {ubinascii.hexlify(addr)}")
-            ble.gattc_discover_services(conn_handle)  # Discover services
-        
-        elif event == 9:  # Service result
-            conn_handle, start_handle, end_handle, uuid = data
-            print(f"Service UUID: {bluetooth.UUID(uuid)}")
-            # publish_to_mqtt(debug_topic, "Service Result UUID:")
-            ble.gattc_discover_characteristics(conn_handle, start_handle, end_handle, uuid)
-
-        elif event == 11:  # Characteristic result
-            conn_handle, def_handle, value_handle, properties, uuid = data
-            print(f"Found characteristic with UUID: {bluetooth.UUID(uuid)}")
-            if uuid == CHARACTERISTIC_UUID:
-                char_handle = value_handle
-                print(f"Found characteristic: {bluetooth.UUID(uuid)}")
-                # publish_to_mqtt(debug_topic, "Found Characteristic FFF6")
-                ble.gattc_read(conn_handle, char_handle)  # Read the characteristic value
-      
-        elif event == 12:  # Characteristic read complete
-            conn_handle, value_handle, char_data = data
-            if value_handle == char_handle:
-                print(f"Data received from characteristic: {ubinascii.hexlify(char_data)}")
-                if ubinascii.hexlify(char_data) == b'3a3031353135303030304546457e':
-                    print("Data matches expected value")
-                    publish_to_mqtt(debug_topic, "Data matches expected value")
-                else:
-                    print("Data does not match expected value")
-                    publish_to_mqtt(debug_topic, "Data does not match expected value")
-            
-        elif event == 27:  # Connection update
-            conn_handle, conn_interval, conn_latency, supervision_timeout, status = data
-            print(f"Connection updated: handle={conn_handle}, interval={conn_interval}, latency={conn_latency}, timeout={supervision_timeout}")
-            handle_connection_update(conn_handle, conn_interval, conn_latency, supervision_timeout)
-            
+        if await otaupdate.Updater(OTA_URL).update():
+            result = "success"
+        else:
+            result = "current"
     except Exception as e:
-        print(f"Error in BLE scan callback: {e}")
-    
+        log.warning("OTA update failed: %s", e)
+    publish_to_mqtt(ota_topic, result)
+    if result == "success":
+        await asyncio.sleep(2)  # let the reply go out
+        machine.reset()
+
+def update_pending():
+    # True while an update runs on trial; otaupdate is only imported then
+    try:
+        os.stat(OTA_STATE)
+    except OSError:
+        return False
+    import otaupdate
+    return otaupdate.pending()
+
+def confirm_update():
+    # The first publish after an update shows it works; see boot.py
+    if update_pending():
+        import otaupdate
+        otaupdate.confirm()
+
+async def poll_task():
+    while POLL_INTERVAL_MS:
+        await asyncio.sleep_ms(POLL_INTERVAL_MS)
+        central.poll()
+
+async def ble_stats_task(interval_s=60):
+    while True:
+        await asyncio.sleep(interval_s)
+        log.info(events.stats())
+        publish_to_mqtt(debug_topic, events.stats())
+        for link in links:
+            publish_to_mqtt(debug_topic, link.stats())
+        log.info(links_supervisor.stats())
+        publish_to_mqtt(debug_topic, links_supervisor.stats())
+        publish_to_mqtt(debug_topic, tls_client.stats())
+
+def publish_battery_values(link):
+    # Only records the latest values; publish_task sends them once per window.
+    decoder = link.decoder
+    if not decoder.has_status:
+        return
+    if "frame" not in boot_marks:
+        mark_boot("frame")
+    if link.aggregate is not None:
+        link.aggregate.add(decoder)
+    if not PUBLISH_TEXT or link.telemetry is None:
+        return  # duty-cycled: nothing to publish until a flush
+    link.telemetry.record(decoder)
+
+async def publish_link(link):
+    sent = 0
+    if PUBLISH_TEXT:
+        sent = await link.telemetry.flush(mqtt_client)
+    packer = link.packer
+    if packer is not None and mqtt_online() and packer.changed(link.decoder):
+        n = packer.pack(link.decoder, unix_time())
+        await mqtt_client.publish(packer.topic, packer.view[:n])
+        sent += 1
+    if sent and "publish" not in boot_marks:
+        mark_boot("publish")
+        confirm_update()
+
+async def publish_task():
+    while True:
+        await asyncio.sleep_ms(PUBLISH_WINDOW_MS)
+        for link in links:
+            try:
+                await publish_link(link)
+            except Exception as e:
+                log.warning("%s: telemetry flush failed: %s", link.name, e)
+
+async def stats_task():
+    while STATS_WINDOW_S:
+        await asyncio.sleep(STATS_WINDOW_S)
+        for link in links:
+            try:
+                link.aggregate.close()
+                await link.aggregate.flush(mqtt_client)
+            except Exception as e:
+                log.warning("%s: stats flush failed: %s", link.name, e)
+
+def mqtt_online():
+    return mqtt_client is not None and mqtt_client.isconnected()
+
+async def store_task():
+    while True:
+        await asyncio.sleep(STORE_INTERVAL_S)
+        if mqtt_online():
+            continue
+        for link in links:
+            if link.decoder.has_status:
+                link.history.append(unix_time(), link.decoder)
+
+async def replay_task():
+    while True:
+        await asyncio.sleep_ms(REPLAY_INTERVAL_MS)
+        if not mqtt_online():
+            continue
+        # One batch per interval, taking the batteries in turn
+        for link in links:
+            if not link.history.backlog():
+                continue
+            try:
+                await replay_batch(link)
+            except Exception as e:
+                log.warning("%s: history replay failed: %s", link.name, e)
+            break
+
+async def replay_batch(link):
+    # Publishes the oldest stored records; returns how many are left.
+    history = link.history
+    records = history.read(REPLAY_BATCH)
+    if records:
+        await mqtt_client.publish(link.topic + "/history", json.dumps(records))
+    history.commit()
+    left = history.backlog()
+    log.info("%s: replayed %d stored records, %d left", link.name, len(records), left)
+    return left
+
 def mqtt_callback(topic, msg):
-    print("Received message on topic:", topic.decode(), "with message:", msg.decode())
+    global ota_running
+    log.debug("Received message on topic: %s with message: %s", topic.decode(), msg.decode())
     #publish_to_mqtt(debug_topic, "MQTT-Message received")
     if msg.decode() == 'now' and topic.decode() == ota_topic:
-        print('OTA update message received.')
+        log.info('OTA update message received.')
         #publish_to_mqtt(debug_topic, "OTA update message received:")
-        if perform_ota_update():
-            gc.collect()
-            publish_to_mqtt(ota_topic, 'success')
+        if ota_running is not None and not ota_running.done():
+            log.warning("OTA update already running, ignored")
         else:
-            publish_to_mqtt(ota_topic, 'failure')
+            ota_running = asyncio.create_task(ota_task())
+    if msg.decode() == 'log' and topic.decode() == debug_topic:
+        # Dump the log ring buffer
+        publish_to_mqtt(debug_topic, "\n".join(log.dump()))
     if msg.decode() == 'reset' and topic.decode() == reset_topic:
-        print('Reset message received.')
+        log.info('Reset message received.')
         #publish_to_mqtt(debug_topic, "RESET message received:")
         machine.reset()
 
-def handle_connection_update(conn_handle, conn_interval, conn_latency, supervision_timeout):
-    # Define preferred parameters
-    MIN_CONN_INTERVAL = 6  # 7.5ms
-    MAX_CONN_INTERVAL = 3200  # 4s
-    MAX_CONN_LATENCY = 499  # 499 intervals
-    MAX_SUPERVISION_TIMEOUT = 3200  # 32s
-
-    # Check if parameters are within acceptable range
-    if (MIN_CONN_INTERVAL <= conn_interval <= MAX_CONN_INTERVAL and
-        conn_latency <= MAX_CONN_LATENCY and
-        supervision_timeout <= MAX_SUPERVISION_TIMEOUT):
-        print("Connection parameters are acceptable.")
-    else:
-        print("Connection parameters are outside acceptable range, considering reconnection...")
-        ble.gap_disconnect(conn_handle)
-        start_ble_scan()  # Try to reconnect
-      
-def start_ble_scan():
-    ble.irq(ble_irq)
-    ble.gap_scan(10000, 30000, 30000)  # Active scan for 10 seconds
-
-def connect_mqtt():
+async def connect_mqtt():
     global mqtt_client
+    if mqtt_client is not None:
+        await mqtt_client.disconnect()
+        mqtt_client = None
+        if runtime is not None:
+            runtime.collect()
+    await time_synced.wait()
+    import amqtt
     try:
-        addr_info = usocket.getaddrinfo(MQTT_BROKER, MQTT_PORT)[0][-1]
-        sock = usocket.socket(usocket.AF_INET, usocket.SOCK_STREAM)
-        sock.connect(addr_info)
-
-        with open(CA_CRT_PATH, 'rb') as f:
-            ca_cert = f.read()
-        sock = ussl.wrap_socket(sock, server_hostname=MQTT_BROKER, cert_reqs=ussl.CERT_REQUIRED, cadata=ca_cert)
-
-        mqtt_client = MQTTClient(CLIENT_ID, server=MQTT_BROKER, port=MQTT_PORT, user=MQTT_USER, password=MQTT_PW, ssl=True)
+        mqtt_client = amqtt.MQTTClient(CLIENT_ID, server=MQTT_BROKER, port=MQTT_PORT, user=MQTT_USER, password=MQTT_PW,
+                                         ssl=tls_client if MQTT_SSL else None)
         mqtt_client.set_callback(mqtt_callback)
-        mqtt_client.connect()
-        print('Connected to MQTT-Broker')
+        await mqtt_client.connect()
+        log.info('Connected to MQTT-Broker, handshake %s ms', tls_client.handshake_ms)
         #publish_to_mqtt(debug_topic, "Connected to MQTT-Broker")
         return True
     except Exception as e:
-        print(f"Failed to connect to MQTT broker: {e}")
+        log.warning("Failed to connect to MQTT broker: %s", e)
         return False
 
-def publish_to_mqtt(topic, value):
-    global mqtt_client
-    mqtt_client.publish(topic, str(value))
-    print(f"Published to {topic}: {value}")
+async def mqtt_subscribe():
+    # Incoming messages are dispatched to mqtt_callback by the client's
+    # reader task; subscriptions are renewed after every reconnect.
+    await mqtt_client.subscribe(ota_topic)
+    await mqtt_client.subscribe(debug_topic)
+    await mqtt_client.subscribe(reset_topic)
+    mark_boot("mqtt")
+    publish_to_mqtt(debug_topic, "Broker connected")
 
-async def check_mqtt_messages_async():
-    global mqtt_client
-    mqtt_client.subscribe(ota_topic)
-    mqtt_client.subscribe(debug_topic)
-    mqtt_client.subscribe(reset_topic)
-    #publish_to_mqtt(debug_topic, "mqtt-client subscribed")
-    while True:
-        try:
-            mqtt_client.wait_msg()
-            gc.collect()
-        except Exception as e:
-            print(f"Error checking messages: {e}")
-            reconnect_mqtt()
-            gc.collect()
-        await asyncio.sleep(1)  # Yield control to allow other tasks to run
-        
-def reconnect_mqtt():
-    global mqtt_client
-    connected = False
-    attempts = 0
-    max_attempts = 5
-
-    while not connected and attempts < max_attempts:
-        if mqtt_client is not None:
-            mqtt_client.disconnect()
-        mqtt_client = None
-        gc.collect()
-
-        connected = connect_mqtt()
-        if not connected:
-            attempts += 1
-            print(f"Retrying MQTT connection in 5 seconds... (Attempt {attempts}/{max_attempts})")
-            time.sleep(5)
+def publish_to_mqtt(topic, value):
+    # Queues the message for the MQTT writer task; never blocks.
+    t0 = time.ticks_us()
+    if mqtt_client is None or not mqtt_client.publish_nowait(topic, str(value)):
+        if publish_dropped is not None:
+            publish_dropped.inc()
+        log.warning("Dropped publish to %s: %s", topic, value)
+        return
+    if publish_us is not None:
+        publish_us.since_us(t0)
+    log.debug("Published to %s: %s", topic, value)
 
-    if not connected:
-        print("Max MQTT reconnection attempts reached. Giving up.")
+wlan = network.WLAN(network.STA_IF)
 
-def connect_to_wifi(ssid, password):
-    wlan = network.WLAN(network.STA_IF)
+async def connect_to_wifi(timeout_ms=10000):
+    # Tries the main network, then the test network, without blocking the
+    # event loop; the supervisor retries with backoff if both fail.
     wlan.active(True)
-    wlan.disconnect()
-    
-    attempts = 3
-    for attempt in range(attempts):
+    for ssid, password in ((wifi_ssid, wifi_password), (wifi_ssid_test, wifi_password_test)):
         try:
+            wlan.disconnect()
             wlan.connect(ssid, password)
-            timeout = 5
-            while not wlan.isconnected() and timeout > 0:
-                print(f'Attempting to connect to {ssid}... (Attempt {attempt + 1}/{attempts})')
-                time.sleep(1)
-                timeout -= 1
-            
-            if wlan.isconnected():
-                print(f'Connected to {ssid}')
-                print('Network config:', wlan.ifconfig())
-                return True
         except OSError as e:
-            print(f'Error on attempt {attempt + 1}: {e}')
-            time.sleep(2)
-        
-    print(f'Failed to connect to {ssid} after {attempts} attempts')
+            log.warning('Error connecting to %s: %s', ssid, e)
+            continue
+        log.info('Attempting to connect to %s...', ssid)
+        t0 = time.ticks_ms()
+        while not wlan.isconnected() and time.ticks_diff(time.ticks_ms(), t0) < timeout_ms:
+            await asyncio.sleep_ms(250)
+        if wlan.isconnected():
+            log.info('Connected to %s', ssid)
+            log.info('Network config: %s', wlan.ifconfig())
+            return True
+        log.warning('Failed to connect to %s', ssid)
     return False
 
-def sync_time():
+# SNTP server as (host, port)
+try:
+    from BROKER import NTP_SERVER
+except ImportError:
+    NTP_SERVER = ("pool.ntp.org", 123)
+NTP_DELTA = 2208988800  # seconds from 1900-01-01 to 1970-01-01
+
+# Set once the clock holds the date: TLS certificate checks and the
+# telemetry timestamps need it, so connect_mqtt() waits for it.
+time_synced = asyncio.Event()
+if time.localtime()[0] >= 2024:
+    time_synced.set()  # RTC kept its time (soft reset, deep sleep)
+
+async def sync_time(timeout_ms=2000):
+    # One SNTP query on a non-blocking UDP socket, polled so BLE keeps
+    # running meanwhile (ntptime.settime() blocks for the round trip).
+    import socket
+    import struct
+    s = None
     try:
-        ntptime.settime()
-        print("Time synchronized successfully")
+        addr = socket.getaddrinfo(NTP_SERVER[0], NTP_SERVER[1])[0][-1]
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setblocking(False)
+        query = bytearray(48)
+        query[0] = 0x1B  # LI 0, version 3, client
+        s.sendto(query, addr)
+        t0 = time.ticks_ms()
+        while True:
+            try:
+                msg = s.recv(48)
+                break
+            except OSError:
+                if time.ticks_diff(time.ticks_ms(), t0) > timeout_ms:
+                    raise OSError("no reply")
+                await asyncio.sleep_ms(20)
+        t = struct.unpack("!I", msg[40:44])[0] - NTP_DELTA - EPOCH_OFFSET
+        tm = time.gmtime(t)
+        machine.RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
+        log.info("Time synchronized successfully")
     except Exception as e:
-        print(f"Failed to synchronize time: {e}")
+        log.warning("Failed to synchronize time: %s", e)
+    finally:
+        if s is not None:
+            s.close()
+    time_synced.set()  # connect anyway; the next WiFi up tries again
+
+async def ntp_task():
+    if time_synced.is_set():
+        # After the MQTT connect, so it does not delay the first publish
+        try:
+            await asyncio.wait_for(mqtt_link.up_event.wait(), 10)
+        except asyncio.TimeoutError:
+            pass
+    await sync_time()
+
+async def wifi_up():
+    mark_boot("wifi")
+    asyncio.create_task(ntp_task())
+
+def setup_supervisor():
+    # WiFi, MQTT and BLE are each brought up and recovered independently
+    # with jittered exponential backoff; MQTT waits for WiFi.
+    global links_supervisor, wifi_link, mqtt_link
+    import supervisor
+    links_supervisor = supervisor.Supervisor()
+    wifi_link = links_supervisor.add("wifi", connect_to_wifi, wlan.isconnected, on_up=wifi_up,
+                                     backoff=supervisor.Backoff(1000, 60000))
+    mqtt_link = links_supervisor.add("mqtt", connect_mqtt, mqtt_online, on_up=mqtt_subscribe, depends=wifi_link,
+                                     backoff=supervisor.Backoff(1000, 120000))
+    links_supervisor.add("ble", central.reconnect, central.up, backoff=supervisor.Backoff(2000, 60000))
+
+async def metrics_task():
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL_S)
+        runtime.collect()
+        publish_to_mqtt(debug_topic, runtime.snapshot())
 
 async def main_async():
-    if not connect_to_wifi(wifi_ssid, wifi_password):
-        if not connect_to_wifi(wifi_ssid_test, wifi_password_test):
-            print('Connect to WiFi failed')
-            machine.reset()
-    sync_time()
-    if connect_mqtt():
-        # Start BLE scan once
-        publish_to_mqtt(debug_topic, "Broker connected")
-        start_ble_scan()
-        # Run check_mqtt_messages_async concurrently
-        await check_mqtt_messages_async()
-    else:
-        print('Connect to MQTT-Broker failed')
-        publish_to_mqtt(debug_topic, "MQTT-Broker not connected")
-        machine.reset()
-        
+    setup_network()
+    setup_supervisor()
+    setup_metrics()
+    central.on_frame = publish_battery_values
+    central.on_debug = lambda msg: publish_to_mqtt(debug_topic, msg)
+    asyncio.create_task(central.run())
+    asyncio.create_task(ble_stats_task())
+    asyncio.create_task(poll_task())
+    asyncio.create_task(publish_task())
+    asyncio.create_task(stats_task())
+    asyncio.create_task(store_task())
+    asyncio.create_task(replay_task())
+    asyncio.create_task(metrics_task())
+    central.start()
+    links_supervisor.start()
+    while True:
+        await asyncio.sleep(3600)
+
+async def duty_cycle_async():
+    # One wake cycle: BLE only, then deep sleep (never returns on the ESP32)
+    import dutycycle
+    dc = dutycycle.DutyCycle(DUTY_CYCLE_S, DUTY_FLUSH_EVERY)
+    dc.phase("ble")
+    counts = {}
+
+    def on_frame(link):
+        if not link.decoder.has_status:
+            return
+        dc.first_frame()
+        link.history.append(unix_time(), link.decoder)
+        counts[link.name] = counts.get(link.name, 0) + 1
+        publish_battery_values(link)
+
+    central.on_frame = on_frame
+    tasks = [asyncio.create_task(central.run()), asyncio.create_task(central.schedule()),
+             asyncio.create_task(poll_task())]
+    central.start()
+    while dc.awake_ms() < DUTY_WAKE_MS:
+        if len(counts) == len(links) and min(counts.values()) >= DUTY_FRAMES:
+            break
+        await asyncio.sleep_ms(250)
+    for task in tasks:
+        task.cancel()
+    for link in links:
+        central.disconnect(link)
+        link.history.flush()
+    log.info("Cycle %d: %s frames, first after %d ms", dc.cycle, counts, dc.first_frame_ms)
+    if dc.flush_due():
+        dc.phase("net")
+        await duty_flush(dc)
+    ble.active(False)
+    dc.sleep()
+
+async def duty_flush(dc):
+    # Replays everything stored since the last flush and the cycle report.
+    if not await connect_to_wifi():
+        return
+    setup_network()
+    for link in links:
+        if PUBLISH_TEXT and link.decoder.has_status:
+            link.telemetry.record(link.decoder)  # the last frame of this cycle
+    await sync_time()
+    if await connect_mqtt():
+        try:
+            await mqtt_subscribe()
+            for link in links:
+                while await replay_batch(link):
+                    pass
+                await publish_link(link)
+            await mqtt_client.publish(debug_topic, json.dumps(dc.report()))
+        except Exception as e:
+            log.warning("Flush failed: %s", e)
+        await mqtt_client.disconnect()
+    wlan.active(False)
+
 if __name__ == '__main__':
-    asyncio.run(main_async())
+    try:
+        asyncio.run(duty_cycle_async() if DUTY_CYCLE_S else main_async())
+    except Exception as e:
+        # A crash of an unconfirmed update must not stop at the REPL: the
+        # reset counts a trial boot, so boot.py rolls it back eventually
+        if update_pending():
+            log.error("Crashed on trial: %s", e)
+            machine.reset()
+        raise
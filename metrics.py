@@ -0,0 +1,150 @@
+# Lightweight runtime metrics: counters, gauges and fixed-bucket
+# histograms.
+#
+# Recording a value is a few integer operations on preallocated arrays,
+# so the hooks stay on in production (bench/bench_metrics.py measures the
+# cost). Gauges are callables evaluated only when a snapshot is taken.
+# snapshot() renders everything as one compact JSON object and, by
+# default, restarts the histograms so each snapshot covers one interval;
+# counters keep counting.
+
+import gc
+from array import array
+
+from compat import compact_json, ticks_us, ticks_ms, ticks_diff
+
+# Upper bucket bounds; values above the last bound go into an overflow bucket.
+US_BUCKETS = (50, 100, 200, 500, 1000, 2000, 5000, 10000, 50000)
+MS_BUCKETS = (10, 50, 100, 500, 1000, 5000, 10000, 30000, 60000)
+
+
+class Counter:
+    def __init__(self):
+        self.n = 0
+
+    def inc(self, k=1):
+        self.n += k
+
+
+class Histogram:
+    """Counts of observed values per bucket, plus count, sum and max.
+
+        h = Histogram(US_BUCKETS)
+        t0 = ticks_us()
+        ...
+        h.since_us(t0)
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = array('L', [0] * (len(bounds) + 1))
+        self.reset()
+
+    def reset(self):
+        counts = self.counts
+        for i in range(len(counts)):
+            counts[i] = 0
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, v):
+        bounds = self.bounds
+        n = len(bounds)
+        i = 0
+        while i < n and v > bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += v
+        if v > self.max:
+            self.max = v
+
+    def since_us(self, t0):
+        self.observe(ticks_diff(ticks_us(), t0))
+
+    def since_ms(self, t0):
+        self.observe(ticks_diff(ticks_ms(), t0))
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p-th percentile (the
+        # maximum for the overflow bucket).
+        if not self.count:
+            return 0
+        rank = (self.count * p + 99) // 100
+        seen = 0
+        for i in range(len(self.bounds)):
+            seen += self.counts[i]
+            if seen >= rank:
+                return min(self.bounds[i], self.max)
+        return self.max
+
+    def summary(self):
+        # [count, mean, p50, p95, max]
+        if not self.count:
+            return [0, 0, 0, 0, 0]
+        return [self.count, self.total // self.count, self.percentile(50), self.percentile(95), self.max]
+
+
+class Metrics:
+    """Named counters, gauges and histograms.
+
+        m = Metrics()
+        frames = m.counter("frames")
+        decode_us = m.histogram("decode_us")
+        m.gauge("heap_free", gc.mem_free)
+        frames.inc()
+        client.publish(debug_topic, m.snapshot())
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self.heap_min_free = None
+        self.gc_us = self.histogram("gc_us", US_BUCKETS + (100000,))
+
+    def counter(self, name):
+        c = self._counters.get(name)
+        if c is None:
+            c = self._counters[name] = Counter()
+        return c
+
+    def gauge(self, name, fn):
+        self._gauges[name] = fn
+
+    def histogram(self, name, bounds=US_BUCKETS):
+        h = self._histograms.get(name)
+        if h is None:
+            h = self._histograms[name] = Histogram(bounds)
+        return h
+
+    def collect(self):
+        # gc.collect() with its cost recorded, plus the heap low-water mark.
+        t0 = ticks_us()
+        gc.collect()
+        self.gc_us.since_us(t0)
+        try:
+            free = gc.mem_free()
+        except AttributeError:
+            return  # CPython
+        if self.heap_min_free is None or free < self.heap_min_free:
+            self.heap_min_free = free
+
+    def snapshot(self, reset=True):
+        d = {}
+        for name, c in self._counters.items():
+            d[name] = c.n
+        for name, fn in self._gauges.items():
+            try:
+                d[name] = fn()
+            except Exception as e:
+                d[name] = str(e)
+        if self.heap_min_free is not None:
+            d["heap_min_free"] = self.heap_min_free
+        for name, h in self._histograms.items():
+            if h.count:
+                d[name] = h.summary()
+            if reset:
+                h.reset()
+        return compact_json(d)
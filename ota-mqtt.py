@@ -2,11 +2,12 @@ import gc
 import ntptime  # Import NTP module
 import time
 import network
-import usocket
-import ussl
 import ubluetooth as bluetooth
 from umqtt.simple import MQTTClient
 from ota import OTAUpdater
+import tls
+import log
+import ubinascii
 from WIFI_CONFIG import SSID, PASSWORD, SSID_TEST, PASSWORD_TEST
 from BROKER import MQTT_BROKER, MQTT_PORT, MQTT_USER, MQTT_PW, MQTT_TOPIC, MQTT_OTA_UPDATE, MQTT_SSL
 
@@ -18,6 +19,8 @@ ble = bluetooth.BLE()
 
 # SSL/TLS Parameters
 CA_CRT_PATH = "/ssl/ca.crt"  # Path to the root CA certificate
+# The CA is parsed once; reconnects reuse the context (and session)
+tls_client = tls.TLSClient(CA_CRT_PATH)
 
 # MQTT Connection Details
 CLIENT_ID = 'ESP32WoMoClient'
@@ -54,19 +57,13 @@ def perform_ota_update():
 
 def scan_callback(event, data):
     try:
-        print('BLE-Scan Event:', event, 'with data:', data)
-        if event == 1:  # EVT_GAP_SCAN_RESULT
-            _, addr_type, addr, _, _, adv_data = data
-            print("Found device with address:", addr)
-            print("Address type:", addr_type)
-            print("Advertisement data:", adv_data)
-        elif event == 5:  # EVT_GAP_SCAN_RESULT
+        if log.level <= log.DEBUG:
+            log.debug('BLE-Scan Event: %d', event)
+        if event == 5:  # EVT_GAP_SCAN_RESULT
             addr_type, addr, adv_type, rssi, adv_data = data
-            print("Found device with address:", bytes(addr))
-            print("Address type:", addr_type)
-            print("Advertisement data:", bytes(adv_data))
-            print("RSSI:", rssi)
-            print("Advertisment type:", adv_type)
+            if log.level <= log.DEBUG:
+                log.debug("Found device %s type %d adv_type %d rssi %d adv %s", ubinascii.hexlify(addr),
+                          addr_type, adv_type, rssi, ubinascii.hexlify(adv_data))
         elif event == 3:  # EVENT_ADV_IND
             addr_type, addr, adv_type, rssi, adv_data = data
             if addr == ble_address:
@@ -83,7 +80,7 @@ def scan_callback(event, data):
                                 print('Received value:', value)
                                 publish_to_mqtt(mqtt_topic, value)
     except Exception as e:
-        print(f"Error in BLE scan callback: {e}")
+        log.error("Error in BLE scan callback: %s", e)
 
 def mqtt_callback(topic, msg):
     print("Received message on topic:", topic.decode(), "with message:", msg.decode())
@@ -104,18 +101,12 @@ def start_ble_scan():
 def connect_mqtt():
     global mqtt_client
     try:
-        addr_info = usocket.getaddrinfo(MQTT_BROKER, MQTT_PORT)[0][-1]
-        sock = usocket.socket(usocket.AF_INET, usocket.SOCK_STREAM)
-        sock.connect(addr_info)
-
-        with open(CA_CRT_PATH, 'rb') as f:
-            ca_cert = f.read()
-        sock = ussl.wrap_socket(sock, server_hostname=MQTT_BROKER, cert_reqs=ussl.CERT_REQUIRED, cadata=ca_cert)
-
-        mqtt_client = MQTTClient(CLIENT_ID, server=MQTT_BROKER, port=MQTT_PORT, user=MQTT_USER, password=MQTT_PW, ssl=True)
+        # umqtt.simple does the one, verified handshake via tls_client.wrap_socket()
+        mqtt_client = MQTTClient(CLIENT_ID, server=MQTT_BROKER, port=MQTT_PORT, user=MQTT_USER, password=MQTT_PW,
+                                  ssl=tls_client if MQTT_SSL else None)
         mqtt_client.set_callback(mqtt_callback)
         mqtt_client.connect()
-        print('Connected to MQTT-Broker')
+        print(f'Connected to MQTT-Broker, handshake {tls_client.handshake_ms} ms')
         return True
     except Exception as e:
         print(f"Failed to connect to MQTT broker: {e}")
@@ -0,0 +1,395 @@
+# Streaming OTA updates with verified staging and rollback.
+#
+# An update is described by manifest.json, published next to version.json
+# (tools/make_manifest.py generates it):
+#
+#   {"version": 91, "files": [{"path": "main.py", "size": 23145, "sha256": "9f2c..."},
+#                             {"path": "berger.mpy", "url": "mpy/berger.mpy", ...}, ...]}
+#
+# path is where the file is installed, url (default: path) where it is
+# fetched relative to the base URL. Only files whose size or hash differ
+# from the installed ones are downloaded; the installed manifest.json is
+# kept with version.json, and files without an entry there are hashed.
+# Files the new manifest no longer lists are removed, as is the .py of a
+# module now shipped as precompiled .mpy (the .py would be imported
+# first) and vice versa.
+#
+# Every changed file is streamed over HTTP(S) in fixed chunks through one
+# preallocated buffer, hashed as it arrives and written to /ota/new/<path>,
+# so the heap used does not depend on the file size and BLE keeps running
+# during the download. Only when every file matched its size and hash is
+# the update switched in: current files move to /ota/old/, the staged ones
+# take their place (renames are atomic per file) and version.json is
+# replaced with them. /ota/state records each step, so a reset in the
+# middle of the switch is completed by the next boot_check().
+#
+# The new version then runs on trial. boot.py calls boot_check() on every
+# boot, main.py calls confirm() once telemetry went out; a version that is
+# not confirmed within MAX_TRIAL_BOOTS boots is rolled back from /ota/old/.
+# /ota/state only exists while an update is switching or on trial, so
+# boot.py and main.py check for it before importing this module.
+
+import json
+import os
+from binascii import hexlify
+
+try:
+    import hashlib
+except ImportError:
+    import uhashlib as hashlib
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+import log
+
+CHUNK = 1024
+MAX_TRIAL_BOOTS = 3
+MAX_MANIFEST = 32768  # bytes; about 300 files as make_manifest.py writes them
+
+OTA_DIR = "/ota"
+VERSION_FILE = "version.json"
+MANIFEST_FILE = "manifest.json"
+
+_busy = False  # one update at a time: a second would wipe /ota/new and /ota/old
+
+
+def _exists(path):
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+
+def _makedirs(path):
+    # mkdir -p; path is absolute
+    part = ""
+    for name in path.split("/")[1:]:
+        part += "/" + name
+        if not _exists(part):
+            os.mkdir(part)
+
+
+def _remove_tree(path):
+    if not _exists(path):
+        return
+    if os.stat(path)[0] & 0x4000:
+        for name in os.listdir(path):
+            _remove_tree(path + "/" + name)
+        os.rmdir(path)
+    else:
+        os.remove(path)
+
+
+def _move(src, dst):
+    _makedirs(dst[:dst.rfind("/")])
+    if _exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def _split_url(url):
+    # (host, port, path, tls)
+    tls = url.startswith("https://")
+    rest = url.split("://", 1)[1]
+    i = rest.find("/")
+    hostport, path = (rest, "/") if i < 0 else (rest[:i], rest[i:])
+    host, _, port = hostport.partition(":")
+    return host, int(port) if port else (443 if tls else 80), path, tls
+
+
+class Updater:
+    """Downloads, verifies and switches in a new version.
+
+        if await Updater(base_url).update():
+            machine.reset()      # the new version boots on trial
+
+    root is the directory the application runs from ("" for the flash
+    root); ssl is passed to open_connection for https URLs.
+    """
+
+    def __init__(self, base_url, root="", ssl=True, chunk=CHUNK, timeout=10):
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        self.root = root
+        self.ssl = ssl
+        self.timeout = timeout
+        self._buf = bytearray(chunk)
+        self._view = memoryview(self._buf)
+        self._readinto = None
+        self.downloaded = 0
+
+    def _local_manifest(self):
+        # {path: entry} of the installed version
+        try:
+            with open(self.root + "/" + MANIFEST_FILE) as f:
+                return {e["path"]: e for e in json.load(f)["files"]}
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def _hash_file(self, path):
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            while True:
+                n = f.readinto(self._buf)
+                if not n:
+                    break
+                h.update(self._view if n == len(self._buf) else self._view[:n])
+        return hexlify(h.digest()).decode()
+
+    def _installed(self, entry, local):
+        # True if the file at entry's path already has its content
+        path = self.root + "/" + entry["path"]
+        try:
+            if os.stat(path)[6] != entry["size"]:
+                return False
+        except OSError:
+            return False
+        known = local.get(entry["path"])
+        if known is not None:
+            return known["sha256"] == entry["sha256"]
+        return self._hash_file(path) == entry["sha256"]
+
+    def _obsolete(self, manifest, local):
+        # Installed files the new version does not have
+        paths = [e["path"] for e in manifest["files"]]
+        out = [p for p in local if p not in paths]
+        for p in paths:
+            for a, b in ((".mpy", ".py"), (".py", ".mpy")):
+                if p.endswith(a):
+                    other = p[:-len(a)] + b
+                    if other not in paths and other not in out and _exists(self.root + "/" + other):
+                        out.append(other)
+        return out
+
+    def local_version(self):
+        try:
+            with open(self.root + "/" + VERSION_FILE) as f:
+                return json.load(f)["version"]
+        except (OSError, ValueError, KeyError):
+            return 0
+
+    async def _get(self, path):
+        # Streams positioned at the body and its Content-Length
+        host, port, base, tls = _split_url(self.base_url + path)
+        conn = asyncio.open_connection(host, port, ssl=self.ssl) if tls else asyncio.open_connection(host, port)
+        reader, writer = await asyncio.wait_for(conn, self.timeout)
+        try:
+            writer.write(("GET %s HTTP/1.0\r\nHost: %s\r\n\r\n" % (base, host)).encode())
+            await writer.drain()
+            status = await reader.readline()
+            if status.split()[1:2] != [b"200"]:
+                raise OSError("HTTP %s" % status.strip().decode())
+            length = -1
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                if line[:15].lower() == b"content-length:":
+                    length = int(line[15:])
+        except Exception:
+            writer.close()
+            raise
+        return reader, writer, length
+
+    async def _read(self, reader, want):
+        # Up to want bytes into the chunk buffer; returns the count
+        if self._readinto is None:
+            self._readinto = hasattr(reader, "readinto")
+        view = self._view if want == len(self._buf) else self._view[:want]
+        if self._readinto:
+            return await reader.readinto(view)
+        data = await reader.read(want)
+        view[:len(data)] = data
+        return len(data)
+
+    async def _copy(self, reader, f, size, name, h=None):
+        # size bytes from reader through the chunk buffer into f (and h)
+        left = size
+        chunk = len(self._buf)
+        while left:
+            n = await self._read(reader, chunk if left > chunk else left)
+            if not n:
+                raise ValueError("%s: truncated at %d" % (name, size - left))
+            part = self._view if n == chunk else self._view[:n]
+            if h is not None:
+                h.update(part)
+            f.write(part)
+            left -= n
+            self.downloaded += n
+
+    async def manifest(self):
+        # Spooled to flash and parsed from the file, so its text is never
+        # held in one piece next to the parsed dict
+        reader, writer, length = await self._get(MANIFEST_FILE)
+        path = self.root + OTA_DIR + "/" + MANIFEST_FILE
+        try:
+            if length <= 0:
+                raise ValueError("bad manifest length %d" % length)
+            if length > MAX_MANIFEST:
+                raise ValueError("manifest is %d bytes, over MAX_MANIFEST (%d)" % (length, MAX_MANIFEST))
+            _makedirs(self.root + OTA_DIR)
+            with open(path, "wb") as f:
+                await self._copy(reader, f, length, MANIFEST_FILE)
+        finally:
+            writer.close()
+        try:
+            with open(path) as f:
+                return json.load(f)
+        finally:
+            os.remove(path)
+
+    async def fetch(self, entry, dst):
+        # Streams one manifest entry to dst; ValueError on size/hash mismatch
+        reader, writer, length = await self._get(entry.get("url", entry["path"]))
+        try:
+            size = entry["size"]
+            if length >= 0 and length != size:
+                raise ValueError("%s: length %d, expected %d" % (entry["path"], length, size))
+            h = hashlib.sha256()
+            _makedirs(dst[:dst.rfind("/")])
+            with open(dst, "wb") as f:
+                await self._copy(reader, f, size, entry["path"], h)
+            if hexlify(h.digest()).decode() != entry["sha256"]:
+                raise ValueError("%s: hash mismatch" % entry["path"])
+        finally:
+            writer.close()
+
+    async def stage(self, manifest, entries):
+        # Downloads entries into /ota/new; True if all of them verified.
+        ota = self.root + OTA_DIR
+        _remove_tree(ota + "/new")
+        _remove_tree(ota + "/old")
+        try:
+            for entry in entries:
+                await self.fetch(entry, ota + "/new/" + entry["path"])
+                await asyncio.sleep_ms(0)
+        except (OSError, ValueError) as e:
+            log.warning("OTA: staging failed: %s", e)
+            _remove_tree(ota + "/new")
+            return False
+        _makedirs(ota + "/new")
+        with open(ota + "/new/" + VERSION_FILE, "w") as f:
+            json.dump({"version": manifest["version"]}, f)
+        with open(ota + "/new/" + MANIFEST_FILE, "w") as f:
+            json.dump(manifest, f)
+        return True
+
+    async def update(self):
+        # True once a newer version is staged and switched in
+        global _busy
+        if _busy:
+            log.warning("OTA: update already in progress")
+            return False
+        _busy = True
+        try:
+            return await self._update()
+        finally:
+            _busy = False
+
+    async def _update(self):
+        if pending(self.root):
+            log.warning("OTA: previous update not confirmed yet")
+            return False
+        manifest = await self.manifest()
+        current = self.local_version()
+        if manifest["version"] <= current:
+            log.info("OTA: version %d is current", current)
+            return False
+        local = self._local_manifest()
+        changed = [e for e in manifest["files"] if not self._installed(e, local)]
+        removed = self._obsolete(manifest, local)
+        log.info("OTA: %d -> %d, %d of %d files changed, %d removed", current, manifest["version"],
+                 len(changed), len(manifest["files"]), len(removed))
+        if not await self.stage(manifest, changed):
+            return False
+        paths = [e["path"] for e in changed] + [VERSION_FILE, MANIFEST_FILE]
+        _save_state(self.root, {"state": "switching", "version": manifest["version"], "prev": current,
+                                "files": paths, "removed": removed, "boots": 0})
+        _switch(self.root)
+        log.info("OTA: switched to %d (%d bytes), on trial", manifest["version"], self.downloaded)
+        return True
+
+
+def _load_state(root):
+    try:
+        with open(root + OTA_DIR + "/state") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_state(root, state):
+    _makedirs(root + OTA_DIR)
+    with open(root + OTA_DIR + "/state", "w") as f:
+        json.dump(state, f)
+
+
+def _switch(root):
+    # Idempotent: files whose staged copy is gone were already switched.
+    state = _load_state(root)
+    ota = root + OTA_DIR
+    for path in state["files"]:
+        new = ota + "/new/" + path
+        if not _exists(new):
+            continue
+        cur = root + "/" + path
+        if _exists(cur):
+            _move(cur, ota + "/old/" + path)
+        _move(new, cur)
+    for path in state.get("removed", ()):
+        cur = root + "/" + path
+        if _exists(cur):
+            _move(cur, ota + "/old/" + path)
+    state["state"] = "trial"
+    _save_state(root, state)
+
+
+def _rollback(root, state):
+    ota = root + OTA_DIR
+    for path in state["files"] + state.get("removed", []):
+        cur = root + "/" + path
+        old = ota + "/old/" + path
+        if _exists(old):
+            _move(old, cur)
+        elif _exists(cur):
+            os.remove(cur)  # added by the update
+    state["state"] = "rolledback"
+    os.remove(ota + "/state")
+    log.warning("OTA: rolled back %d -> %d", state["version"], state["prev"])
+
+
+def boot_check(root=""):
+    # From boot.py: finish an interrupted switch, count trial boots and
+    # roll back an unconfirmed version. Returns the state name or None.
+    state = _load_state(root)
+    if state is None:
+        return None
+    if state["state"] == "switching":
+        _switch(root)
+        state = _load_state(root)
+    if state["state"] == "trial":
+        state["boots"] += 1
+        if state["boots"] > MAX_TRIAL_BOOTS:
+            _rollback(root, state)
+        else:
+            _save_state(root, state)
+    return state["state"]
+
+
+def pending(root=""):
+    state = _load_state(root)
+    return state is not None and state["state"] == "trial"
+
+
+def confirm(root=""):
+    # The running version works: keep it and drop the old files.
+    state = _load_state(root)
+    if state is None or state["state"] != "trial":
+        return False
+    os.remove(root + OTA_DIR + "/state")
+    _remove_tree(root + OTA_DIR + "/old")
+    log.info("OTA: version %d confirmed", state["version"])
+    return True
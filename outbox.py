@@ -0,0 +1,180 @@
+# Coalescing telemetry publisher.
+#
+# Decoded values are recorded with set() as often as frames arrive; only
+# the latest value per key is kept. Once per window flush() sends them
+# either as one compact JSON object (MODE_JSON) or as a pipelined burst
+# of one PUBLISH per key (MODE_BURST) written with a single drain.
+#
+# Optional per-key rules (deadband, max_interval_s) suppress redundant
+# updates: a value only becomes fresh when it moved more than deadband
+# (in the raw integer units passed to set()) from the value last marked
+# for publishing, or when max_interval_s has passed since then, which
+# bounds staleness. A rule named e.g. 'cell' applies to cell1, cell2, ...
+# A JSON snapshot only carries the fresh keys, so values held back by a
+# deadband cost neither a message in burst mode nor bytes in JSON mode;
+# the first snapshot has every key, later ones what changed.
+#
+# While the broker is unreachable, JSON snapshots go into a bounded RAM
+# outbox (oldest dropped first) and are sent in order on reconnect; in
+# burst mode the per-key table itself is the outbox, so superseded
+# values are simply overwritten.
+
+import berger
+from compat import compact_json, ticks_diff, ticks_ms, unix_time
+
+MODE_JSON = 0
+MODE_BURST = 1
+
+CELL_KEYS = tuple('cell%d' % (i + 1) for i in range(berger.MAX_CELLS))
+TEMP_KEYS = tuple('temp%d' % (i + 1) for i in range(berger.MAX_TEMPS))
+
+
+class Outbox:
+    """Latest-value table plus bounded backlog of snapshots.
+
+    set(key, value, scale) stores an integer; the published value is
+    value / scale, converted only at flush time so recording a frame
+    does not allocate floats.
+    """
+
+    def __init__(self, topic, mode=MODE_JSON, window_ms=5000, max_backlog=16, rules=None):
+        self.topic = topic
+        self.rules = rules or {}
+        self._key_rules = {}  # key -> (deadband, max_interval_ms)
+        self._ref = {}
+        self._pub_t = {}
+        self.mode = mode
+        self.window_ms = window_ms
+        self.max_backlog = max_backlog
+        self._values = {}
+        self._scales = {}
+        self._fresh = {}
+        self._dirty = False
+        self._dirty_t0 = 0
+        self.latency_ms = None  # optional metrics.Histogram, first set() to publish
+        self._topics = {}
+        self._backlog = []
+        self.updates = 0
+        self.superseded = 0
+        self.suppressed = 0
+        self.flushes = 0
+        self.messages = 0
+        self.dropped = 0
+
+    def _rule(self, key):
+        rule = self.rules.get(key)
+        if rule is None:
+            rule = self.rules.get(key.rstrip('0123456789'))
+        if rule is not None:
+            self._key_rules[key] = (rule[0], rule[1] * 1000)
+            self._pub_t[key] = ticks_ms()
+
+    def set(self, key, value, scale=1):
+        self.updates += 1
+        fresh = self._fresh.get(key)
+        if fresh is None:
+            self._scales[key] = scale
+            self._topics[key] = self.topic + '/' + key
+            self._rule(key)
+        elif fresh:
+            self.superseded += 1
+        else:
+            rule = self._key_rules.get(key)
+            if rule is not None and -rule[0] <= value - self._ref[key] <= rule[0]:
+                self._values[key] = value
+                self.suppressed += 1
+                return
+        self._values[key] = value
+        self._ref[key] = value
+        self._fresh[key] = True
+        if not self._dirty:
+            self._dirty_t0 = ticks_ms()
+        self._dirty = True
+
+    def record(self, dec):
+        # The values of a decoded status frame (berger.Decoder)
+        self.set('voltage', dec.pack_mv, 1000)
+        self.set('current', dec.current_ma, 1000)
+        self.set('soc', dec.soc)
+        self.set('capacity', dec.capacity_mah, 1000)
+        cells = dec.cells
+        for i in range(dec.ncells):
+            self.set(CELL_KEYS[i], cells[i], 1000)
+        temps = dec.temps
+        for i in range(dec.ntemps):
+            self.set(TEMP_KEYS[i], temps[i], 10)
+
+    def _expire(self):
+        # Keys not marked for max_interval are republished as they are.
+        now = ticks_ms()
+        for key, rule in self._key_rules.items():
+            if not self._fresh[key] and ticks_diff(now, self._pub_t[key]) >= rule[1]:
+                self._ref[key] = self._values[key]
+                self._fresh[key] = True
+                if not self._dirty:
+                    self._dirty_t0 = now
+                self._dirty = True
+
+    def _sent(self):
+        now = ticks_ms()
+        for k in self._fresh:
+            if self._fresh[k]:
+                self._fresh[k] = False
+                if k in self._key_rules:
+                    self._pub_t[k] = now
+        self._dirty = False
+
+    def _value(self, key):
+        scale = self._scales[key]
+        v = self._values[key]
+        return v if scale == 1 else v / scale
+
+    def snapshot(self):
+        # Compact JSON object of the fresh values plus the time it was
+        # taken, so snapshots replayed after an outage keep their order.
+        fresh = self._fresh
+        d = {k: self._value(k) for k in self._values if fresh[k]}
+        d['ts'] = unix_time()
+        return compact_json(d)
+
+    def pending(self):
+        return len(self._backlog) + (1 if self._dirty else 0)
+
+    async def flush(self, client):
+        # Called once per window. client may be None or disconnected.
+        if self._key_rules:
+            self._expire()
+        online = client is not None and client.isconnected()
+        t0 = self._dirty_t0 if self._dirty and online else None
+        if self.mode == MODE_JSON:
+            if self._dirty:
+                if len(self._backlog) >= self.max_backlog:
+                    self._backlog.pop(0)
+                    self.dropped += 1
+                self._backlog.append(self.snapshot())
+                self._sent()
+            if not online:
+                return 0
+            if not self._backlog:
+                return 0
+            backlog = self._backlog
+            self._backlog = []
+            try:
+                await client.publish_many([(self.topic, p) for p in backlog])
+            except Exception:
+                self._backlog = (backlog + self._backlog)[-self.max_backlog:]
+                raise
+            sent = len(backlog)
+        else:
+            if not (self._dirty and online):
+                return 0
+            pkts = [(self._topics[k], str(self._value(k))) for k in self._values if self._fresh[k]]
+            await client.publish_many(pkts)
+            self._sent()
+            sent = len(pkts)
+        self.flushes += 1
+        self.messages += sent
+        if t0 is not None and self.latency_ms is not None:
+            self.latency_ms.since_ms(t0)
+        return sent
+
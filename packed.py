@@ -0,0 +1,113 @@
+# Compact binary telemetry payload.
+#
+# One status snapshot per message, little-endian, fixed layout for a given
+# cell/temperature count:
+#
+#   offset  type  field
+#   0       B     version (VERSION)
+#   1       B     flags (none defined yet, 0)
+#   2       H     sequence number, wraps at 65536
+#   4       I     unix time [s] (compat.unix_time(), also on the ESP32)
+#   8       I     pack voltage [mV]
+#   12      i     current [mA, +charge/-discharge]
+#   16      I     remaining capacity [mAh]
+#   20      B     SOC [%]
+#   21      B     cell count n
+#   22      B     temperature count t
+#   23      B     reserved (0)
+#   24      n*H   cell voltages [mV]
+#   ..      t*h   temperatures [0.1 degC]
+#
+# A 4-cell, 2-temperature pack is 36 bytes against ~155 for the JSON
+# snapshot. Decoders must check the version and ignore bytes past the
+# fields they know; new fields are only ever appended, anything else bumps
+# VERSION.
+#
+# Packer writes into a preallocated buffer with struct.pack_into, so
+# encoding a frame does not allocate. decode() is the reference decoder
+# and runs unchanged on the host.
+
+import struct
+
+VERSION = 1
+HEADER = "<BBHIIiIBBBB"
+HEADER_SIZE = struct.calcsize(HEADER)  # 24
+
+
+def size(ncells, ntemps):
+    return HEADER_SIZE + 2 * ncells + 2 * ntemps
+
+
+class Packer:
+    """Encodes the latest values of a berger.Decoder.
+
+        packer = Packer(topic + "/bin", max_cells, max_temps)
+        if packer.changed(decoder):
+            n = packer.pack(decoder, time.time())
+            await client.publish(packer.topic, packer.view[:n])
+
+    The view is only valid until the next pack().
+    """
+
+    def __init__(self, topic, max_cells=16, max_temps=4):
+        self.topic = topic
+        self._buf = bytearray(size(max_cells, max_temps))
+        self.view = memoryview(self._buf)
+        self.seq = 0
+        self.packed = 0
+        self._frames = -1
+
+    def changed(self, dec):
+        # New status values since the last pack()
+        return dec.has_status and dec.frames != self._frames
+
+    def pack(self, dec, ts, flags=0):
+        buf = self._buf
+        ncells = dec.ncells
+        ntemps = dec.ntemps
+        struct.pack_into(HEADER, buf, 0, VERSION, flags, self.seq, ts, dec.pack_mv,
+                         dec.current_ma, dec.capacity_mah, dec.soc, ncells, ntemps, 0)
+        off = HEADER_SIZE
+        cells = dec.cells
+        for i in range(ncells):
+            struct.pack_into("<H", buf, off, cells[i])
+            off += 2
+        temps = dec.temps
+        for i in range(ntemps):
+            struct.pack_into("<h", buf, off, temps[i])
+            off += 2
+        self.seq = (self.seq + 1) & 0xFFFF
+        self._frames = dec.frames
+        self.packed += 1
+        return off
+
+
+def decode(payload):
+    """Reference decoder: payload bytes -> dict of values in SI units.
+
+    Raises ValueError for an unknown version or a truncated payload.
+    """
+    if len(payload) < HEADER_SIZE:
+        raise ValueError("short payload")
+    (version, flags, seq, ts, pack_mv, current_ma, capacity_mah, soc,
+     ncells, ntemps, _) = struct.unpack_from(HEADER, payload, 0)
+    if version != VERSION:
+        raise ValueError("unknown version %d" % version)
+    if len(payload) < size(ncells, ntemps):
+        raise ValueError("truncated payload")
+    cells = struct.unpack_from("<%dH" % ncells, payload, HEADER_SIZE)
+    temps = struct.unpack_from("<%dh" % ntemps, payload, HEADER_SIZE + 2 * ncells)
+    d = {
+        "seq": seq,
+        "ts": ts,
+        "voltage": pack_mv / 1000,
+        "current": current_ma / 1000,
+        "soc": soc,
+        "capacity": capacity_mah / 1000,
+        "flags": flags,
+    }
+    for i in range(ncells):
+        d["cell%d" % (i + 1)] = cells[i] / 1000
+    for i in range(ntemps):
+        d["temp%d" % (i + 1)] = temps[i] / 10
+    return d
@@ -0,0 +1,139 @@
+# Cheap pre-filter for GAP scan results.
+#
+# Runs in the BLE IRQ on the raw values the stack hands over: advertising
+# type and RSSI are integer compares, and a 256-entry table of the last
+# MAC byte rejects almost every foreign device before any byte-wise MAC
+# compare. Only candidates that pass are looked at further; the
+# AD-structure helpers walk adv_data in place (no slicing, no copies), so
+# they are safe to run in the IRQ as well.
+
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+# Advertising PDU types as reported in _IRQ_SCAN_RESULT
+ADV_IND = const(0)
+ADV_DIRECT_IND = const(1)
+ADV_SCAN_IND = const(2)
+ADV_NONCONN_IND = const(3)
+SCAN_RSP = const(4)
+
+# AD types
+AD_FLAGS = const(0x01)
+AD_UUID16_INCOMPLETE = const(0x02)
+AD_UUID16_COMPLETE = const(0x03)
+AD_NAME_SHORT = const(0x08)
+AD_NAME_COMPLETE = const(0x09)
+
+
+def ad_find(adv, ad_type):
+    # Offset of the payload of the first AD structure of ad_type, or -1.
+    # The payload length is adv[offset - 2] - 1.
+    i = 0
+    n = len(adv)
+    while i + 1 < n:
+        length = adv[i]
+        if length == 0:
+            break
+        if adv[i + 1] == ad_type:
+            return i + 2 if i + 1 + length <= n else -1
+        i += 1 + length
+    return -1
+
+
+def has_uuid16(adv, uuid):
+    # True if a complete or incomplete 16-bit service UUID list has uuid.
+    lo = uuid & 0xFF
+    hi = uuid >> 8
+    i = 0
+    n = len(adv)
+    while i + 1 < n:
+        length = adv[i]
+        if length == 0:
+            break
+        end = i + 1 + length
+        if end > n:
+            break
+        t = adv[i + 1]
+        if t == AD_UUID16_COMPLETE or t == AD_UUID16_INCOMPLETE:
+            j = i + 2
+            while j + 1 < end:
+                if adv[j] == lo and adv[j + 1] == hi:
+                    return True
+                j += 2
+        i = end
+    return False
+
+
+def name_is(adv, name):
+    # Compare the (complete or short) local name with bytes name in place.
+    off = ad_find(adv, AD_NAME_COMPLETE)
+    if off < 0:
+        off = ad_find(adv, AD_NAME_SHORT)
+        if off < 0:
+            return False
+    n = adv[off - 2] - 1
+    if n != len(name):
+        return False
+    for k in range(n):
+        if adv[off + k] != name[k]:
+            return False
+    return True
+
+
+class ScanFilter:
+    """First stage of scan result handling, in the IRQ.
+
+        f = ScanFilter(min_rssi=-90)
+        f.add_mac(mac)
+        if f.accept(adv_type, rssi):
+            if f.maybe_known(addr):      # then compare the full MAC
+                ...
+            elif f.is_candidate(adv_data):
+                ...                      # unknown device offering uuid16
+
+    Only connectable advertisements (ADV_IND, ADV_DIRECT_IND) pass by
+    default; is_candidate() parses adv_data for the service UUID and,
+    if set, the local name.
+    """
+
+    def __init__(self, min_rssi=-100, uuid16=None, name=None, connectable_only=True):
+        self.min_rssi = min_rssi
+        self.uuid16 = uuid16
+        self.name = name
+        self._types = (1 << ADV_IND) | (1 << ADV_DIRECT_IND) if connectable_only else 0x1F
+        self._tails = bytearray(256)
+        self.seen = 0
+        self.rejected = 0
+        self.parsed = 0
+        self.candidates = 0
+
+    def add_mac(self, mac):
+        self._tails[mac[-1]] = 1
+
+    def accept(self, adv_type, rssi):
+        self.seen += 1
+        if rssi < self.min_rssi or not (self._types >> adv_type) & 1:
+            self.rejected += 1
+            return False
+        return True
+
+    def maybe_known(self, addr):
+        return self._tails[addr[-1]] == 1
+
+    def is_candidate(self, adv_data):
+        self.parsed += 1
+        if self.uuid16 is not None and not has_uuid16(adv_data, self.uuid16):
+            return False
+        if self.name is not None and not name_is(adv_data, self.name):
+            return False
+        if self.uuid16 is None and self.name is None:
+            return False
+        self.candidates += 1
+        return True
+
+    def counts(self):
+        # [seen, rejected by type/RSSI, AD-parsed, candidates]
+        return [self.seen, self.rejected, self.parsed, self.candidates]
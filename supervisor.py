@@ -0,0 +1,159 @@
+# Async supervisor for the WiFi, MQTT and BLE links.
+#
+# Each link runs in its own task: while it is up the task only checks it
+# every check_ms; once it drops, the task retries connect() with jittered
+# exponential backoff until it comes back. Links recover independently -
+# a dead broker does not hold up BLE - except that a link waits for the
+# link it depends on (MQTT on WiFi) instead of burning retries.
+#
+# Per link the supervisor keeps failures, recoveries and the time from
+# detecting the outage to being up again (last and max).
+
+import random
+import log
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from compat import ticks_ms, ticks_diff
+
+
+class Backoff:
+    """Exponential backoff with jitter: each delay is drawn from
+    [d/2, d] with d = base_ms * factor**attempt, capped at max_ms."""
+
+    def __init__(self, base_ms=500, max_ms=60000, factor=2):
+        self.base_ms = base_ms
+        self.max_ms = max_ms
+        self.factor = factor
+        self.attempt = 0
+
+    def reset(self):
+        self.attempt = 0
+
+    def next(self):
+        d = self.base_ms
+        for _ in range(self.attempt):
+            d *= self.factor
+            if d >= self.max_ms:
+                d = self.max_ms
+                break
+        else:
+            self.attempt += 1
+        half = d // 2
+        return half + random.getrandbits(16) % (d - half + 1)
+
+
+class Link:
+    def __init__(self, name, connect, is_up, on_up=None, depends=None, backoff=None, check_ms=1000):
+        self.name = name
+        self.connect = connect  # async () -> bool
+        self.is_up = is_up  # () -> bool
+        self.on_up = on_up  # optional async () after each (re)connect
+        self.depends = depends
+        self.backoff = backoff or Backoff()
+        self.check_ms = check_ms
+        self.up = False
+        self.attempts = 0
+        self.failures = 0
+        self.recoveries = 0
+        self.last_recover_ms = None
+        self.max_recover_ms = 0
+        self.recover_hist = None  # optional metrics.Histogram
+        self.up_event = asyncio.Event()  # wakes dependent links
+        self._down_t0 = None
+
+    def stats(self):
+        return (f"{self.name} up={self.up} attempts={self.attempts} failures={self.failures} "
+                f"recoveries={self.recoveries} recover_ms={self.last_recover_ms} max_recover_ms={self.max_recover_ms}")
+
+
+class Supervisor:
+    """Owns one task per Link.
+
+        sup = Supervisor()
+        wifi = sup.add("wifi", connect_wifi, wlan.isconnected, on_up=sync_time_async)
+        sup.add("mqtt", connect_mqtt, mqtt_online, on_up=subscribe, depends=wifi)
+        sup.start()
+    """
+
+    def __init__(self):
+        self.links = []
+        self._tasks = []
+
+    def add(self, name, connect, is_up, **kwargs):
+        link = Link(name, connect, is_up, **kwargs)
+        self.links.append(link)
+        return link
+
+    def start(self):
+        for link in self.links:
+            self._tasks.append(asyncio.create_task(self._run(link)))
+
+    def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        self._tasks = []
+
+    def stats(self):
+        return "; ".join(link.stats() for link in self.links)
+
+    async def _recovered(self, link, first):
+        link.up = True
+        link.up_event.set()
+        link.backoff.reset()
+        dt = ticks_diff(ticks_ms(), link._down_t0)
+        link.last_recover_ms = dt
+        if not first:
+            link.recoveries += 1
+            if dt > link.max_recover_ms:
+                link.max_recover_ms = dt
+            if link.recover_hist is not None:
+                link.recover_hist.observe(dt)
+        log.info("Supervisor: %s up after %d ms", link.name, dt)
+        if link.on_up is not None:
+            try:
+                await link.on_up()
+            except Exception as e:
+                log.error("Supervisor: %s on_up failed: %s", link.name, e)
+
+    async def _run(self, link):
+        first = True
+        link._down_t0 = ticks_ms()
+        while True:
+            if link.is_up():
+                if not link.up:
+                    # Came back on its own, e.g. the WiFi stack reconnected.
+                    await self._recovered(link, first)
+                    first = False
+                await asyncio.sleep_ms(link.check_ms)
+                continue
+            if link.up:
+                link.up = False
+                link.up_event.clear()
+                link._down_t0 = ticks_ms()
+                link.backoff.reset()
+                log.warning("Supervisor: %s down", link.name)
+            if link.depends is not None and not link.depends.up:
+                # Start as soon as the dependency is up, not at the next check
+                try:
+                    await asyncio.wait_for(link.depends.up_event.wait(), link.check_ms / 1000)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            link.attempts += 1
+            try:
+                ok = await link.connect()
+            except Exception as e:
+                log.warning("Supervisor: %s connect failed: %s", link.name, e)
+                ok = False
+            if ok and link.is_up():
+                await self._recovered(link, first)
+                first = False
+                continue
+            link.failures += 1
+            delay = link.backoff.next()
+            log.info("Supervisor: %s retry in %d ms", link.name, delay)
+            await asyncio.sleep_ms(delay)
@@ -0,0 +1,149 @@
+# Verified TLS for the broker connections.
+#
+# The CA is read from flash and parsed into an SSLContext once; every
+# (re)connect reuses that context and does a single, verified handshake
+# (server_hostname is checked against the certificate). Where the ssl
+# module supports sessions (SSLSession) and the socket is wrapped through
+# wrap_socket() - uasyncio streams, umqtt - the session of the previous
+# connection is offered again, so the broker can resume it instead of a
+# full handshake. CPython's asyncio streams cannot take a session.
+#
+# Handshake time and the heap allocated while connecting are recorded
+# per connect; the peaks are kept for stats(). ssl is only imported by the
+# first context(), so a firmware without MQTT over TLS never loads it.
+
+import gc
+import sys
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from compat import ticks_ms, ticks_diff
+
+try:
+    from gc import mem_alloc
+except ImportError:
+    mem_alloc = None  # CPython: measure with tracemalloc instead
+
+ssl = None  # set by _import_ssl()
+_SESSIONS = False
+# uasyncio wraps the socket through ssl.wrap_socket(); CPython's asyncio
+# needs a real SSLContext.
+_MICROPYTHON = sys.implementation.name == 'micropython'
+
+
+def _import_ssl():
+    global ssl, _SESSIONS
+    if ssl is None:
+        try:
+            import ssl as mod
+        except ImportError:
+            import ussl as mod
+        ssl = mod
+        _SESSIONS = hasattr(mod, 'SSLSession')
+
+
+class TLSClient:
+    """Client-side TLS context with the CA kept in RAM.
+
+        tls = TLSClient('/ssl/ca.crt')
+        client = amqtt.MQTTClient(..., ssl=tls)        # asyncio
+        client = umqtt.simple.MQTTClient(..., ssl=tls)  # blocking
+    """
+
+    def __init__(self, ca_path):
+        self.ca_path = ca_path
+        self._ctx = None
+        self._session = None
+        self._sslobj = None
+        self._t0 = 0
+        self._heap0 = 0
+        self.ca_loads = 0
+        self.handshakes = 0
+        self.resumed = 0
+        self.handshake_ms = None
+        self.max_handshake_ms = 0
+        self.heap_peak = 0
+
+    def context(self):
+        if self._ctx is None:
+            _import_ssl()
+            with open(self.ca_path, 'rb') as f:
+                ca = f.read()
+            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            ctx.verify_mode = ssl.CERT_REQUIRED
+            try:
+                ctx.load_verify_locations(cadata=ca)
+            except (TypeError, ValueError, OSError):
+                ctx.load_verify_locations(cadata=ca.decode())  # CPython wants PEM as str
+            self._ctx = ctx
+            self.ca_loads += 1
+            del ca
+            gc.collect()
+        return self._ctx
+
+    def _harvest(self):
+        # With TLS 1.2 the session exists right after the handshake; a
+        # TLS 1.3 ticket arrives later, so look again before reconnecting
+        # (only possible while the old socket is still open).
+        obj = self._sslobj
+        if _SESSIONS and obj is not None:
+            try:
+                session = obj.session
+            except (AttributeError, ValueError, OSError):
+                session = None
+            if session is not None:
+                self._session = session
+
+    def wrap_socket(self, sock, server_hostname=None, do_handshake_on_connect=True):
+        # SSLContext.wrap_socket() stand-in, used by uasyncio and umqtt.
+        ctx = self.context()
+        self._harvest()
+        kw = {}
+        if _SESSIONS and self._session is not None:
+            kw['session'] = self._session
+        if do_handshake_on_connect:
+            self._heap0 = mem_alloc() if mem_alloc else 0
+            self._t0 = ticks_ms()
+        s = ctx.wrap_socket(sock, server_hostname=server_hostname,
+                            do_handshake_on_connect=do_handshake_on_connect, **kw)
+        self._sslobj = s
+        if do_handshake_on_connect:
+            self.established()
+        return s
+
+    async def open_connection(self, host, port, timeout=10):
+        # Streams for host:port; call established() after the first reply.
+        ctx = self.context()
+        self._harvest()
+        self._heap0 = mem_alloc() if mem_alloc else 0
+        self._t0 = ticks_ms()
+        if _MICROPYTHON:
+            conn = asyncio.open_connection(host, port, ssl=self)
+        else:
+            conn = asyncio.open_connection(host, port, ssl=ctx, server_hostname=host)
+        return await asyncio.wait_for(conn, timeout)
+
+    def established(self, writer=None):
+        # uasyncio defers the handshake to the first write, so the time is
+        # taken up to the first reply (e.g. CONNACK): TCP, TLS and one round trip.
+        dt = ticks_diff(ticks_ms(), self._t0)
+        if mem_alloc:
+            heap = mem_alloc() - self._heap0
+            if heap > self.heap_peak:
+                self.heap_peak = heap
+        if writer is not None and not _MICROPYTHON:
+            self._sslobj = writer.get_extra_info('ssl_object')
+        if getattr(self._sslobj, 'session_reused', False):
+            self.resumed += 1
+        self._harvest()
+        self.handshakes += 1
+        self.handshake_ms = dt
+        if dt > self.max_handshake_ms:
+            self.max_handshake_ms = dt
+
+    def stats(self):
+        return (f"tls handshakes={self.handshakes} resumed={self.resumed} handshake_ms={self.handshake_ms} "
+                f"max_handshake_ms={self.max_handshake_ms} heap_peak={self.heap_peak} ca_loads={self.ca_loads}")
@@ -0,0 +1,117 @@
+# Generates manifest.json for otaupdate.py (run on the host).
+#
+#   python tools/make_manifest.py                  # version from version.json
+#   python tools/make_manifest.py --version 92     # also writes version.json
+#   python tools/make_manifest.py --mpy            # modules as precompiled .mpy
+#
+# The firmware files are main.py, boot.py and every module of this
+# directory they import, directly or indirectly (lazy imports included),
+# except the per-van configuration (BROKER.py, WIFI_CONFIG.py): it holds
+# credentials, is not in the repository and must survive updates.
+# A release is: bump the version, run this, commit manifest.json and
+# version.json (and mpy/ with --mpy).
+#
+# With --mpy every module except main.py and boot.py (MicroPython runs
+# those from source) is compiled by mpy-cross into mpy/<name>.mpy and
+# listed with path <name>.mpy and url mpy/<name>.mpy; devices then skip
+# compiling them at boot. mpy-cross must produce the .mpy version of the
+# firmware on the device; --march xtensawin allows @micropython.native.
+
+import argparse
+import ast
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+ENTRY_POINTS = ("main.py", "boot.py")
+SOURCE_ONLY = ("main.py", "boot.py")
+EXCLUDE = ("BROKER.py", "WIFI_CONFIG.py")
+
+
+def firmware_files(src):
+    # Entry points plus the local modules they pull in
+    todo = [f for f in ENTRY_POINTS if os.path.exists(os.path.join(src, f))]
+    seen = set()
+    while todo:
+        name = todo.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        with open(os.path.join(src, name)) as f:
+            tree = ast.parse(f.read(), name)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                mods = [a.name for a in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                mods = [node.module]
+            else:
+                continue
+            for mod in mods:
+                path = mod.split('.')[0] + '.py'
+                if path not in EXCLUDE and os.path.exists(os.path.join(src, path)):
+                    todo.append(path)
+    return sorted(seen)
+
+
+def entry(path, data, url=None):
+    e = {"path": path, "size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+    if url is not None and url != path:
+        e["url"] = url
+    return e
+
+
+def compile_mpy(src, name, out_dir, mpy_cross="mpy-cross", march=None):
+    os.makedirs(out_dir, exist_ok=True)
+    out = os.path.join(out_dir, name[:-3] + ".mpy")
+    cmd = [mpy_cross, "-o", out]
+    if march:
+        cmd.append("-march=" + march)
+    subprocess.run(cmd + [os.path.join(src, name)], check=True)
+    with open(out, "rb") as f:
+        return f.read()
+
+
+def build(src, version, files=None, mpy=False, mpy_cross="mpy-cross", march=None):
+    files = [f for f in files or firmware_files(src) if os.path.basename(f) not in EXCLUDE]
+    out = []
+    for name in files:
+        if mpy and name.endswith(".py") and name not in SOURCE_ONLY:
+            data = compile_mpy(src, name, os.path.join(src, "mpy"), mpy_cross, march)
+            mpy_name = name[:-3] + ".mpy"
+            out.append(entry(mpy_name, data, "mpy/" + mpy_name))
+        else:
+            with open(os.path.join(src, name), "rb") as f:
+                out.append(entry(name, f.read()))
+    return {"version": version, "files": out}
+
+
+def main():
+    p = argparse.ArgumentParser(description="Generate manifest.json for OTA updates")
+    p.add_argument("files", nargs="*", help="files to list (default: main.py, boot.py and their imports)")
+    p.add_argument("--src", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    p.add_argument("--version", type=int, help="release version (default: from version.json)")
+    p.add_argument("--mpy", action="store_true", help="ship modules as .mpy")
+    p.add_argument("--mpy-cross", default="mpy-cross")
+    p.add_argument("--march")
+    args = p.parse_args()
+    src = os.path.normpath(args.src)
+    version_path = os.path.join(src, "version.json")
+    if args.version is None:
+        with open(version_path) as f:
+            version = json.load(f)["version"]
+    else:
+        version = args.version
+        with open(version_path, "w") as f:
+            json.dump({"version": version}, f)
+    manifest = build(src, version, args.files, args.mpy, args.mpy_cross, args.march)
+    with open(os.path.join(src, "manifest.json"), "w") as f:
+        json.dump(manifest, f, separators=(",", ":"))  # compact: the device reads it
+    total = sum(e["size"] for e in manifest["files"])
+    print("manifest.json: version %d, %d files, %d bytes" % (version, len(manifest["files"]), total),
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()